@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import argparse
+import struct
+import tempfile
+from collections.abc import Iterable, Iterator
+from contextlib import ExitStack
+from typing import BinaryIO, NamedTuple, TextIO
+
+from isa import DATA_MEMORY_BEGIN_ADDRESS, INPUT_CELL_ADDRESS, INSTRUCTION_MEMORY_BEGIN_ADDRESS, OUTPUT_CELL_ADDRESS
+from object_file import HEADER, MAGIC, SECTION_DATA, SECTION_TEXT, SYMBOL, VERSION, WORD_SIZE
+from translator import (
+    convert_data_tokens_to_binary,
+    convert_tokens_to_binary,
+    data_line_size,
+    remove_comments,
+    tokenize_line,
+)
+from translator_excpetions import DuplicateLabelError, UndefinedLabelError
+from translator_token import Token, TokenType
+
+WORD = struct.Struct("<I")
+# Text format: a 32 character binary word per line, lines separated by "\n"
+TEXT_LINE_SIZE = 33
+
+
+class LabelTable(dict):
+    """
+    Labels defined so far. Looking up a label which is not defined yet gives address 0 and
+    remembers the label, so the word can be backpatched when the label shows up.
+    """
+
+    def __init__(self, labels: dict[str, int] | None = None):
+        super().__init__(labels or {})
+        self.missing: str | None = None
+
+    def __missing__(self, label: str) -> int:
+        self.missing = label
+        return 0
+
+
+class Fixup(NamedTuple):
+    index: int  # Code word
+    word: int  # Code word with address 0
+    table: LabelTable
+    label: str
+    listing_offset: int | None  # Byte position of the binary word in the listing file
+
+
+class ObjectOutput:
+    """Writes the object file as the code comes, the data is spooled to a temporary file until the end."""
+
+    def __init__(self, stack: ExitStack, target: str):
+        self.file: BinaryIO = stack.enter_context(open(target, "w+b"))
+        self.data: BinaryIO = stack.enter_context(tempfile.TemporaryFile())
+        self.file.write(bytes(HEADER.size))
+        self.code_size = 0
+        self.data_size = 0
+
+    def write_code(self, word: int) -> None:
+        self.file.write(WORD.pack(word))
+        self.code_size += 1
+
+    def patch_code(self, index: int, word: int) -> None:
+        position = self.file.tell()
+        self.file.seek(HEADER.size + index * WORD_SIZE)
+        self.file.write(WORD.pack(word))
+        self.file.seek(position)
+
+    def write_data(self, word: int) -> None:
+        self.data.write(WORD.pack(word))
+        self.data_size += 1
+
+    def finish(self, symbols: Iterable[tuple[str, int, int]]) -> None:
+        self.data.seek(0)
+        while chunk := self.data.read(1 << 16):
+            self.file.write(chunk)
+        count = 0
+        for name, section, address in symbols:
+            encoded = name.encode("utf-8")
+            self.file.write(SYMBOL.pack(section, address, len(encoded)))
+            self.file.write(encoded)
+            count += 1
+        self.file.seek(0)
+        self.file.write(
+            HEADER.pack(MAGIC, VERSION, 0, self.code_size, self.data_size, INSTRUCTION_MEMORY_BEGIN_ADDRESS, count)
+        )
+
+
+class TextOutput:
+    """Writes the code and data files of the text format line by line."""
+
+    def __init__(self, stack: ExitStack, target_code: str, target_data: str):
+        self.code: TextIO = stack.enter_context(open(target_code, "w+", encoding="utf-8", newline="\n"))
+        self.data: TextIO = stack.enter_context(open(target_data, "w", encoding="utf-8", newline="\n"))
+        self.code_size = 0
+        self.data_size = 0
+
+    @staticmethod
+    def _separator(size: int) -> str:
+        # No trailing newline, like translator.write_file
+        return "\n" if size else ""
+
+    def write_code(self, word: int) -> None:
+        self.code.write(f"{self._separator(self.code_size)}{word:032b}")
+        self.code_size += 1
+
+    def patch_code(self, index: int, word: int) -> None:
+        position = self.code.tell()
+        self.code.seek(index * TEXT_LINE_SIZE)
+        self.code.write(f"{word:032b}")
+        self.code.seek(position)
+
+    def write_data(self, word: int) -> None:
+        self.data.write(f"{self._separator(self.data_size)}{word:032b}")
+        self.data_size += 1
+
+    def finish(self, symbols: Iterable[tuple[str, int, int]]) -> None:
+        pass
+
+
+def read_lines(source: str) -> Iterator[str]:
+    """Source lines without comments and surrounding spaces, empty ones skipped."""
+    with open(source, encoding="utf-8") as file:
+        for line in file:
+            line = remove_comments(line).strip()
+            if line:
+                yield line
+
+
+class Assembler:
+    """
+    One-pass assembler producing the same program as translator.main.
+
+    Every line is tokenized, its labels defined and its words written as soon as it is read.
+    A reference to a label defined further down is written with address 0 and backpatched
+    when the label is defined, so only the labels and the pending references stay in memory.
+    The data lines of the listing come after the text ones, they are spooled to the data_listing
+    file until the end. Unlike translator.main, a label defined twice is an error.
+    """
+
+    def __init__(
+        self,
+        output: ObjectOutput | TextOutput,
+        listing: BinaryIO | None = None,
+        data_listing: BinaryIO | None = None,
+    ):
+        self.output = output
+        self.listing = listing
+        self.data_listing = data_listing
+        self.data_labels = LabelTable({"in": INPUT_CELL_ADDRESS, "out": OUTPUT_CELL_ADDRESS})
+        self.text_labels = LabelTable()
+        self.fixups: dict[str, list[Fixup]] = {}
+        self.section: str | None = None
+        self.data_address = DATA_MEMORY_BEGIN_ADDRESS
+        self.text_address = INSTRUCTION_MEMORY_BEGIN_ADDRESS
+
+    def feed(self, line: str) -> None:
+        tokens = tokenize_line(line)
+        if not tokens:
+            return
+        if tokens[0].get_type() == TokenType.SECTION:
+            self.section = str(tokens[0].get_value())
+        elif self.section == "data":
+            self._data_line(tokens)
+        elif self.section == "text":
+            self._text_line(tokens)
+        self._code_line(tokens, line)
+
+    def _define(self, table: LabelTable, label: str, address: int) -> None:
+        if label in table:
+            raise DuplicateLabelError(label)
+        table[label] = address
+        for fixup in self.fixups.pop(label, []):
+            if fixup.table is table:
+                self._patch(fixup, address)
+            else:
+                self.fixups.setdefault(label, []).append(fixup)
+
+    def _data_line(self, tokens: list[Token]) -> None:
+        if tokens[0].get_type() == TokenType.LABEL:
+            self._define(self.data_labels, tokens[0].get_string_value(), self.data_address)
+            self.data_address += data_line_size(tokens[1:])
+        for binary in convert_data_tokens_to_binary(tokens):
+            if self.data_listing is not None:
+                self.data_listing.write(f"{DATA_MEMORY_BEGIN_ADDRESS + self.output.data_size}  {binary}\n".encode())
+            self.output.write_data(int(binary, 2))
+
+    def _text_line(self, tokens: list[Token]) -> None:
+        if tokens[0].get_type() == TokenType.LABEL:
+            self._define(self.text_labels, tokens[0].get_string_value(), self.text_address)
+            if len(tokens) == 1:
+                return
+        self.text_address += 1
+
+    def _code_line(self, tokens: list[Token], line: str) -> None:
+        self.data_labels.missing = self.text_labels.missing = None
+        binary = convert_tokens_to_binary(tokens, self.data_labels, self.text_labels)
+        if not binary:
+            return
+        listing_offset = None
+        if self.listing is not None:
+            prefix = f"{self.output.code_size + 1} "
+            listing_offset = self.listing.tell() + len(prefix)
+            self.listing.write(f"{prefix}{binary} {line}\n".encode())
+        for table in (self.data_labels, self.text_labels):
+            if table.missing is not None:
+                fixup = Fixup(self.output.code_size, int(binary, 2), table, table.missing, listing_offset)
+                self.fixups.setdefault(table.missing, []).append(fixup)
+        self.output.write_code(int(binary, 2))
+
+    def _patch(self, fixup: Fixup, address: int) -> None:
+        word = fixup.word | (address & 0xFFFF) << 1
+        self.output.patch_code(fixup.index, word)
+        if fixup.listing_offset is not None and self.listing is not None:
+            position = self.listing.tell()
+            self.listing.seek(fixup.listing_offset)
+            self.listing.write(f"{word:032b}".encode())
+            self.listing.seek(position)
+
+    def finish(self) -> None:
+        """
+        Write the data section of the listing, the label maps and the symbols.
+
+        Raises:
+            UndefinedLabelError: If a referenced label was never defined.
+        """
+        if self.fixups:
+            raise UndefinedLabelError(next(iter(self.fixups)))
+        if self.listing is not None:
+            self.listing.write(b"-- Data section --\n")
+            if self.data_listing is not None:
+                self.data_listing.seek(0)
+                while chunk := self.data_listing.read(1 << 16):
+                    self.listing.write(chunk)
+            lines = [
+                "-- Data labels --",
+                str(dict(self.data_labels)),
+                "-- Text labels --",
+                str(dict(self.text_labels)),
+            ]
+            self.listing.writelines(f"{line}\n".encode() for line in lines)
+        symbols = [(label, SECTION_TEXT, address) for label, address in self.text_labels.items()]
+        symbols += [(label, SECTION_DATA, address) for label, address in self.data_labels.items()]
+        self.output.finish(symbols)
+
+
+def assemble(source: str, target_code: str, target_data: str | None = None, listing: str | None = None) -> None:
+    """
+    Translate the source in one pass, into an object file or the text code and data files if target_data is given.
+
+    Args:
+        source (str): Assembly source file, read line by line.
+        target_code (str): Object file or text code file.
+        target_data (str | None): Text data file.
+        listing (str | None): Listing file: "<number> <word> <line>" for every instruction, then the
+            data words and the label maps.
+    """
+    with ExitStack() as stack:
+        if target_data is None:
+            output: ObjectOutput | TextOutput = ObjectOutput(stack, target_code)
+        else:
+            output = TextOutput(stack, target_code, target_data)
+        listing_file = data_listing = None
+        if listing is not None:
+            listing_file = stack.enter_context(open(listing, "w+b"))
+            listing_file.write(b"-- Text section --\n")
+            data_listing = stack.enter_context(tempfile.TemporaryFile())
+        assembler = Assembler(output, listing_file, data_listing)
+        for line in read_lines(source):
+            assembler.feed(line)
+        assembler.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="One-pass translator of the RISC assembly")
+    parser.add_argument("source", help="assembly source file")
+    parser.add_argument("target_code", help="object file, or the code file of the text format")
+    parser.add_argument("target_data", nargs="?", help="data file, exports the program in the text format")
+    parser.add_argument("--listing", help="write the listing (words with their source lines and labels) to a file")
+    args = parser.parse_args()
+
+    assemble(args.source, args.target_code, args.target_data, args.listing)
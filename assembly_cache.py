@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from types import ModuleType
+from typing import NamedTuple
+
+import translator
+from object_file import SECTION_DATA, SECTION_TEXT, read_object
+
+DEFAULT_CACHE_DIRECTORY = Path.home() / ".cache" / "risc-assembly"
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+ENTRY_SUFFIX = ".o"
+STATS_FILE = "stats.json"
+STATS_FIELDS = ("hits", "misses", "bytes_read", "bytes_written", "evictions")
+
+
+class Assembly(NamedTuple):
+    """A translated program, as returned by the cache."""
+
+    code: array  # Instruction words
+    data: array  # Initial data memory words
+    entry: int
+    text_labels: dict[str, int]
+    data_labels: dict[str, int]
+
+
+def _imported_module(value: object) -> ModuleType | None:
+    """The module a global of another module is: the module itself, or the one defining a function, class or constant."""
+    if isinstance(value, ModuleType):
+        return value
+    return sys.modules.get(getattr(value, "__module__", None) or "")
+
+
+def translator_modules() -> list[ModuleType]:
+    """
+    Modules of the project the translator imports, directly or through each other, sorted by name.
+
+    A change in any of them (the optimizations, the microcode their costs come from, the ISA)
+    may change the translated program, so all of them invalidate the cached programs.
+
+    >>> [module.__name__ for module in translator_modules()][-4:]
+    ['peephole', 'translator', 'translator_excpetions', 'translator_token']
+    """
+    directory = Path(translator.__file__).parent
+    modules = {translator.__name__: translator}
+    pending = [translator]
+    while pending:
+        for value in list(vars(pending.pop()).values()):
+            module = _imported_module(value)
+            if module is None or module.__name__ in modules or getattr(module, "__file__", None) is None:
+                continue
+            if Path(module.__file__).parent == directory:
+                modules[module.__name__] = module
+                pending.append(module)
+    return [modules[name] for name in sorted(modules)]
+
+
+def translator_version() -> str:
+    """Hash of the sources of translator_modules(), part of the cache key of a program."""
+    digest = hashlib.sha256()
+    for module in translator_modules():
+        digest.update(Path(module.__file__).read_bytes())
+    return digest.hexdigest()
+
+
+def _write_text(filename: str, words: array) -> None:
+    translator.write_file(filename, [f"{word:032b}" for word in words])
+
+
+class AssemblyCache:
+    """
+    On-disk cache of translated programs, keyed by the source text, the optimizations and the translator version.
+
+    Every entry is an object file (code, data and the label table), named by the SHA-256 of the
+    key. A hit only reads the object file, the source is not tokenized. When the entries take
+    more than max_bytes the least recently used ones are removed, a hit counts as a use.
+    The counters are kept in stats.json next to the entries, so they add up across runs.
+    """
+
+    def __init__(self, directory: str | os.PathLike = DEFAULT_CACHE_DIRECTORY, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.version = translator_version()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, source: str, optimize: bool = False, dataflow: bool = False, profile: str | None = None) -> str:
+        """Key of a program: the translator version, the optimizations, the contents of the profile and the source."""
+        profile_text = "" if profile is None else Path(profile).read_text(encoding="utf-8")
+        options = json.dumps({"optimize": optimize, "dataflow": dataflow, "profile": profile_text})
+        return hashlib.sha256((self.version + options + source).encode("utf-8")).hexdigest()
+
+    def entries(self) -> list[Path]:
+        """Entries from the least to the most recently used."""
+        return sorted(self.directory.glob(f"*{ENTRY_SUFFIX}"), key=lambda entry: entry.stat().st_mtime_ns)
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self.entries())
+
+    def stats(self) -> dict[str, int]:
+        try:
+            stats = json.loads((self.directory / STATS_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            stats = {}
+        return {field: stats.get(field, 0) for field in STATS_FIELDS}
+
+    def _count(self, **increments: int) -> None:
+        stats = self.stats()
+        for field, increment in increments.items():
+            stats[field] += increment
+        temporary = self.directory / f"{STATS_FILE}.tmp"
+        temporary.write_text(json.dumps(stats), encoding="utf-8")
+        temporary.replace(self.directory / STATS_FILE)
+
+    def entry(self, source: str, optimize: bool = False, dataflow: bool = False, profile: str | None = None) -> Path:
+        """
+        Object file of the source, translated with the optimizations of translator.main and stored on a miss.
+
+        Returns:
+            Path: The cache entry, valid until it is evicted.
+        """
+        entry = self.directory / f"{self.key(source, optimize, dataflow, profile)}{ENTRY_SUFFIX}"
+        if entry.exists():
+            os.utime(entry)
+            self._count(hits=1, bytes_read=entry.stat().st_size)
+            return entry
+        with tempfile.TemporaryDirectory(dir=self.directory) as building:
+            source_file = Path(building) / "source.rasm"
+            source_file.write_text(source, encoding="utf-8")
+            # The listing printed by the translator is not part of the entry
+            with contextlib.redirect_stdout(io.StringIO()):
+                translator.main(str(source_file), str(Path(building) / "program.o"), None, optimize, dataflow, profile)
+            (Path(building) / "program.o").replace(entry)
+        size = entry.stat().st_size
+        self._count(misses=1, bytes_written=size, evictions=self._evict(keep=entry))
+        return entry
+
+    def _evict(self, keep: Path) -> int:
+        entries = self.entries()
+        total = sum(entry.stat().st_size for entry in entries)
+        evicted = 0
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            total -= entry.stat().st_size
+            entry.unlink(missing_ok=True)
+            evicted += 1
+        return evicted
+
+    def get(self, source: str, optimize: bool = False, dataflow: bool = False, profile: str | None = None) -> Assembly:
+        """Code and data images and label maps of the source text, optimized like translator.main does."""
+        program = read_object(str(self.entry(source, optimize, dataflow, profile)))
+        labels: dict[int, dict[str, int]] = {SECTION_TEXT: {}, SECTION_DATA: {}}
+        for symbol in program.symbols:
+            labels[symbol.section][symbol.name] = symbol.address
+        return Assembly(program.code, program.data, program.entry, labels[SECTION_TEXT], labels[SECTION_DATA])
+
+    def translate(
+        self,
+        source: str,
+        target_code: str,
+        target_data: str | None = None,
+        optimize: bool = False,
+        dataflow: bool = False,
+        profile: str | None = None,
+    ) -> None:
+        """Cached equivalent of translator.main, without the listing."""
+        with open(source, encoding="utf-8") as file:
+            text = file.read()
+        if target_data is None:
+            shutil.copyfile(self.entry(text, optimize, dataflow, profile), target_code)
+            return
+        program = self.get(text, optimize, dataflow, profile)
+        _write_text(target_code, program.code)
+        _write_text(target_data, program.data)
+
+    def clear(self) -> None:
+        """Remove all the entries and reset the counters."""
+        for entry in self.directory.glob(f"*{ENTRY_SUFFIX}"):
+            entry.unlink(missing_ok=True)
+        (self.directory / STATS_FILE).unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache of translated programs")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("--cache", default=str(DEFAULT_CACHE_DIRECTORY), help="cache directory")
+    args = parser.parse_args()
+
+    cache = AssemblyCache(args.cache)
+    if args.command == "clear":
+        cache.clear()
+    else:
+        stats = cache.stats()
+        stats["entries"] = len(cache.entries())
+        stats["size"] = cache.size()
+        for field, value in stats.items():
+            print(f"{field:<14} {value}")
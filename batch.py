@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import signal
+import sys
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import cache
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import machine
+from machine_exceptions import MachineError, WallClockTimeoutError
+from object_file import ObjectFile
+from run_result import STOP_TICK_LIMIT
+
+
+class Job(NamedTuple):
+    """
+    One run of a compiled program, a line of the manifest.
+
+    Manifest lines are JSON objects with the keys "code" (object file or text code file),
+    "data" (text data file, omitted for object files), "input" (input file), "id",
+    "stream_input", "tick_limit" and "timeout"; relative paths are resolved against the
+    manifest directory.
+    """
+
+    job_id: str
+    code: str
+    data: str | None
+    input_file: str | None
+    stream_input: bool
+    tick_limit: int
+    timeout: float | None
+    engine: str
+
+
+def read_manifest(
+    manifest: str,
+    tick_limit: int,
+    timeout: float | None,
+    engine: str,
+) -> Iterator[Job]:
+    """
+    Read the jobs of a JSON lines manifest, the arguments are the defaults for the jobs which do not set them.
+    """
+    base = Path(manifest).resolve().parent
+
+    def resolve(path: str | None) -> str | None:
+        return None if path is None else str(base / path)
+
+    with open(manifest, encoding="utf-8") as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            yield Job(
+                str(entry.get("id", number)),
+                resolve(entry["code"]),
+                resolve(entry.get("data")),
+                resolve(entry.get("input")),
+                entry.get("stream_input", False),
+                entry.get("tick_limit", tick_limit),
+                entry.get("timeout", timeout),
+                entry.get("engine", engine),
+            )
+
+
+@cache
+def load_program(code: str, data: str | None) -> ObjectFile:
+    """Load a program once per worker process, all its jobs share it."""
+    return machine.load_program(code, data)
+
+
+def _init_worker() -> None:
+    # Stop reasons are in the results, the per-word and per-run log lines would only cost time
+    logging.disable(logging.CRITICAL)
+
+
+def _start_timer(stack: ExitStack, seconds: float) -> None:
+    def raise_timeout(signum: int, frame: Any) -> None:
+        raise WallClockTimeoutError(seconds)
+
+    previous = signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    stack.callback(signal.signal, signal.SIGALRM, previous)
+    stack.callback(signal.setitimer, signal.ITIMER_REAL, 0)
+
+
+def run_job(job: Job) -> dict[str, Any]:
+    """
+    Run a single job in a worker.
+
+    The wall-clock timeout is an interval timer, so the simulation loops pay nothing for it
+    (it is not available on platforms without signal.setitimer). The timer runs until the
+    stack is closed, so a timeout while the input and output files are closed is caught too.
+
+    Returns:
+        dict[str, Any]: The JSON result line: id, output, ticks, instructions, mc, stop_reason and seconds.
+    """
+    started = time.perf_counter()
+    result: dict[str, Any] = {"id": job.job_id}
+    try:
+        with ExitStack() as stack:
+            if job.timeout is not None and hasattr(signal, "setitimer"):
+                _start_timer(stack, job.timeout)
+            program = load_program(job.code, job.data)
+            io_controller = machine.create_io_controller(stack, job.input_file, job.stream_input, log_io=False)
+            run = machine.run_simulation(
+                program.code,
+                program.data,
+                None,
+                engine=job.engine,
+                entry=program.entry,
+                io_controller=io_controller,
+                tick_limit=job.tick_limit,
+            )
+    except (OSError, ValueError, MachineError) as e:
+        result.update(stop_reason=str(e), seconds=time.perf_counter() - started)
+        return result
+    result.update(
+        output=run.output,
+        ticks=run.ticks,
+        instructions=run.instructions,
+        mc=run.microinstructions,
+        stop_reason=STOP_TICK_LIMIT if run.stop == STOP_TICK_LIMIT else run.stop_reason,
+        seconds=time.perf_counter() - started,
+    )
+    return result
+
+
+def run_batch(jobs: list[Job], workers: int | None = None, chunk_size: int = 16) -> Iterator[dict[str, Any]]:
+    """
+    Run the jobs on a process pool and yield the results in the order of the jobs.
+
+    Jobs are handed out in chunks, so consecutive jobs of the same program mostly land in one
+    worker and reuse the loaded program.
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        yield from executor.map(run_job, jobs, chunksize=chunk_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many (program, input) jobs of the RISC CPU model")
+    parser.add_argument("manifest", help="JSON lines file with a job per line")
+    parser.add_argument("-o", "--output", help="JSON lines results file, stdout by default")
+    parser.add_argument("-j", "--workers", type=int, help="number of worker processes, CPU count by default")
+    parser.add_argument("--chunk-size", type=int, default=16, help="number of jobs sent to a worker at once")
+    parser.add_argument("--engine", choices=machine.ENGINES, default=machine.ENGINE_BLOCK)
+    parser.add_argument("--tick-limit", type=int, default=machine.TICK_LIMIT, help="default tick limit of a job")
+    parser.add_argument("--timeout", type=float, help="default wall-clock time limit of a job in seconds")
+    args = parser.parse_args()
+
+    jobs = list(read_manifest(args.manifest, args.tick_limit, args.timeout, args.engine))
+    with ExitStack() as stack:
+        output = sys.stdout if args.output is None else stack.enter_context(open(args.output, "w", encoding="utf-8"))
+        for result in run_batch(jobs, args.workers, args.chunk_size):
+            output.write(json.dumps(result) + "\n")
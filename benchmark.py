@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import machine
+import translator
+from run_result import RunResult
+
+EXAMPLES_DIRECTORY = Path(__file__).parent / "examples"
+INPUT_DIRECTORY = Path(__file__).parent / "input"
+# Benchmark runs stop at HALT, the limit only guards against programs that never halt
+BENCHMARK_TICK_LIMIT = 100_000_000
+DEFAULT_THRESHOLD = 0.1
+
+PHASE_TRANSLATE = "translate"
+PHASE_LOAD = "load"
+PHASE_EXECUTE = "execute"
+
+LOOP_SOURCE = """
+.data
+limit: #{count}
+
+.text
+    add r6, r0, limit
+    lw r4, r6
+    add r1, r0, #0
+    add r5, r0, #0
+loop:
+    bgt r1, r4, exit
+    add r5, r5, r1
+    add r1, r1, #1
+    jmp loop
+exit:
+    add r10, r0, out
+    sw r5, r10
+    halt
+"""
+
+MEMORY_SOURCE = """
+.data
+count: #{count}
+
+.text
+    add r6, r0, count
+    lw r4, r6
+    add r7, r0, #100 // first cell of the array
+    add r1, r0, #0
+fill:
+    bgt r1, r4, sum
+    add r8, r7, r1
+    sw r1, r8
+    add r1, r1, #1
+    jmp fill
+sum:
+    add r1, r0, #0
+    add r5, r0, #0
+read:
+    bgt r1, r4, exit
+    add r8, r7, r1
+    lw r9, r8
+    add r5, r5, r9
+    add r1, r1, #1
+    jmp read
+exit:
+    add r10, r0, out
+    sw r5, r10
+    halt
+"""
+
+
+class Workload(NamedTuple):
+    name: str
+    source: str  # Assembly source text
+    input_str: str
+
+
+def example_workloads() -> list[Workload]:
+    """The programs of examples/, with the first line of input/<name>.txt as their input."""
+    workloads = []
+    for source in sorted(EXAMPLES_DIRECTORY.glob("*.rasm")):
+        input_file = INPUT_DIRECTORY / f"{source.stem}.txt"
+        input_str = input_file.read_text(encoding="utf-8").split("\n")[0] if input_file.exists() else ""
+        workloads.append(Workload(source.stem, source.read_text(encoding="utf-8"), input_str))
+    return workloads
+
+
+def synthetic_workloads(scale: float = 1.0) -> list[Workload]:
+    """
+    Larger generated programs: a counting loop, an array filled and summed across many memory
+    pages, a long straight-line program (translation and loading) and cat over a long input.
+    """
+    straight = ".text\n" + "    add r1, r1, #1\n" * int(20_000 * scale) + "    halt\n"
+    cat = (EXAMPLES_DIRECTORY / "cat.rasm").read_text(encoding="utf-8")
+    return [
+        Workload("loop", LOOP_SOURCE.format(count=int(50_000 * scale)), ""),
+        Workload("memory", MEMORY_SOURCE.format(count=int(20_000 * scale)), ""),
+        Workload("straight", straight, ""),
+        Workload("cat_long", cat, "benchmark " * int(2_000 * scale)),
+    ]
+
+
+def best_time(function: Callable[[], Any], repeat: int) -> tuple[float, Any]:
+    """Best wall time of `repeat` calls and the result of the last one."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def peak_memory(function: Callable[[], Any]) -> int:
+    """Peak memory allocated by a call in KiB (measured separately, tracemalloc slows the call down)."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def run_workload(workload: Workload, directory: str, engine: str, repeat: int) -> dict[str, dict[str, Any]]:
+    """
+    Benchmark the translation, loading and execution of a workload separately.
+
+    Returns:
+        dict[str, dict[str, Any]]: Metrics by phase.
+    """
+    source = os.path.join(directory, f"{workload.name}.rasm")
+    target = os.path.join(directory, f"{workload.name}.o")
+    Path(source).write_text(workload.source, encoding="utf-8")
+
+    def translate() -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            translator.main(source, target)
+
+    def load() -> Any:
+        return machine.load_program(target, None)
+
+    translate()
+    program = load()
+
+    def execute() -> RunResult:
+        return machine.run_simulation(
+            program.code,
+            program.data,
+            workload.input_str,
+            engine=engine,
+            entry=program.entry,
+            tick_limit=BENCHMARK_TICK_LIMIT,
+        )
+
+    results = {}
+    for phase, function in ((PHASE_TRANSLATE, translate), (PHASE_LOAD, load)):
+        seconds, _ = best_time(function, repeat)
+        results[phase] = {"seconds": seconds, "peak_kib": peak_memory(function)}
+    seconds, result = best_time(execute, repeat)
+    results[PHASE_EXECUTE] = {
+        "seconds": seconds,
+        "peak_kib": peak_memory(execute),
+        "ticks": result.ticks,
+        "instructions": result.instructions,
+        "ticks_per_second": result.ticks / seconds,
+        "instructions_per_second": result.instructions / seconds,
+        "stop_reason": result.stop_reason,
+    }
+    return results
+
+
+def run_benchmarks(workloads: list[Workload], engine: str, repeat: int) -> dict[str, Any]:
+    """Run all the workloads, the per-word io and per-run logs are disabled meanwhile."""
+    benchmarks = {}
+    logging.disable(logging.CRITICAL)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for workload in workloads:
+                for phase, metrics in run_workload(workload, directory, engine, repeat).items():
+                    benchmarks[f"{workload.name}/{phase}"] = metrics
+    finally:
+        logging.disable(logging.NOTSET)
+    return {"python": platform.python_version(), "engine": engine, "benchmarks": benchmarks}
+
+
+def throughput(metrics: dict[str, Any]) -> float:
+    """Simulated ticks per second for executions, runs per second for translation and loading."""
+    if "ticks_per_second" in metrics:
+        return metrics["ticks_per_second"]
+    return 1 / metrics["seconds"] if metrics["seconds"] else float("inf")
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any]) -> list[tuple[str, float]]:
+    """
+    Compare the throughput of every benchmark present in both runs.
+
+    Returns:
+        list[tuple[str, float]]: The benchmark names and their throughput relative to the baseline.
+
+    >>> compare({"benchmarks": {"a": {"seconds": 2.0}, "b": {"seconds": 1.0}}}, {"benchmarks": {"a": {"seconds": 1.0}}})
+    [('a', 0.5)]
+    """
+    return [
+        (name, throughput(metrics) / throughput(baseline["benchmarks"][name]))
+        for name, metrics in results["benchmarks"].items()
+        if name in baseline["benchmarks"]
+    ]
+
+
+def print_results(results: dict[str, Any]) -> None:
+    print(f"{'benchmark':<25} {'seconds':>10} {'peak KiB':>9} {'ticks/s':>12} {'instr/s':>12}")
+    for name, metrics in results["benchmarks"].items():
+        ticks = f"{metrics['ticks_per_second']:>12.0f}" if "ticks_per_second" in metrics else f"{'':>12}"
+        instructions = f"{metrics['instructions_per_second']:>12.0f}" if "instructions_per_second" in metrics else ""
+        print(f"{name:<25} {metrics['seconds']:>10.4f} {metrics['peak_kib']:>9} {ticks} {instructions}")
+
+
+def print_ratios(ratios: list[tuple[str, float]]) -> None:
+    for name, ratio in ratios:
+        print(f"{name:<25} {ratio:>6.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the translator and the RISC CPU model")
+    parser.add_argument("-o", "--output", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="BASELINE", help="fail if a benchmark got slower than this baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="allowed throughput drop against the baseline, 0.1 is 10%%",
+    )
+    parser.add_argument("--engine", choices=machine.ENGINES, default=machine.ENGINE_MICROCODE)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best time counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="size factor of the synthetic workloads")
+    parser.add_argument("--filter", default="", help="only run the workloads whose name contains this")
+    args = parser.parse_args()
+
+    workloads = [
+        workload for workload in example_workloads() + synthetic_workloads(args.scale) if args.filter in workload.name
+    ]
+    results = run_benchmarks(workloads, args.engine, args.repeat)
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as file:
+            ratios = compare(results, json.load(file))
+        print_ratios(ratios)
+        regressions = [name for name, ratio in ratios if ratio < 1 - args.threshold]
+        if regressions:
+            print(f"Throughput regressions: {', '.join(regressions)}")
+            sys.exit(1)
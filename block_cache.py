@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Callable
+
+from alu import MAX_NUMBER, MIN_NUMBER
+from control_unit import ControlUnit
+from instruction_engine import InstructionEngine, MicroprogramCost
+from isa import Opcode
+from memory import DecodedInstruction
+from microcode import Signal
+
+MAX_BLOCK_LENGTH = 64
+DEFAULT_CACHE_SIZE = 256
+
+ALU_OPERATORS = {
+    Opcode.ADD.code: "+",
+    Opcode.SUB.code: "-",
+    Opcode.MUL.code: "*",
+    Opcode.AND.code: "&",
+}
+BLOCK_TERMINATORS = {Opcode.BEQ.code, Opcode.BNE.code, Opcode.BGT.code, Opcode.BLT.code, Opcode.JUMP.code}
+
+
+class Block:
+    """
+    Straight-line run of instructions translated into one Python function.
+
+    The function returns (position, stage, error): on success (-1, 0, None), otherwise the
+    index of the failed instruction, the rows of it which were finished and the exception.
+    """
+
+    def __init__(
+        self,
+        pc: int,
+        instructions: list[DecodedInstruction],
+        function: Callable,
+        costs: list[tuple[int, int]],
+        max_ticks: int,
+    ):
+        self.pc = pc
+        self.instructions = instructions
+        self.function = function
+        self.costs = costs  # Ticks and mc spent before each instruction of the block
+        self.max_ticks = max_ticks
+
+
+class BlockCache:
+    """LRU cache of translated blocks keyed by the PC the block starts at."""
+
+    def __init__(self, capacity: int = DEFAULT_CACHE_SIZE):
+        self.capacity = capacity
+        self.blocks: OrderedDict[int, Block | None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, pc: int, translate: Callable[[int], Block | None]) -> Block | None:
+        block = self.blocks.get(pc)
+        if block is not None or pc in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(pc)
+            return block
+        self.misses += 1
+        block = translate(pc)
+        self.blocks[pc] = block
+        if len(self.blocks) > self.capacity:
+            self.blocks.popitem(last=False)
+            self.evictions += 1
+        return block
+
+    def stats(self) -> str:
+        return f"hits={self.hits}, misses={self.misses}, evictions={self.evictions}, size={len(self.blocks)}"
+
+
+class BlockEngine(InstructionEngine):
+    """
+    InstructionEngine which executes whole basic blocks at once.
+
+    A block starts at the PC of a fetch and ends with a branch, jmp or halt (or before an
+    instruction which cannot be fetched, which is left to the instruction by instruction
+    path to fail exactly like the microcoded ControlUnit). Instruction memory is read-only,
+    so translated blocks never have to be invalidated.
+    """
+
+    def __init__(self, control_unit: ControlUnit, cache_size: int = DEFAULT_CACHE_SIZE):
+        super().__init__(control_unit)
+        self.cache = BlockCache(cache_size)
+
+    def run(self, tick_limit: int) -> str | None:
+        control_unit = self.control_unit
+        last_start = tick_limit - self.max_instruction_ticks
+        while control_unit.tick_counter <= last_start:
+            block = self.cache.get(self.datapath.pc, self.translate)
+            if block is None or control_unit.tick_counter + block.max_ticks > tick_limit:
+                halted = self.step()
+            else:
+                halted = self.execute(block)
+            if halted:
+                return "HALT"
+        return None
+
+    def execute(self, block: Block) -> bool:
+        """
+        Run a translated block and charge its ticks.
+
+        Returns:
+            bool: True if the block ended with HALT.
+        """
+        datapath = self.datapath
+        register_file = datapath.register_file
+        position, stage, error = block.function(register_file.registers, register_file, datapath.data_memory, self.alu)
+        if error is not None:
+            instruction = block.instructions[position]
+            self._latch(instruction)
+            datapath.pc = block.pc + position + 1
+            self._commit(block, position)
+            self._charge(self.costs[instruction.decode_line][0], stage)
+            raise error
+
+        last = len(block.instructions) - 1
+        instruction = block.instructions[last]
+        self._latch(instruction)
+        cost = self.costs[instruction.decode_line][self.alu.neg_zero]
+        datapath.pc = instruction.r2 if cost.jumps else block.pc + last + 1
+        self._commit(block, last)
+        self._charge(cost, cost.ticks)
+        return cost.halts
+
+    def _commit(self, block: Block, position: int) -> None:
+        """Charge the instructions before the given one and the fetch of it."""
+        control_unit = self.control_unit
+        ticks, mc = block.costs[position]
+        control_unit.tick_counter += ticks + self.fetch.ticks
+        control_unit.mc_counter += mc + self.fetch.mc[-1]
+        control_unit.instructions_counter += position + 1
+        control_unit.fetched.update(range(block.pc, block.pc + position + 1))
+
+    def _latch(self, instruction: DecodedInstruction) -> None:
+        control_unit = self.control_unit
+        control_unit.decode_line = control_unit.ir = instruction.decode_line
+        control_unit.operands = instruction.operands
+        control_unit.instruction = instruction
+        self.datapath.cu_data_out = self.datapath.cu_address_out = instruction.r2
+
+    def translate(self, pc: int) -> Block | None:
+        """
+        Find the basic block starting at the given PC and translate it.
+
+        Returns:
+            Block | None: The translated block, None if the first instruction can not be fetched.
+        """
+        instructions = self._find_block(pc)
+        if not instructions:
+            return None
+
+        lines = [
+            f"def block_{pc}(R, rf, mem, alu):",
+            "    position = stage = 0",
+            "    try:",
+        ]
+        costs = []
+        ticks = mc = max_ticks = 0
+        for position, instruction in enumerate(instructions):
+            costs.append((ticks, mc))
+            cost = self.costs[instruction.decode_line][0]
+            lines.append(f"        position = {position}")
+            lines += ["        " + line for line in self._translate_instruction(instruction, cost)]
+            ticks += self.fetch.ticks + cost.ticks
+            mc += self.fetch.mc[-1] + cost.mc[-1]
+            max_ticks += self.fetch.ticks + max(path.ticks for path in self.costs[instruction.decode_line])
+            if instruction.opcode == Opcode.HALT.code:
+                # The HALT row is not charged, but it needs a tick within the limit like in the microcoded run
+                max_ticks += 1
+        lines += [
+            "    except Exception as error:",
+            "        return position, stage, error",
+            "    return -1, 0, None",
+        ]
+
+        namespace = {
+            "MAX_NUMBER": MAX_NUMBER,
+            "MIN_NUMBER": MIN_NUMBER,
+        }
+        exec(compile("\n".join(lines) + "\n", f"<block {pc}>", "exec"), namespace)
+        return Block(pc, instructions, namespace[f"block_{pc}"], costs, max_ticks)
+
+    def _find_block(self, pc: int) -> list[DecodedInstruction]:
+        instruction_memory = self.datapath.instruction_memory
+        instructions: list[DecodedInstruction] = []
+        while len(instructions) < MAX_BLOCK_LENGTH:
+            address = pc + len(instructions) + 1
+            if not 1 <= address <= len(instruction_memory.decoded):
+                break
+            instruction = instruction_memory.read_decoded(address)
+            if instruction.decode_line is None:
+                break
+            instructions.append(instruction)
+            if instruction.opcode in BLOCK_TERMINATORS or instruction.opcode == Opcode.HALT.code:
+                break
+        return instructions
+
+    def _translate_instruction(self, instruction: DecodedInstruction, cost: MicroprogramCost) -> list[str]:
+        opcode = instruction.opcode
+        if opcode in ALU_OPERATORS:
+            return self._translate_math(instruction, cost)
+        if opcode == Opcode.LOAD_WORD.code:
+            return [
+                f"stage = {cost.stages[Signal.LATCH_READ_MEM]}",
+                f"mem.memory_out = mem.read_cell(R[{instruction.r1}])",
+                f"stage = {cost.stages[Signal.LATCH_REG]}",
+                self._latch_register(instruction.rb, "mem.memory_out"),
+            ]
+        if opcode == Opcode.WRITE_WORD.code:
+            return [
+                f"stage = {cost.stages[Signal.LATCH_WRITE_MEM]}",
+                f"mem.write_cell(R[{instruction.r1}], R[{instruction.r2}])",
+            ]
+        if opcode in BLOCK_TERMINATORS and opcode != Opcode.JUMP.code:
+            return self._translate_alu(ALU_OPERATORS[Opcode.SUB.code], f"R[{instruction.rb}]", f"R[{instruction.r1}]")
+        return ["pass"]
+
+    def _translate_math(self, instruction: DecodedInstruction, cost: MicroprogramCost) -> list[str]:
+        lines = [f"stage = {cost.stages[Signal.LATCH_REG]}"]
+        if instruction.flag:
+            lines.append(f"R[15] = {instruction.r2}")
+            right = str(instruction.r2)
+        else:
+            right = f"R[{instruction.r2}]"
+        lines += self._translate_alu(ALU_OPERATORS[instruction.opcode], f"R[{instruction.r1}]", right)
+        lines.append(self._latch_register(instruction.rb, "result"))
+        return lines
+
+    def _translate_alu(self, operator: str, left: str, right: str) -> list[str]:
+        return [
+            f"result = {left} {operator} {right}",
+            "if result > MAX_NUMBER:",
+            "    result %= MAX_NUMBER",
+            "elif result < MIN_NUMBER:",
+            "    result %= -MIN_NUMBER",
+            "alu.alu_result = result",
+            "alu.neg_zero = 1 if result == 0 else 2 if result < 0 else 0",
+        ]
+
+    def _latch_register(self, index: int, value: str) -> str:
+        if index == 0:
+            return f"rf.latch_reg_n(0, {value})"
+        return f"R[{index}] = {value}"
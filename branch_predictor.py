@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Any, TextIO
+
+from control_unit import ControlUnit
+from isa import Opcode
+from machine_exceptions import UnknownPredictorError
+from memory import DecodedInstruction
+from tracer import Tracer
+
+PREDICTOR_NOT_TAKEN = "not-taken"
+PREDICTOR_BACKWARD_TAKEN = "backward-taken"
+PREDICTOR_TWO_BIT = "2bit"
+PREDICTOR_GSHARE = "gshare"
+
+CONDITIONAL_BRANCHES = {
+    Opcode.BEQ.code: Opcode.BEQ.mnemonic,
+    Opcode.BNE.code: Opcode.BNE.mnemonic,
+    Opcode.BGT.code: Opcode.BGT.mnemonic,
+    Opcode.BLT.code: Opcode.BLT.mnemonic,
+}
+# Ticks a pipeline fetching along the prediction loses on a misprediction (IF and ID of pipeline.py)
+DEFAULT_PENALTY = 2
+
+
+class Predictor(ABC):
+    """Base class of the branch predictors: a direction for a conditional branch, then its outcome."""
+
+    name = ""
+
+    @abstractmethod
+    def predict(self, address: int, target: int) -> bool:
+        """Whether the branch at the address is predicted taken."""
+
+    def update(self, address: int, taken: bool) -> None:
+        pass
+
+
+class NotTakenPredictor(Predictor):
+    """Static: the fetch always continues with the next instruction."""
+
+    name = PREDICTOR_NOT_TAKEN
+
+    def predict(self, address: int, target: int) -> bool:
+        return False
+
+
+class BackwardTakenPredictor(Predictor):
+    """Static: backward branches (loops) are taken, forward ones are not."""
+
+    name = PREDICTOR_BACKWARD_TAKEN
+
+    def predict(self, address: int, target: int) -> bool:
+        return target <= address
+
+
+class TwoBitPredictor(Predictor):
+    """
+    A table of 2-bit saturating counters indexed by the branch address, taken from 2 up.
+
+    >>> predictor = TwoBitPredictor(entries=4)
+    >>> for taken in (True, True, False, True):
+    ...     predictor.update(8, taken)
+    >>> predictor.predict(8, 0), predictor.predict(9, 0)
+    (True, False)
+    """
+
+    name = PREDICTOR_TWO_BIT
+
+    def __init__(self, entries: int = 256):
+        self.counters = [1] * entries  # Weakly not taken
+
+    def _index(self, address: int) -> int:
+        return address % len(self.counters)
+
+    def predict(self, address: int, target: int) -> bool:
+        return self.counters[self._index(address)] >= 2
+
+    def update(self, address: int, taken: bool) -> None:
+        index = self._index(address)
+        counter = self.counters[index]
+        self.counters[index] = min(counter + 1, 3) if taken else max(counter - 1, 0)
+
+
+class GsharePredictor(TwoBitPredictor):
+    """2-bit counters indexed by the branch address XOR the outcomes of the last conditional branches."""
+
+    name = PREDICTOR_GSHARE
+
+    def __init__(self, history_bits: int = 8):
+        super().__init__(1 << history_bits)
+        self.mask = (1 << history_bits) - 1
+        self.history = 0
+
+    def _index(self, address: int) -> int:
+        return (address ^ self.history) & self.mask
+
+    def update(self, address: int, taken: bool) -> None:
+        super().update(address, taken)
+        self.history = ((self.history << 1) | taken) & self.mask
+
+
+PREDICTORS: dict[str, type[Predictor]] = {
+    predictor.name: predictor
+    for predictor in (NotTakenPredictor, BackwardTakenPredictor, TwoBitPredictor, GsharePredictor)
+}
+
+
+def create_predictors(names: str) -> list[Predictor]:
+    """
+    Create the predictors of a comma separated list of names.
+
+    >>> [predictor.name for predictor in create_predictors("2bit,gshare")]
+    ['2bit', 'gshare']
+
+    Raises:
+        UnknownPredictorError: If a name is not in PREDICTORS.
+    """
+    predictors = []
+    for name in filter(None, names.split(",")):
+        if name not in PREDICTORS:
+            raise UnknownPredictorError(name)
+        predictors.append(PREDICTORS[name]())
+    return predictors
+
+
+class BranchMonitor(Tracer):
+    """
+    Branch predictors run side by side on the branches of the microcoded ControlUnit.
+
+    Like the Profiler, the monitor receives the state after every tick and passes it on to the
+    wrapped tracer. When a beq/bne/bgt/blt/jmp finishes, the next PC tells its direction: every
+    predictor is asked first and learns the outcome after. A jmp is predicted taken by all of
+    them (it is known to be taken once decoded), the predictors only see conditional branches.
+
+    The microcode spends the same ticks on a branch whatever its direction; the cost of a
+    branch on a machine fetching along the prediction is its mispredictions times the penalty.
+    """
+
+    def __init__(
+        self,
+        predictors: list[Predictor],
+        penalty: int = DEFAULT_PENALTY,
+        source: dict[int, str] | None = None,
+    ):
+        super().__init__()
+        self.predictors = predictors
+        self.penalty = penalty
+        self.source = {} if source is None else source
+        self.tracer: Tracer | None = None
+        self.decoded: list[DecodedInstruction] = []
+        self.pc = 0
+        self.mpc = 0
+        self.address = 0
+        self.executions: Counter[int] = Counter()
+        self.taken: Counter[int] = Counter()
+        # Mispredictions per predictor name and branch address
+        self.mispredicted: dict[str, Counter[int]] = {predictor.name: Counter() for predictor in predictors}
+
+    def attach(self, control_unit: ControlUnit, tracer: Tracer | None = None) -> BranchMonitor:
+        """
+        Start watching the branches from the current state of the control unit.
+
+        Returns:
+            BranchMonitor: The monitor itself, to be used as the tracer of the run.
+        """
+        self.tracer = tracer
+        self.decoded = control_unit.datapath.instruction_memory.decoded
+        self.pc = control_unit.datapath.pc
+        self.mpc = control_unit.mpc
+        # An instruction resumed in the middle was fetched already, PC points to the next one
+        self.address = self.pc if self.mpc == 0 else self.pc - 1
+        return self
+
+    def record(self, ir: int, mpc: int, pc: int, registers: list[int], neg_zero: int, ticks: int, mc: int) -> None:
+        if self.mpc == 0:
+            self.address = self.pc
+        if mpc == 0 and self.address < len(self.decoded):
+            self.resolve(self.address, self.decoded[self.address], pc != self.address + 1)
+        self.pc = pc
+        self.mpc = mpc
+        if self.tracer is not None:
+            self.tracer.record(ir, mpc, pc, registers, neg_zero, ticks, mc)
+
+    def resolve(self, address: int, instruction: DecodedInstruction, taken: bool) -> None:
+        """Score the predictions for a finished instruction, anything but a branch is left out."""
+        if instruction.opcode == Opcode.JUMP.code:
+            self.executions[address] += 1
+            self.taken[address] += 1
+            return
+        if instruction.opcode not in CONDITIONAL_BRANCHES:
+            return
+        self.executions[address] += 1
+        self.taken[address] += taken
+        for predictor in self.predictors:
+            if predictor.predict(address, instruction.r2) != taken:
+                self.mispredicted[predictor.name][address] += 1
+            predictor.update(address, taken)
+
+    def _summary(self, executions: int, mispredicted: int) -> dict[str, Any]:
+        return {
+            "mispredicted": mispredicted,
+            "accuracy": 1 - mispredicted / executions if executions else 1.0,
+            "penalty_ticks": mispredicted * self.penalty,
+        }
+
+    def report(self) -> dict[str, Any]:
+        """Accuracy and penalty ticks per predictor and per branch, the costliest branches first."""
+        executions = sum(self.executions.values())
+        branches = []
+        for address, count in self.executions.items():
+            opcode = self.decoded[address].opcode
+            predictions = {
+                name: self._summary(count, mispredicted[address]) for name, mispredicted in self.mispredicted.items()
+            }
+            branches.append(
+                {
+                    "address": address,
+                    "opcode": CONDITIONAL_BRANCHES.get(opcode, Opcode.JUMP.mnemonic),
+                    "target": self.decoded[address].r2,
+                    "executions": count,
+                    "taken": self.taken[address],
+                    "source": self.source.get(address, ""),
+                    "predictors": predictions,
+                }
+            )
+        branches.sort(key=lambda branch: max(p["penalty_ticks"] for p in branch["predictors"].values()), reverse=True)
+        return {
+            "penalty": self.penalty,
+            "executions": executions,
+            "predictors": {
+                name: self._summary(executions, mispredicted.total())
+                for name, mispredicted in self.mispredicted.items()
+            },
+            "branches": branches,
+        }
+
+    def write_table(self, file: TextIO) -> None:
+        """Write the accuracy and penalty ticks of every predictor, in total and per branch."""
+        report = self.report()
+        file.write(f"mispredict penalty: {report['penalty']} ticks, branches executed: {report['executions']}\n")
+        file.write(f"{'predictor':>15} {'mispredicted':>12} {'accuracy':>8} {'penalty':>8}\n")
+        for name, summary in report["predictors"].items():
+            file.write(
+                f"{name:>15} {summary['mispredicted']:>12} {summary['accuracy']:>8.2%} {summary['penalty_ticks']:>8}\n"
+            )
+        names = "".join(f" {name:>15}" for name in report["predictors"])
+        file.write(f"\n{'address':>7} {'branch':>6} {'target':>6} {'executions':>10} {'taken':>6}{names}  source\n")
+        for branch in report["branches"]:
+            accuracies = "".join(
+                f" {prediction['accuracy']:>8.2%} {prediction['penalty_ticks']:>6}"
+                for prediction in branch["predictors"].values()
+            )
+            file.write(
+                f"{branch['address']:>7} {branch['opcode']:>6} {branch['target']:>6} {branch['executions']:>10} "
+                f"{branch['taken']:>6}{accuracies}  {branch['source']}\n"
+            )
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import machine
+import pytest
+import translator
+from assembly_cache import translator_version
+from ruamel.yaml import YAML
+
+GOLDEN_FILES = "golden/*.yml"
+# Ways a golden case is run: (interpreted microcode, engine)
+GOLDEN_VARIANTS = {
+    "compiled": (False, machine.ENGINE_MICROCODE),
+    "interpreted": (True, machine.ENGINE_MICROCODE),
+    machine.ENGINE_INSTRUCTION: (False, machine.ENGINE_INSTRUCTION),
+    machine.ENGINE_BLOCK: (False, machine.ENGINE_BLOCK),
+}
+GOLDEN_TIMINGS = pytest.StashKey[dict[str, float]]()
+
+
+class GoldenRun(NamedTuple):
+    """Outputs of a golden case run in a worker."""
+
+    code: str  # Text code file
+    data: str  # Text data file
+    stdout: str  # Translator listing and machine output
+    log: str  # Log of the run, formatted like caplog.text
+    seconds: float
+
+
+def translate_cached(source: str, cache_directory: str) -> Path:
+    """
+    Translate a source into code.bin, data.bin and stdout.txt, reusing the result of a previous run.
+
+    Returns:
+        Path: Directory of the translation inside the cache.
+    """
+    key = hashlib.sha256((translator_version() + source).encode("utf-8")).hexdigest()
+    target = Path(cache_directory) / key
+    if target.exists():
+        return target
+    building = Path(tempfile.mkdtemp(dir=target.parent))
+    (building / "source.rasm").write_text(source, encoding="utf-8")
+    with contextlib.redirect_stdout(io.StringIO()) as stdout:
+        translator.main(str(building / "source.rasm"), str(building / "code.bin"), str(building / "data.bin"))
+    (building / "stdout.txt").write_text(stdout.getvalue(), encoding="utf-8")
+    try:
+        building.rename(target)
+    except OSError:
+        # Translated by another worker in the meantime
+        shutil.rmtree(building)
+    return target
+
+
+def run_golden_case(path: str, variant: str, log_format: str, cache_directory: str) -> GoldenRun:
+    """Translate (or take from the cache) and run one golden case in an isolated directory, capturing the log."""
+    started = time.perf_counter()
+    with open(path, encoding="utf-8") as file:
+        inputs = YAML(typ="safe", pure=True).load(file)
+    translation = translate_cached(inputs["in_source"], cache_directory)
+    interpreted, engine = GOLDEN_VARIANTS[variant]
+
+    log = io.StringIO()
+    handler = logging.StreamHandler(log)
+    handler.setFormatter(logging.Formatter(log_format))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+    try:
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()) as stdout:
+            input_stream = os.path.join(directory, "input.txt")
+            with open(input_stream, mode="w", encoding="utf-8") as file:
+                file.write(inputs["in_stdin"])
+            code = str(translation / "code.bin")
+            data = str(translation / "data.bin")
+            machine.main(code, data, input_stream, interpreted=interpreted, engine=engine)
+    finally:
+        root.removeHandler(handler)
+    return GoldenRun(
+        (translation / "code.bin").read_text(encoding="utf-8").replace("\r", ""),
+        (translation / "data.bin").read_text(encoding="utf-8").replace("\r", ""),
+        (translation / "stdout.txt").read_text(encoding="utf-8") + stdout.getvalue(),
+        log.getvalue(),
+        time.perf_counter() - started,
+    )
+
+
+def _init_worker() -> None:
+    # Forked workers inherit the pytest log handlers, the cases capture their logs themselves
+    logging.getLogger().handlers.clear()
+
+
+class GoldenRuns:
+    """
+    Runs all the golden cases on a process pool as soon as the first of them is needed.
+
+    With a single worker the cases are run in the test process one at a time, when requested.
+    """
+
+    def __init__(self, config: pytest.Config, workers: int):
+        self.log_format = config.getini("log_format")
+        # Without the cache plugin (-p no:cacheprovider) translations are only shared within the session
+        cache = getattr(config, "cache", None)
+        self.cache_directory = tempfile.mkdtemp() if cache is None else str(cache.mkdir("golden-translations"))
+        self.timings = config.stash[GOLDEN_TIMINGS]
+        self.executor = None
+        self.futures: dict[tuple[str, str], Future[GoldenRun]] = {}
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+            for path in sorted(Path(config.rootpath).glob(GOLDEN_FILES)):
+                for variant in GOLDEN_VARIANTS:
+                    self._submit(str(path), variant)
+
+    def _submit(self, path: str, variant: str) -> Future[GoldenRun]:
+        if self.executor is None:
+            future: Future[GoldenRun] = Future()
+            future.set_result(run_golden_case(path, variant, self.log_format, self.cache_directory))
+        else:
+            future = self.executor.submit(run_golden_case, path, variant, self.log_format, self.cache_directory)
+        self.futures[(path, variant)] = future
+        return future
+
+    def get(self, path: os.PathLike, variant: str) -> GoldenRun:
+        key = (str(Path(path).resolve()), variant)
+        future = self.futures.get(key) or self._submit(*key)
+        run = future.result()
+        self.timings[f"{Path(path).name} [{variant}]"] = run.seconds
+        return run
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--golden-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="processes running the golden cases, 1 runs them in the test process",
+    )
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    config.stash[GOLDEN_TIMINGS] = {}
+
+
+@pytest.fixture(scope="session")
+def golden_runs(pytestconfig: pytest.Config):
+    runs = GoldenRuns(pytestconfig, pytestconfig.getoption("golden_workers"))
+    yield runs
+    runs.close()
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus: int, config: pytest.Config) -> None:
+    timings = config.stash.get(GOLDEN_TIMINGS, {})
+    if not timings:
+        return
+    terminalreporter.write_sep("-", "golden case timings (translation and run)")
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        terminalreporter.write_line(f"{seconds:8.3f}s  {name}")
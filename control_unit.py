@@ -1,8 +1,17 @@
+from __future__ import annotations
+
+from collections import Counter
+from typing import TYPE_CHECKING
+
 from alu import Alu
 from datapath import DataPath
-from isa import Opcode
-from machine_exceptions import InvalidOperandIndexError, MachineRuntimeError
+from machine_exceptions import InvalidOpcodeError, InvalidOperandIndexError, MachineRuntimeError
+from memory import DecodedInstruction, decode_instruction
 from microcode import MicroProgramMemory, Signal
+from microcode_compiler import BRANCH_DECODE_LINES, compile_microprogram_memory
+
+if TYPE_CHECKING:
+    from microcode_compaction import MicrocodeTable
 
 
 class ControlUnit:
@@ -17,6 +26,7 @@ class ControlUnit:
 
     ir: int  # Instruction register
     operands: int  # Operands (24 bit register)
+    instruction: DecodedInstruction  # Fields of the latched operands
 
     mpc_mux: Signal
     mpc: int  # MP counter
@@ -24,65 +34,75 @@ class ControlUnit:
     inc_value: int
 
     tick_counter: int
+    instructions_counter: int
+    mc_counter: int
+    fetched: Counter[int]  # Instructions fetched per address, counted by the engines of machine.run_simulation
 
-    def __init__(self, alu: Alu, datapath: DataPath):
+    def __init__(
+        self, alu: Alu, datapath: DataPath, interpreted: bool = False, microcode: MicrocodeTable | None = None
+    ):
         """
         Initialize the ControlUnit with an ALU and a DataPath.
 
         Args:
             alu (Alu): The ALU instance to be used by the ControlUnit.
             datapath (DataPath): The DataPath instance to be used by the ControlUnit.
+            interpreted (bool): Execute microprograms signal by signal instead of using
+                the compiled microprogram memory.
+            microcode (MicrocodeTable | None): Microprogram memory to run instead of MicroProgramMemory
+                (e.g. microcode_compaction.compact()), always interpreted.
         """
         self.ir = 0
         self.operands = 0
+        self.instruction = decode_instruction(0)
         self.mpc = 0
         self.alu = alu
         self.datapath = datapath
         self.tick_counter = 0
+        self.instructions_counter = 0
+        self.mc_counter = 0
+        self.fetched = Counter()
 
         self.inc_value = 1
 
-    def latch_operands(self, instruction: str) -> None:
+        self.microcode = microcode
+        # Rows an instruction fetch starts in and decode lines of the instructions comparing rb with r1
+        self.fetch_rows = frozenset({0}) if microcode is None else microcode.fetch_rows
+        self.compare_lines = BRANCH_DECODE_LINES if microcode is None else microcode.compare_lines
+
+        # Stalls of the memory accesses are added to the ticks of their row
+        self.data_cache = datapath.data_memory.cache
+
+        self.compiled_microprograms = None if interpreted or microcode is not None else compile_microprogram_memory()
+
+    def latch_operands(self, instruction: DecodedInstruction) -> None:
         """
         Latch the operands from the given instruction.
 
         Args:
-            instruction (str): The instruction string.
+            instruction (DecodedInstruction): The decoded instruction.
         """
-        self.operands = int(instruction[7:-1], 2)
-        self.datapath.cu_data_out = int(instruction[7 + 4 + 4 : -1], 2)
-        self.datapath.cu_address_out = int(instruction[7 + 4 + 4 : -1], 2)
+        self.operands = instruction.operands
+        self.instruction = instruction
+        self.datapath.cu_data_out = instruction.r2
+        self.datapath.cu_address_out = instruction.r2
 
-    def decode_instruction(self, instruction: str) -> None:
+    def decode_instruction(self, instruction: DecodedInstruction) -> None:
         """
         Decode the given instruction and set the decode_line attribute accordingly.
 
         Args:
-            instruction (str): The instruction string to be decoded.
-        """
+            instruction (DecodedInstruction): The instruction decoded by the instruction memory.
 
-        # Extract opcode and flag from the instruction
-        opcode = int(instruction[0:7], 2)
-        flag = int(instruction[-1], 2)
-
-        # Mapping of opcode and flag to decode lines
-        opcode_flag_map = {
-            Opcode.NOP.code: {0: 3, 1: 3},
-            Opcode.HALT.code: {0: 4, 1: 4},
-            Opcode.ADD.code: {0: 5, 1: 6},
-            Opcode.SUB.code: {0: 8, 1: 9},
-            Opcode.MUL.code: {0: 11, 1: 12},
-            Opcode.AND.code: {0: 14, 1: 15},
-            Opcode.LOAD_WORD.code: {0: 17, 1: 17},
-            Opcode.WRITE_WORD.code: {0: 19, 1: 19},
-            Opcode.BEQ.code: {0: 20, 1: 20},
-            Opcode.BNE.code: {0: 24, 1: 24},
-            Opcode.BGT.code: {0: 28, 1: 28},
-            Opcode.BLT.code: {0: 32, 1: 32},
-            Opcode.JUMP.code: {0: 36, 1: 36},
-        }
-
-        self.decode_line = opcode_flag_map[opcode][flag]
+        Raises:
+            InvalidOpcodeError: If the opcode has no microprogram.
+        """
+        decode_line = instruction.decode_line
+        if self.microcode is not None:
+            decode_line = self.microcode.decode_line(instruction.opcode, instruction.flag)
+        if decode_line is None:
+            raise InvalidOpcodeError(instruction.opcode)
+        self.decode_line = decode_line
 
     def tick(self):
         """
@@ -109,9 +129,9 @@ class ControlUnit:
         Get the current instruction from the instruction memory.
 
         Returns:
-            str: The current instruction string.
+            DecodedInstruction: The current instruction.
         """
-        return self.datapath.instruction_memory.read_cell(self.datapath.pc)
+        return self.datapath.instruction_memory.read_decoded(self.datapath.pc)
 
     def get_operand(self, index: int) -> int:
         """
@@ -127,27 +147,37 @@ class ControlUnit:
         Raises:
             MachineRuntimeError: If the index is invalid.
         """
-        bin_operands = format(self.operands, "024b")
         if index == 0:
-            return int(bin_operands[:4], 2)
+            return self.instruction.rb
         if index == 1:
-            return int(bin_operands[4:8], 2)
+            return self.instruction.r1
         if index == 2:
-            return int(bin_operands[8:], 2)
+            return self.instruction.r2
         raise InvalidOperandIndexError()
 
     def run_microprogram(self) -> int:
         """
         Run the microprogram for the current MPC (Micro Program Counter) value.
 
+        A row waiting for the data cache takes the stall ticks on top of its own.
+
         Returns:
             int: The number of mc executed.
         """
-        program = MicroProgramMemory.get_microprogram(self.mpc)
-        for signal in program:
-            self._execute_signal(signal)
-        self.tick()
-        return len(program)
+        if self.compiled_microprograms is not None:
+            executed = self.compiled_microprograms[self.mpc](self)
+        else:
+            if self.microcode is None:
+                program = MicroProgramMemory.get_microprogram(self.mpc)
+            else:
+                program = self.microcode.rows[self.mpc]
+            for signal in program:
+                self._execute_signal(signal)
+            self.tick()
+            executed = len(program)
+        if self.data_cache is not None:
+            self.tick_counter += self.data_cache.take_stall()
+        return executed
 
     def _execute_signal(self, signal):
         """
@@ -262,14 +292,14 @@ class ControlUnit:
         self.datapath.register_file.latch_reg_n(index, self.datapath.get_register_file_input())
 
     def sel_left_reg(self):
-        if 20 <= self.ir <= 32:
+        if self.ir in self.compare_lines:
             index = self.get_operand(0)
         else:
             index = self.get_operand(1)
         self.datapath.register_file.sel_left_reg(Signal(int(Signal.SEL_L_REG0) + index))
 
     def sel_right_reg(self):
-        if 20 <= self.ir <= 32:
+        if self.ir in self.compare_lines:
             index = self.get_operand(1)
         else:
             index = self.get_operand(2)
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import NamedTuple
+
+from machine_exceptions import CacheConfigError
+
+WRITE_BACK = "back"
+WRITE_THROUGH = "through"
+WRITE_POLICIES = (WRITE_BACK, WRITE_THROUGH)
+
+# Keys of the --data-cache option and the CacheConfig fields they set
+CONFIG_KEYS = {
+    "sets": "sets",
+    "ways": "ways",
+    "line": "line_size",
+    "write": "write_policy",
+    "hit": "hit_latency",
+    "miss": "miss_latency",
+}
+
+
+class CacheConfig(NamedTuple):
+    sets: int = 16
+    ways: int = 1  # Lines per set, 1 - direct-mapped
+    line_size: int = 4  # Cells per line
+    write_policy: str = WRITE_BACK
+    hit_latency: int = 1  # Ticks of a cached access, the uncached memory takes 1
+    miss_latency: int = 10  # Ticks to move a line between the cache and the memory
+
+
+def parse_cache_config(spec: str) -> CacheConfig:
+    """
+    Parse a cache description "sets=64,ways=2,line=8,write=through,hit=1,miss=20", omitted keys keep the defaults.
+
+    >>> parse_cache_config("ways=2,write=through")
+    CacheConfig(sets=16, ways=2, line_size=4, write_policy='through', hit_latency=1, miss_latency=10)
+
+    Raises:
+        CacheConfigError: If a key is unknown or a value is out of range.
+    """
+    fields: dict[str, int | str] = {}
+    for item in filter(None, spec.split(",")):
+        key, _, value = item.partition("=")
+        if key not in CONFIG_KEYS:
+            raise CacheConfigError(item)
+        if key == "write":
+            fields[CONFIG_KEYS[key]] = value
+        elif value.isdigit():
+            fields[CONFIG_KEYS[key]] = int(value)
+        else:
+            raise CacheConfigError(item)
+    config = CacheConfig(**fields)
+    if min(config.sets, config.ways, config.line_size, config.hit_latency) < 1:
+        raise CacheConfigError(spec)
+    if config.write_policy not in WRITE_POLICIES:
+        raise CacheConfigError(spec)
+    return config
+
+
+class DataCache:
+    """
+    Timing model of a data cache between the register file and DataMemory.
+
+    The cells stay in DataMemory and the cache only keeps the tags of its lines, so the values
+    (and the whole architectural state) are those of the uncached run, an access only costs
+    ticks. Address // line_size is the line, the line modulo sets picks its set, a set holds
+    `ways` lines and replaces the least recently used one.
+
+    An access takes hit_latency ticks, a miss miss_latency more to fill the line and another
+    miss_latency if the evicted line is dirty. With write-back a write allocates the line like
+    a read and marks it dirty; with write-through every write also goes to the memory
+    (miss_latency, there is no write buffer) and a missing line is not allocated.
+    The ticks above the single tick of the memory row are stalls: the microprogram waits.
+
+    >>> cache = DataCache(CacheConfig(sets=2, line_size=2))
+    >>> [cache.read(address) for address in (4, 5, 8, 4)]
+    [11, 1, 11, 11]
+    >>> cache.write(5), cache.read(8), cache.stats()
+    (1, 21, 'reads=5, writes=1, hits=2, misses=4, hit_rate=0.33, evictions=3, writebacks=1, stall_ticks=50')
+    """
+
+    def __init__(self, config: CacheConfig):
+        self.config = config
+        self.write_back = config.write_policy == WRITE_BACK
+        # Per set: tag of a cached line to its dirty bit, least recently used first
+        self.sets: list[OrderedDict[int, bool]] = [OrderedDict() for _ in range(config.sets)]
+        self.reads = 0
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self.stall_ticks = 0
+        self.stall = 0  # Stall of the current tick, taken by the ControlUnit
+
+    def stats(self) -> str:
+        accesses = self.hits + self.misses
+        hit_rate = self.hits / accesses if accesses else 0
+        return (
+            f"reads={self.reads}, writes={self.writes}, hits={self.hits}, misses={self.misses}, "
+            f"hit_rate={hit_rate:.2f}, evictions={self.evictions}, writebacks={self.writebacks}, "
+            f"stall_ticks={self.stall_ticks}"
+        )
+
+    def take_stall(self) -> int:
+        stall, self.stall = self.stall, 0
+        return stall
+
+    def read(self, address: int) -> int:
+        """
+        Look up the line of a read address, filling it on a miss.
+
+        Returns:
+            int: The ticks of the access.
+        """
+        self.reads += 1
+        return self._charge(self._access(address, allocate=True, dirty=False))
+
+    def write(self, address: int) -> int:
+        """
+        Look up the line of a written address, see the write policy in the class docstring.
+
+        Returns:
+            int: The ticks of the access.
+        """
+        self.writes += 1
+        latency = self._access(address, allocate=self.write_back, dirty=self.write_back)
+        if not self.write_back:
+            latency += self.config.miss_latency
+        return self._charge(latency)
+
+    def _charge(self, latency: int) -> int:
+        self.stall += latency - 1
+        self.stall_ticks += latency - 1
+        return latency
+
+    def _access(self, address: int, allocate: bool, dirty: bool) -> int:
+        line = address // self.config.line_size
+        lines = self.sets[line % self.config.sets]
+        tag = line // self.config.sets
+        if tag in lines:
+            self.hits += 1
+            lines[tag] = lines[tag] or dirty
+            lines.move_to_end(tag)
+            return self.config.hit_latency
+        self.misses += 1
+        if not allocate:
+            return self.config.hit_latency
+        latency = self.config.hit_latency + self.config.miss_latency
+        if len(lines) == self.config.ways:
+            self.evictions += 1
+            if lines.popitem(last=False)[1]:
+                self.writebacks += 1
+                latency += self.config.miss_latency
+        lines[tag] = dirty
+        return latency
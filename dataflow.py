@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+from collections import Counter
+
+from isa import Opcode
+from peephole import BRANCHES, SCRATCH_REGISTER, Program, immediate_value, label_targets, register_token
+from translator_token import Token, TokenType
+
+REGISTER_COUNT = 15  # r1..r15 are writable, r0 is always 0
+ALL_REGISTERS = (1 << (REGISTER_COUNT + 1)) - 2
+
+CHANGE_REDUNDANT = "redundant load removed"
+CHANGE_COPY = "load replaced by copy"
+CHANGE_HOISTED = "invariant load hoisted"
+
+
+class Node:
+    """An instruction of the flow graph with the registers it reads and writes (bit n is rn)."""
+
+    def __init__(self, line: int, mnemonic: str, arguments: list[Token]):
+        self.line = line
+        self.mnemonic = mnemonic
+        self.arguments = arguments
+        self.defs = 0
+        self.uses = 0
+        self.successors: list[int] = []
+        self.predecessors: list[int] = []
+        self.exits = False  # Halts or leaves the program, all registers count as used afterwards
+        self.target: int | None = None  # Node a branch goes to
+
+
+def _registers(tokens: list[Token]) -> int:
+    mask = 0
+    for token in tokens:
+        if token.get_type() == TokenType.REGISTER:
+            mask |= 1 << token.get_int_value()
+    return mask & ALL_REGISTERS
+
+
+def constant_load(program: Program, node: Node) -> tuple[int, int] | None:
+    """
+    Register and value of "add rX, r0, <number or data label>" (rX != r0).
+    """
+    if node.mnemonic != Opcode.ADD.mnemonic or len(node.arguments) != 3:
+        return None
+    rb, r1, operand = node.arguments
+    if rb.get_type() != TokenType.REGISTER or r1.get_type() != TokenType.REGISTER or r1.get_int_value() != 0:
+        return None
+    value = immediate_value(program, operand)
+    if value is None or rb.get_int_value() == 0:
+        return None
+    return rb.get_int_value(), value
+
+
+def _copy(node: Node) -> tuple[int, int] | None:
+    """Destination and source of "add rX, rY, r0" or "add rX, r0, rY"."""
+    if node.mnemonic != Opcode.ADD.mnemonic or len(node.arguments) != 3:
+        return None
+    if any(token.get_type() != TokenType.REGISTER for token in node.arguments):
+        return None
+    rb, r1, r2 = (token.get_int_value() for token in node.arguments)
+    if r1 != 0 and r2 != 0:
+        return None
+    return rb, r1 or r2
+
+
+class FlowGraph:
+    """
+    Control-flow graph of the text section, one node per instruction.
+
+    Edges follow the fall-through order and the branch labels, a jmp or halt does not fall
+    through. Only a single contiguous text section is analysed, see build.
+    """
+
+    def __init__(self, program: Program, nodes: list[Node], first_line: int):
+        self.program = program
+        self.nodes = nodes
+        self.first_line = first_line  # Where code before the first instruction can be inserted
+
+    @staticmethod
+    def build(program: Program) -> FlowGraph | None:
+        """
+        Flow graph of the program, None if it can not be analysed: the program has several text
+        sections or malformed instructions.
+        """
+        lines = program.text_lines()
+        code = [position for position, line in enumerate(lines) if line >= 0 and program.instruction(line)]
+        if not code or -1 in lines[code[0] : code[-1]]:
+            return None
+        text = set(lines)
+        if any(program.instruction(line) for line in range(len(program.tokens)) if line not in text):
+            return None
+        first = next(position for position, line in enumerate(lines) if line >= 0)
+        targets = label_targets(program, lines)
+        node_of = {position: index for index, position in enumerate(code)}
+        nodes = [Node(lines[position], *program.instruction(lines[position])) for position in code]
+        for index, node in enumerate(nodes):
+            if not FlowGraph._connect(node, index, len(nodes), targets, node_of):
+                return None
+        for index, node in enumerate(nodes):
+            for successor in node.successors:
+                nodes[successor].predecessors.append(index)
+        return FlowGraph(program, nodes, lines[first])
+
+    @staticmethod
+    def _connect(node: Node, index: int, count: int, targets: dict[str, int], node_of: dict[int, int]) -> bool:
+        mnemonic = node.mnemonic
+        if mnemonic in BRANCHES:
+            if not node.arguments or node.arguments[-1].get_type() != TokenType.LABEL:
+                return False
+            node.target = node_of.get(targets.get(node.arguments[-1].get_string_value(), -1))
+            node.uses = _registers(node.arguments)
+        elif Opcode.get_opcode_by_mnemonic(mnemonic).is_mathlog() or mnemonic == Opcode.LOAD_WORD.mnemonic:
+            if not node.arguments or node.arguments[0].get_type() != TokenType.REGISTER:
+                return False
+            node.defs = _registers(node.arguments[:1])
+            node.uses = _registers(node.arguments[1:])
+        else:
+            node.uses = _registers(node.arguments)
+        falls_through = mnemonic not in {Opcode.JUMP.mnemonic, Opcode.HALT.mnemonic}
+        if falls_through and index + 1 < count:
+            node.successors.append(index + 1)
+        if node.target is not None:
+            node.successors.append(node.target)
+        node.exits = mnemonic == Opcode.HALT.mnemonic or (falls_through and index + 1 == count)
+        node.exits |= mnemonic in BRANCHES and node.target is None
+        return True
+
+    def liveness(self) -> list[int]:
+        """Registers live on entry of every node (backward analysis, everything is live after an exit)."""
+        live_in = [0] * len(self.nodes)
+        changed = True
+        while changed:
+            changed = False
+            for index in reversed(range(len(self.nodes))):
+                node = self.nodes[index]
+                live_out = ALL_REGISTERS if node.exits else 0
+                for successor in node.successors:
+                    live_out |= live_in[successor]
+                value = node.uses | (live_out & ~node.defs)
+                if value != live_in[index]:
+                    live_in[index] = value
+                    changed = True
+        return live_in
+
+    def _definitions(self) -> tuple[list[int], int]:
+        """Definitions killed by every node and the initial values of the registers, as bit sets."""
+        count = len(self.nodes)
+        registers = range(1, REGISTER_COUNT + 1)
+        defined_by = {register: 1 << (count + register) for register in registers}
+        for index, node in enumerate(self.nodes):
+            for register in registers:
+                if node.defs >> register & 1:
+                    defined_by[register] |= 1 << index
+        kills = [sum(defined_by[r] for r in registers if node.defs >> r & 1) for node in self.nodes]
+        return kills, sum(1 << (count + register) for register in registers)
+
+    def reaching_definitions(self) -> list[int]:
+        """
+        Definitions reaching the entry of every node (forward analysis). Bit n is the definition
+        made by node n, bit len(nodes) + r the initial value of register r.
+        """
+        kills, initial = self._definitions()
+        reach_in = [0] * len(self.nodes)
+        reach_out = [0] * len(self.nodes)
+        changed = True
+        while changed:
+            changed = False
+            for index, node in enumerate(self.nodes):
+                value = initial if index == 0 else 0
+                for predecessor in node.predecessors:
+                    value |= reach_out[predecessor]
+                reach_in[index] = value
+                out = (value & ~kills[index]) | (1 << index if node.defs else 0)
+                if out != reach_out[index]:
+                    reach_out[index] = out
+                    changed = True
+        return reach_in
+
+    def dominators(self) -> list[int]:
+        """Nodes dominating every node (bit n is node n), node 0 is the entry."""
+        count = len(self.nodes)
+        every = (1 << count) - 1
+        dominators = [1] + [every] * (count - 1)
+        changed = True
+        while changed:
+            changed = False
+            for index in range(1, count):
+                value = every
+                for predecessor in self.nodes[index].predecessors:
+                    value &= dominators[predecessor]
+                value = (value if self.nodes[index].predecessors else 0) | 1 << index
+                if value != dominators[index]:
+                    dominators[index] = value
+                    changed = True
+        return dominators
+
+    def loops(self, dominators: list[int]) -> dict[int, int]:
+        """Natural loops: the nodes of every loop (bit set) by loop header."""
+        loops: dict[int, int] = {}
+        for index, node in enumerate(self.nodes):
+            for header in node.successors:
+                if not dominators[index] >> header & 1:
+                    continue
+                body = 1 << header
+                stack = [index]
+                while stack:
+                    member = stack.pop()
+                    if body >> member & 1:
+                        continue
+                    body |= 1 << member
+                    stack.extend(self.nodes[member].predecessors)
+                loops[header] = loops.get(header, 0) | body
+        return loops
+
+    def constants(self) -> list[dict[int, int]]:
+        """
+        Registers holding a known value on entry of every node on all paths (registers start at 0).
+        R15 is left out, flag-1 math changes it.
+        """
+        count = len(self.nodes)
+        known_in: list[dict[int, int] | None] = [None] * count
+        known_out: list[dict[int, int] | None] = [None] * count
+        changed = True
+        while changed:
+            changed = False
+            for index in range(count):
+                incoming = [known_out[p] for p in self.nodes[index].predecessors]
+                if index == 0:
+                    incoming.append(dict.fromkeys(range(1, SCRATCH_REGISTER), 0))
+                reached = [state for state in incoming if state is not None]
+                if not reached:
+                    continue
+                state = {r: v for r, v in reached[0].items() if all(other.get(r) == v for other in reached[1:])}
+                known_in[index] = state
+                out = self._transfer(self.nodes[index], state)
+                if out != known_out[index]:
+                    known_out[index] = out
+                    changed = True
+        return [state or {} for state in known_in]
+
+    def _transfer(self, node: Node, state: dict[int, int]) -> dict[int, int]:
+        out = {r: v for r, v in state.items() if not node.defs >> r & 1}
+        load = constant_load(self.program, node)
+        copy = _copy(node)
+        if load is not None:
+            out[load[0]] = load[1]
+        elif copy is not None and (copy[1] == 0 or copy[1] in state):
+            out[copy[0]] = state.get(copy[1], 0)
+        return out
+
+
+def remove_redundant_loads(graph: FlowGraph) -> bool:
+    """
+    Remove constant loads of a value the register already holds, and load a value another
+    register holds with a copy (no immediate, one microprogram row less).
+    """
+    changed = False
+    for node, known in zip(graph.nodes, graph.constants()):
+        load = constant_load(graph.program, node)
+        if load is None:
+            continue
+        register, value = load
+        if known.get(register) == value:
+            graph.program.replace(node.line, None, CHANGE_REDUNDANT)
+            changed = True
+            continue
+        holder = next((r for r, v in sorted(known.items()) if v == value and r != register), None)
+        if holder is not None and value != 0:
+            arguments = [register_token(register), register_token(holder), register_token(0)]
+            graph.program.replace(node.line, arguments, CHANGE_COPY)
+            changed = True
+    return changed
+
+
+def _preheader(graph: FlowGraph, header: int, body: int) -> int | None:
+    """
+    Line before which code runs once before the loop: right after the instruction falling
+    through into the header (or at the start of the text), provided no branch from outside
+    the loop jumps to the header.
+    """
+    for predecessor in graph.nodes[header].predecessors:
+        outside = not body >> predecessor & 1
+        if outside and (predecessor != header - 1 or graph.nodes[predecessor].target == header):
+            return None
+    if header == 0:
+        return graph.first_line
+    if body >> (header - 1) & 1 or graph.nodes[header - 1].mnemonic in {Opcode.JUMP.mnemonic, Opcode.HALT.mnemonic}:
+        return None
+    return graph.nodes[header - 1].line + 1
+
+
+def _hoistable(graph: FlowGraph, index: int, body: int, facts: tuple[list[int], list[int], list[int]]) -> bool:
+    """
+    A constant load can leave the loop if it is the only definition of its register in the
+    loop, every use in the loop sees only this definition, and it dominates every loop exit
+    after which the register is live.
+    """
+    live_in, reach_in, dominators = facts
+    node = graph.nodes[index]
+    for member, other in enumerate(graph.nodes):
+        if body >> member & 1 and member != index and other.defs & node.defs:
+            return False
+    definitions = [d for d, other in enumerate(graph.nodes) if other.defs & node.defs]
+    register = node.defs.bit_length() - 1
+    all_definitions = sum(1 << d for d in definitions) | 1 << (len(graph.nodes) + register)
+    for member in range(len(graph.nodes)):
+        member_node = graph.nodes[member]
+        if body >> member & 1 and member_node.uses & node.defs and reach_in[member] & all_definitions != 1 << index:
+            return False
+        leaves = member_node.exits or any(not body >> s & 1 for s in member_node.successors)
+        live_after = member_node.exits or any(
+            live_in[s] & node.defs for s in member_node.successors if not body >> s & 1
+        )
+        if body >> member & 1 and leaves and live_after and not dominators[member] >> index & 1:
+            return False
+    return True
+
+
+def hoist_invariant_load(graph: FlowGraph) -> bool:
+    """Move one loop-invariant constant load in front of its loop."""
+    dominators = graph.dominators()
+    facts = (graph.liveness(), graph.reaching_definitions(), dominators)
+    for header, body in sorted(graph.loops(dominators).items()):
+        line = _preheader(graph, header, body)
+        if line is None:
+            continue
+        for index, node in enumerate(graph.nodes):
+            if body >> index & 1 and constant_load(graph.program, node) and _hoistable(graph, index, body, facts):
+                instruction = Token(TokenType.INSTRUCTION, node.mnemonic)
+                graph.program.replace(node.line, None, CHANGE_HOISTED)
+                graph.program.insert(line, [instruction, *node.arguments])
+                return True
+    return False
+
+
+def optimize(
+    code: list[str], tokenized: list[list[Token]], data_labels: dict[str, int]
+) -> tuple[list[str], list[list[Token]], Counter[str]]:
+    """
+    Redundant load elimination and loop-invariant code motion of constant loads, repeated until nothing changes.
+
+    Args and returns are those of peephole.optimize. Programs which use R15 or have several text
+    sections are returned unchanged.
+    """
+    program = Program(code, tokenized, data_labels)
+    # Flag-1 math loads R15 behind the scenes, its value is not known in a program using it
+    while not program.uses_scratch_register():
+        graph = FlowGraph.build(program)
+        if graph is None or not (remove_redundant_loads(graph) or hoist_invariant_load(graph)):
+            break
+    return (*program.result(), program.changes)
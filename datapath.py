@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import logging
+from collections.abc import Sequence
 
 from alu import Alu
+from data_cache import DataCache
 from io_controller import IOController
 from machine_exceptions import InvalidMuxSignalError
 from memory import DataMemory, InstructionMemory
@@ -25,16 +27,23 @@ class DataPath:
     cu_address_out: int
     cu_data_out: int
 
-    def __init__(self, instructions: list[str], data: list[int], input_stream: str):
+    def __init__(
+        self,
+        instructions: Sequence[int],
+        data: Sequence[int],
+        input_stream: str,
+        io_controller: IOController | None = None,
+        data_cache: DataCache | None = None,
+    ):
         self.pc = 0
 
         self.register_file = RegisterFile()
         # Connect ALU to register file
         self.alu = Alu(self.register_file)
 
-        self.io_controller = IOController(input_stream)
+        self.io_controller = IOController(input_stream) if io_controller is None else io_controller
         # Connect Datamemory to register file and io controller
-        self.data_memory = DataMemory(data, self.register_file, self.io_controller)
+        self.data_memory = DataMemory(data, self.register_file, self.io_controller, data_cache)
 
         self.instruction_memory = InstructionMemory(instructions)
 
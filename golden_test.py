@@ -1,16 +1,116 @@
 import contextlib
 import io
+import json
 import logging
 import os
 import tempfile
 
+import data_cache
+import layout
+import lockstep_engine
 import machine
+import microcode_compaction
 import pytest
+import run_result
 import translator
+from assembly_cache import AssemblyCache
+from branch_predictor import PREDICTORS, BranchMonitor, create_predictors
+from profiler import Profiler, read_listing
+from snapshot import Checkpointer
+from tracer import Tracer
+
+
+def translate(source, **options):
+    """
+    Translate a source with translator.main into an object file and load it.
+
+    Returns:
+        tuple[ObjectFile, list[str]]: The program and the lines of the translator listing.
+    """
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_file = os.path.join(tmpdirname, "source.rasm")
+        target_object = os.path.join(tmpdirname, "target.o")
+        with open(source_file, mode="w", encoding="utf-8") as f:
+            f.write(source)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            translator.main(source_file, target_object, **options)
+        return machine.load_program(target_object, None), stdout.getvalue().splitlines()
+
+
+def translate_golden(golden, **options):
+    """
+    Translate the source of a golden case, see translate.
+
+    Returns:
+        tuple[ObjectFile, str]: The program and the first line of the golden input.
+    """
+    program, _ = translate(golden["in_source"], **options)
+    return program, "".join(golden["in_stdin"].splitlines()[:1])
+
+
+@pytest.mark.parametrize("interpreted", [False, True], ids=["compiled", "interpreted"])
+@pytest.mark.golden_test("golden/*.yml")
+def test_translator_and_machine(golden, golden_runs, interpreted):
+    """The cases are translated and run in parallel by golden_runs (see conftest.py)."""
+    run = golden_runs.get(golden.path, "interpreted" if interpreted else "compiled")
+
+    assert run.code == golden.out["out_code"]
+    assert run.stdout == golden.out["out_stdout"]
+    assert run.data == golden.out["out_data"]
+    assert run.log == golden.out["out_log"]
+
+
+@pytest.mark.parametrize("engine", [machine.ENGINE_INSTRUCTION, machine.ENGINE_BLOCK])
+@pytest.mark.golden_test("golden/*.yml")
+def test_instruction_engine(golden, golden_runs, engine):
+    """Fast engines skip per-tick machine states, the rest of the log matches the microcoded run."""
+    expected = [
+        line for line in golden_runs.get(golden.path, "compiled").log.splitlines() if "Machine state" not in line
+    ]
+    log = golden_runs.get(golden.path, engine).log
+
+    assert [line for line in log.splitlines() if "Block cache" not in line] == expected
+
+
+@pytest.mark.parametrize("tick_limit", range(8, 14))
+def test_engines_at_tick_limit(tick_limit):
+    """Around the tick limit every engine stops where the microcoded run does, a HALT needs a tick under it."""
+    program, _ = translate(".text\n    nop\n    nop\n    halt\n")
+    results = []
+    for engine in (machine.ENGINE_MICROCODE, machine.ENGINE_INSTRUCTION, machine.ENGINE_BLOCK):
+        result = machine.run_simulation(
+            program.code, program.data, "", engine=engine, entry=program.entry, tick_limit=tick_limit
+        )
+        results.append((result.stop_reason, result.ticks, result.instructions))
+
+    assert results == [results[0]] * 3
+    assert (results[0][0] is None) == (tick_limit <= 11)
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_pipeline(golden):
+    """The pipelined control unit gives the same architectural results in fewer ticks."""
+    program, input_str = translate_golden(golden)
+    results = []
+    for engine in (machine.ENGINE_MICROCODE, machine.ENGINE_PIPELINE):
+        result = machine.run_simulation(program.code, program.data, input_str, engine=engine, entry=program.entry)
+        state = (
+            result.output,
+            result.stop_reason,
+            result.registers,
+            [page.tolist() for page in result.control_unit.datapath.data_memory.pages],
+            result.instructions,
+        )
+        results.append((state, result.ticks))
+
+    (state, ticks), (pipelined_state, pipelined_ticks) = results
+    assert pipelined_state == state
+    assert pipelined_ticks < ticks
 
 
 @pytest.mark.golden_test("golden/*.yml")
-def test_translator_and_machine(golden, caplog):
+def test_object_file(golden, caplog):
+    """The packed object file holds the same program as the text export and runs the same way."""
     caplog.set_level(logging.DEBUG)
 
     with tempfile.TemporaryDirectory() as tmpdirname:
@@ -18,25 +118,250 @@ def test_translator_and_machine(golden, caplog):
         input_stream = os.path.join(tmpdirname, "input.txt")
         target_code = os.path.join(tmpdirname, "target_code.bin")
         target_data = os.path.join(tmpdirname, "target_dara.bin")
+        target_object = os.path.join(tmpdirname, "target.o")
 
         with open(source, mode="w", encoding="utf-8") as f:
             f.write(golden["in_source"])
         with open(input_stream, mode="w", encoding="utf-8") as f:
             f.write(golden["in_stdin"])
 
-        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+        with contextlib.redirect_stdout(io.StringIO()):
             translator.main(source, target_code, target_data)
+            translator.main(source, target_object)
             machine.main(target_code, target_data, input_stream)
+            expected = caplog.text
+            caplog.clear()
+            machine.main(target_object, None, input_stream)
+
+        program = machine.load_program(target_object, None)
+        text_program = machine.load_program(target_code, target_data)
+        assert list(program.code) == text_program.code
+        assert list(program.data) == text_program.data
+        assert caplog.text == expected
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_lockstep_engine(golden):
+    """N lockstep instances give the same outputs and counters as N separate runs."""
+    pytest.importorskip("numpy")
+
+    program, _ = translate_golden(golden)
+
+    inputs = [*golden["in_stdin"].splitlines()[:1], "", "lockstep"]
+    results = lockstep_engine.LockstepEngine(program.code, program.data, inputs, program.entry).run()
+    for input_str, result in zip(inputs, results):
+        expected = machine.run_simulation(program.code, program.data, input_str, entry=program.entry)
+        assert result.output == expected.output
+        assert (result.ticks, result.instructions, result.mc) == (
+            expected.ticks,
+            expected.instructions,
+            expected.microinstructions,
+        )
+        assert result.stop_reason == expected.stop_reason
 
-        with open(target_code, mode="rb") as f:
-            code = f.read()
-            code = str(code, encoding="utf-8").replace("\r", "")
 
-        with open(target_data, mode="rb") as f:
-            data = f.read()
-            data = str(data, encoding="utf-8").replace("\r", "")
+@pytest.mark.golden_test("golden/*.yml")
+def test_snapshot_resume(golden):
+    """A run stopped at a checkpoint and resumed from the snapshot goes through the same states as a single run."""
+    program, input_str = translate_golden(golden)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        snapshot = os.path.join(tmpdirname, "run.snap")
+        tracer = Tracer()
+        result = machine.run_simulation(program.code, program.data, input_str, tracer=tracer, entry=program.entry)
+        half = result.ticks // 2
+        resumed_tracer = Tracer()
+        machine.run_simulation(
+            program.code,
+            program.data,
+            input_str,
+            tracer=resumed_tracer,
+            entry=program.entry,
+            tick_limit=half,
+            checkpointer=Checkpointer(snapshot, 7),
+        )
+        resumed = machine.run_simulation(
+            program.code,
+            program.data,
+            None,
+            engine=machine.ENGINE_BLOCK,
+            tracer=resumed_tracer,
+            entry=program.entry,
+            tick_limit=machine.TICK_LIMIT - half,
+            snapshot=snapshot,
+        )
+
+    assert resumed_tracer.states[:half] == tracer.states[:half]
+    assert resumed.output == result.output
+    assert (resumed.ticks, resumed.instructions, resumed.microinstructions) == (
+        result.ticks,
+        result.instructions,
+        result.microinstructions,
+    )
+    assert resumed.stop_reason == result.stop_reason
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_profiler(golden):
+    """The profile accounts for every tick and instruction of the run and maps addresses to the listing."""
+    program, listing = translate(golden["in_source"])
+    profiler = Profiler(read_listing(listing))
+    input_str = "".join(golden["in_stdin"].splitlines()[:1])
+    result = machine.run_simulation(program.code, program.data, input_str, entry=program.entry, profiler=profiler)
+    report = profiler.report()
+
+    assert report["ticks"] == result.ticks
+    assert sum(line["executions"] for line in report["instructions"]) == result.instructions
+    assert sum(report["opcodes"].values()) == result.instructions
+    assert result.opcode_mix == report["opcodes"]
+    assert all(line["source"] for line in report["instructions"])
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_assembly_cache(golden):
+    """A cached program is the one translator.main writes, the second request is a hit."""
+    program, _ = translate_golden(golden)
+    optimized_program, _ = translate_golden(golden, optimize=True, dataflow=True)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = AssemblyCache(os.path.join(tmpdirname, "cache"))
+        first = cache.get(golden["in_source"])
+        second = cache.get(golden["in_source"])
+        optimized = cache.get(golden["in_source"], optimize=True, dataflow=True)
+        stats = cache.stats()
+        cache.clear()
+
+    assert first == second
+    assert (first.code, first.data, first.entry) == (program.code, program.data, program.entry)
+    assert {**first.text_labels, **first.data_labels} == {symbol.name: symbol.address for symbol in program.symbols}
+    assert list(optimized.code) == list(optimized_program.code)
+    assert (stats["misses"], stats["hits"], stats["evictions"]) == (2, 1, 0)
+    assert cache.stats()["hits"] == 0
+
+
+@pytest.mark.parametrize(
+    "optimizations",
+    [{"optimize": True}, {"dataflow": True}, {"optimize": True, "dataflow": True}],
+    ids=["peephole", "dataflow", "both"],
+)
+@pytest.mark.golden_test("golden/*.yml")
+def test_optimizations(golden, optimizations):
+    """The optimized program gives the same output in at most as many ticks."""
+    results = []
+    for options in ({}, optimizations):
+        program, input_str = translate_golden(golden, **options)
+        result = machine.run_simulation(program.code, program.data, input_str, entry=program.entry)
+        results.append((result.ticks, result.output, result.stop_reason))
+
+    (ticks, output, stop_reason), (optimized_ticks, optimized_output, optimized_stop_reason) = results
+    assert (optimized_output, optimized_stop_reason) == (output, stop_reason)
+    assert optimized_ticks <= ticks
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_block_layout(golden):
+    """Laid out by its own profile, the program gives the same output in exactly the expected ticks."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        profile_file = os.path.join(tmpdirname, "profile.json")
+        results = []
+        for profile in (None, profile_file):
+            program, input_str = translate_golden(golden, profile=profile)
+            profiler = Profiler()
+            result = machine.run_simulation(
+                program.code, program.data, input_str, entry=program.entry, profiler=profiler
+            )
+            results.append((result.ticks, result.output, result.stop_reason))
+            if profile is None:
+                with open(profile_file, "w", encoding="utf-8") as f:
+                    json.dump(profiler.report(), f)
+
+        source = os.path.join(tmpdirname, "source.rasm")
+        with open(source, mode="w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        code = translator.read_file(source)
+        tokenized = translator.tokenize(code)
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_labels = translator.get_data_labels_mapping(tokenized)
+        _, _, changes = layout.optimize(code, tokenized, data_labels, layout.load_profile(profile_file))
+
+    (ticks, output, stop_reason), (laid_out_ticks, laid_out_output, laid_out_stop_reason) = results
+    assert (laid_out_output, laid_out_stop_reason) == (output, stop_reason)
+    assert laid_out_ticks == ticks - changes[layout.CHANGE_SAVED]
+
+
+def test_compacted_microcode():
+    """The compacted microprogram memory runs every golden case to the same state in fewer ticks."""
+    results = microcode_compaction.verify(microcode_compaction.compact())
+
+    assert results
+    for result in results:
+        assert result.identical, result.name
+        assert result.compacted_ticks < result.ticks, result.name
+
+
+@pytest.mark.parametrize("write_policy", [data_cache.WRITE_BACK, data_cache.WRITE_THROUGH])
+@pytest.mark.golden_test("golden/*.yml")
+def test_data_cache(golden, write_policy):
+    """The data cache only stalls the memory rows: the same state in the ticks plus the stall ticks."""
+    program, input_str = translate_golden(golden)
+    config = data_cache.CacheConfig(sets=2, ways=2, line_size=2, write_policy=write_policy)
+    results = []
+    for cache in (None, config):
+        result = machine.run_simulation(program.code, program.data, input_str, entry=program.entry, data_cache=cache)
+        state = (
+            result.output,
+            result.stop_reason,
+            result.registers,
+            [page.tolist() for page in result.control_unit.datapath.data_memory.pages],
+            result.instructions,
+        )
+        results.append((state, result.ticks))
+
+    (state, ticks), (cached_state, cached_ticks) = results
+    cache = result.control_unit.data_cache
+    assert cached_state == state
+    assert cached_ticks == ticks + cache.stall_ticks
+    assert cache.hits + cache.misses == cache.reads + cache.writes
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_branch_predictors(golden):
+    """The monitor sees the taken branches the profiler counts, static not-taken mispredicts each of them."""
+    program, input_str = translate_golden(golden)
+
+    profiler = Profiler()
+    monitor = BranchMonitor(create_predictors(",".join(PREDICTORS)))
+    machine.run_simulation(
+        program.code, program.data, input_str, entry=program.entry, profiler=profiler, branch_monitor=monitor
+    )
+    report = monitor.report()
+
+    assert +monitor.taken == profiler.taken
+    for branch in report["branches"]:
+        expected = 0 if branch["opcode"] == "jmp" else branch["taken"]
+        assert branch["predictors"]["not-taken"]["mispredicted"] == expected
+    assert all(0 <= summary["accuracy"] <= 1 for summary in report["predictors"].values())
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_run_result(golden):
+    """The result of a run holds what the golden log summary reports."""
+    program, input_str = translate_golden(golden)
+    result = machine.run_simulation(program.code, program.data, input_str, entry=program.entry)
+    origin = " machine:run_simulation "
+    summary = dict(
+        line.split(origin)[1].strip().split(": ", 1) for line in golden.out["out_log"].splitlines() if origin in line
+    )
 
-        assert code == golden.out["out_code"]
-        assert stdout.getvalue() == golden.out["out_stdout"]
-        assert data == golden.out["out_data"]
-        assert caplog.text == golden.out["out_log"]
+    assert result.stop == run_result.STOP_HALT
+    assert summary["StopIteration reason"].strip() == result.stop_reason
+    assert int(summary["Ticks"]) == result.ticks
+    assert int(summary["Instructions executed"]) == result.instructions
+    assert int(summary["Microprogram executed"]) == result.microinstructions
+    assert summary["Output(int)"] == str(result.output)
+    assert result.cpi == result.ticks / result.instructions
+    assert sum(result.opcode_mix.values()) == result.instructions
+    for engine in (machine.ENGINE_INSTRUCTION, machine.ENGINE_BLOCK, machine.ENGINE_PIPELINE):
+        engine_result = machine.run_simulation(
+            program.code, program.data, input_str, engine=engine, entry=program.entry
+        )
+        assert engine_result.opcode_mix == result.opcode_mix, engine
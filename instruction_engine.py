@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+from typing import Callable, NamedTuple
+
+from control_unit import ControlUnit
+from isa import Opcode
+from machine_exceptions import InvalidOpcodeError
+from memory import DecodedInstruction
+from microcode import MicroProgramMemory, Signal
+
+ALU_OPERATIONS: dict[int, Callable[[int, int], int]] = {
+    Opcode.ADD.code: lambda left, right: left + right,
+    Opcode.SUB.code: lambda left, right: left - right,
+    Opcode.MUL.code: lambda left, right: left * right,
+    Opcode.AND.code: lambda left, right: left & right,
+}
+
+
+class MicroprogramCost(NamedTuple):
+    """Cost of a microprogram path, taken from the microprogram memory."""
+
+    mc: tuple[int, ...]  # mc[k] - number of signals executed by the first k rows
+    stages: dict[Signal, int]  # Position of the first row containing a signal
+    jumps: bool  # The path latches the address from the instruction into PC
+    halts: bool  # The path ends with HALT
+
+    @property
+    def ticks(self) -> int:
+        return len(self.mc) - 1
+
+
+def get_microprogram_cost(start: int, neg_zero: int = 0) -> MicroprogramCost:
+    """
+    Collect the tick and microinstruction costs of the path starting at the given row.
+
+    >>> cost = get_microprogram_cost(6)
+    >>> cost.ticks, cost.mc[-1], cost.stages[Signal.LATCH_REG]
+    (2, 11, 1)
+    """
+    rows, halts = MicroProgramMemory.get_path(start, neg_zero)
+    mc = [0]
+    stages: dict[Signal, int] = {}
+    jumps = False
+    for position, row in enumerate(rows):
+        program = MicroProgramMemory.get_microprogram(row)
+        mc.append(mc[-1] + len(program))
+        for signal in program:
+            stages.setdefault(signal, position)
+        jumps = jumps or Signal.SEL_PC_ADDR in program
+    return MicroprogramCost(tuple(mc), stages, jumps, halts)
+
+
+class InstructionEngine:
+    """
+    Executes whole ISA instructions directly on the DataPath state.
+
+    Instead of stepping through microinstructions the engine applies the effect of an
+    instruction at once and charges the ticks and microinstructions the microprogram
+    memory would spend on it, so the counters match the microcoded ControlUnit. When an
+    instruction fails half way (e.g. reading from the empty input buffer) only the rows
+    executed before the failing one are charged, like in the microcoded run.
+    """
+
+    def __init__(self, control_unit: ControlUnit):
+        self.bind(control_unit)
+
+        self.fetch = get_microprogram_cost(0)
+        self.costs = {
+            line: tuple(get_microprogram_cost(line, neg_zero) for neg_zero in range(3))
+            for line in MicroProgramMemory.get_decode_lines()
+        }
+        self.max_instruction_ticks = self.fetch.ticks + max(
+            cost.ticks for costs in self.costs.values() for cost in costs
+        )
+        # Rows of the current instruction which are finished before the next risky operation
+        self.stage = 0
+
+        self.handlers: dict[int, Callable[[DecodedInstruction, MicroprogramCost], None]] = {
+            Opcode.LOAD_WORD.code: self._load_word,
+            Opcode.WRITE_WORD.code: self._write_word,
+        }
+        for opcode in (Opcode.NOP, Opcode.HALT, Opcode.JUMP):
+            self.handlers[opcode.code] = self._no_operation
+        for opcode in (Opcode.ADD, Opcode.SUB, Opcode.MUL, Opcode.AND):
+            self.handlers[opcode.code] = self._math
+        for opcode in (Opcode.BEQ, Opcode.BNE, Opcode.BGT, Opcode.BLT):
+            self.handlers[opcode.code] = self._compare
+
+    def bind(self, control_unit: ControlUnit) -> None:
+        """Execute the next instructions on another machine, the cost tables are kept."""
+        self.control_unit = control_unit
+        self.datapath = control_unit.datapath
+        self.alu = control_unit.alu
+
+    def run(self, tick_limit: int) -> str | None:
+        """
+        Execute instructions while a whole instruction fits into the tick limit.
+
+        Args:
+            tick_limit (int): Tick limit of the simulation.
+
+        Returns:
+            str | None: "HALT" if the program halted, None if the remaining ticks have to be
+            simulated by the microcoded ControlUnit.
+        """
+        last_start = tick_limit - self.max_instruction_ticks
+        while self.control_unit.tick_counter <= last_start:
+            if self.step():
+                return "HALT"
+        return None
+
+    def step(self) -> bool:
+        """
+        Fetch and execute one instruction.
+
+        Returns:
+            bool: True if the instruction was HALT.
+        """
+        instruction = self._fetch()
+        line = instruction.decode_line
+        self.stage = 0
+        try:
+            self.handlers[instruction.opcode](instruction, self.costs[line][0])
+        except Exception:
+            self._charge(self.costs[line][0], self.stage)
+            raise
+        cost = self.costs[line][self.alu.neg_zero]
+        if cost.jumps:
+            self.datapath.pc = instruction.r2
+        self._charge(cost, cost.ticks)
+        return cost.halts
+
+    def _charge(self, cost: MicroprogramCost, rows: int) -> None:
+        self.control_unit.tick_counter += rows
+        self.control_unit.mc_counter += cost.mc[rows]
+
+    def _fetch(self) -> DecodedInstruction:
+        control_unit = self.control_unit
+        datapath = self.datapath
+        control_unit.instructions_counter += 1
+        control_unit.fetched[datapath.pc] += 1
+
+        read_stage = self.fetch.stages[Signal.LATCH_IR]
+        self._charge(self.fetch, read_stage)
+        datapath.pc += 1
+        instruction = datapath.instruction_memory.read_decoded(datapath.pc)
+        if instruction.decode_line is None:
+            raise InvalidOpcodeError(instruction.opcode)
+        control_unit.decode_line = control_unit.ir = instruction.decode_line
+        control_unit.operands = instruction.operands
+        control_unit.instruction = instruction
+        datapath.cu_data_out = datapath.cu_address_out = instruction.r2
+        control_unit.tick_counter += self.fetch.ticks - read_stage
+        control_unit.mc_counter += self.fetch.mc[-1] - self.fetch.mc[read_stage]
+        return instruction
+
+    def _alu(self, operation: Callable[[int, int], int], left: int, right: int) -> int:
+        alu = self.alu
+        alu.alu_result = operation(left, right)
+        alu._handle_overflow()
+        alu.update_flags(alu.alu_result)
+        return alu.alu_result
+
+    def _no_operation(self, instruction: DecodedInstruction, cost: MicroprogramCost) -> None:
+        pass
+
+    def _math(self, instruction: DecodedInstruction, cost: MicroprogramCost) -> None:
+        register_file = self.datapath.register_file
+        registers = register_file.registers
+        self.stage = cost.stages[Signal.LATCH_REG]
+        if instruction.flag:
+            registers[15] = instruction.r2
+            right = registers[15]
+        else:
+            right = registers[instruction.r2]
+        result = self._alu(ALU_OPERATIONS[instruction.opcode], registers[instruction.r1], right)
+        register_file.latch_reg_n(instruction.rb, result)
+
+    def _load_word(self, instruction: DecodedInstruction, cost: MicroprogramCost) -> None:
+        data_memory = self.datapath.data_memory
+        self.stage = cost.stages[Signal.LATCH_READ_MEM]
+        data_memory.memory_out = data_memory.read_cell(self.datapath.register_file.registers[instruction.r1])
+        self.stage = cost.stages[Signal.LATCH_REG]
+        self.datapath.register_file.latch_reg_n(instruction.rb, data_memory.memory_out)
+
+    def _write_word(self, instruction: DecodedInstruction, cost: MicroprogramCost) -> None:
+        registers = self.datapath.register_file.registers
+        self.stage = cost.stages[Signal.LATCH_WRITE_MEM]
+        self.datapath.data_memory.write_cell(registers[instruction.r1], registers[instruction.r2])
+
+    def _compare(self, instruction: DecodedInstruction, cost: MicroprogramCost) -> None:
+        registers = self.datapath.register_file.registers
+        self._alu(ALU_OPERATIONS[Opcode.SUB.code], registers[instruction.rb], registers[instruction.r1])
@@ -1,25 +1,126 @@
 from __future__ import annotations
 
 import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from itertools import islice
+from typing import TextIO
 
 from machine_exceptions import StopIterationError
 
+DEFAULT_CHUNK_SIZE = 4096
+DEFAULT_BATCH_SIZE = 4096
+
+# Input sources are iterators over chunks of input words, they are read only when the buffer runs empty
+InputSource = Iterator[Sequence[int]]
+
+
+def string_source(text: str) -> InputSource:
+    yield [ord(char) for char in text]
+
+
+def file_source(file: TextIO, chunk_size: int = DEFAULT_CHUNK_SIZE) -> InputSource:
+    """Read a text file (or stdin) lazily, chunk_size characters at a time."""
+    while chunk := file.read(chunk_size):
+        yield [ord(char) for char in chunk]
+
+
+def iterable_source(values: Iterable[int | str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> InputSource:
+    """
+    Feed words (or strings, one word per character) from any iterable, e.g. a generator.
+
+    >>> list(iterable_source(["ab", 10, "c"], chunk_size=2))
+    [[97, 98], [10, 99]]
+    """
+    words = (word for value in values for word in (map(ord, value) if isinstance(value, str) else [value]))
+    while chunk := list(islice(words, chunk_size)):
+        yield chunk
+
+
+class OutputSink(ABC):
+    """Receives the output words in batches of batch_size."""
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    @abstractmethod
+    def write(self, values: list[int]) -> None:
+        """Take a batch of output words."""
+
+
+class CallbackSink(OutputSink):
+    def __init__(self, callback: Callable[[list[int]], None], batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.callback = callback
+
+    def write(self, values: list[int]) -> None:
+        self.callback(values)
+
+
+class FileSink(OutputSink):
+    """Writes the output as characters (U+FFFD for words out of the Unicode range) or as numbers, one per line."""
+
+    def __init__(self, file: TextIO, batch_size: int = DEFAULT_BATCH_SIZE, as_text: bool = True):
+        super().__init__(batch_size)
+        self.file = file
+        self.as_text = as_text
+
+    def write(self, values: list[int]) -> None:
+        if self.as_text:
+            self.file.write("".join(chr(value) if 0 <= value < 0x110000 else "\ufffd" for value in values))
+        else:
+            self.file.write("".join(f"{value}\n" for value in values))
+
 
 class IOController:
-    def __init__(self, input_str: str):
-        self.input_buffer: list[int] = [ord(char) for char in input_str] + [0]
+    """
+    Input and output buffers of the memory-mapped io cells.
+
+    The input is pulled from the source chunk by chunk when the buffer runs empty, after the
+    source is exhausted a single 0 is read (end of input), then reading raises StopIterationError.
+    Without a sink all the output stays in output_buffer, with a sink output_buffer holds at
+    most batch_size words which were not flushed yet.
+    """
+
+    def __init__(self, input_str: str | InputSource = "", sink: OutputSink | None = None, log_io: bool = True):
+        self.input_source = string_source(input_str) if isinstance(input_str, str) else input_str
+        self.input_buffer: deque[int] = deque()
+        self.input_finished = False
         self.output_buffer: list[int] = []
+        self.sink = sink
+        # Per-word debug logging of io operations
+        self.log_io = log_io
 
     def write_to_buffer(self, value: int) -> None:
         self.output_buffer.append(value)
-        logging.debug(f"Adding value to output buffer: {value}")
+        if self.log_io:
+            logging.debug(f"Adding value to output buffer: {value}")
+        if self.sink is not None and len(self.output_buffer) >= self.sink.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Pass the buffered output to the sink, if there is one."""
+        if self.sink is not None and self.output_buffer:
+            self.sink.write(self.output_buffer)
+            self.output_buffer = []
+
+    def _fill_input_buffer(self) -> None:
+        for chunk in self.input_source:
+            if chunk:
+                self.input_buffer.extend(chunk)
+                return
+        if not self.input_finished:
+            self.input_buffer.append(0)
+            self.input_finished = True
 
     def read_from_buffer(self) -> int:
+        if not self.input_buffer:
+            self._fill_input_buffer()
         if self.input_buffer:
-            logging.debug(
-                f"Reading value from input buffer: {
-                          self.input_buffer[0]}"
-            )
-            return self.input_buffer.pop(0)
+            value = self.input_buffer.popleft()
+            if self.log_io:
+                logging.debug(f"Reading value from input buffer: {value}")
+            return value
         logging.warning("no more values in input buffer to read")
         raise StopIterationError("empty-buffer")
@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import json
+from collections import Counter
+from typing import NamedTuple
+
+from dataflow import FlowGraph
+from isa import Opcode
+from microcode import MicroProgramMemory
+from peephole import BRANCHES, Program, render
+from translator_excpetions import ProfileMismatchError
+from translator_token import Token, TokenType
+
+FETCH_TICKS = len(MicroProgramMemory.get_path(0)[0])
+JUMP_TICKS = FETCH_TICKS + len(MicroProgramMemory.get_path(MicroProgramMemory.get_decode_line(Opcode.JUMP.code, 1))[0])
+# The condition which holds exactly when the original one does not (bgt is taken unless N, blt if N)
+INVERTED = {
+    Opcode.BEQ.mnemonic: Opcode.BNE.mnemonic,
+    Opcode.BNE.mnemonic: Opcode.BEQ.mnemonic,
+    Opcode.BGT.mnemonic: Opcode.BLT.mnemonic,
+    Opcode.BLT.mnemonic: Opcode.BGT.mnemonic,
+}
+LABEL_PREFIX = "_layout"
+
+ACTION_KEEP = "keep"
+ACTION_REMOVE = "remove"  # A jmp to the next block
+ACTION_INVERT = "invert"  # A branch to the next block, inverted to branch to the one it fell through to
+ACTION_JUMP = "jump"  # The block fell through to one placed elsewhere, a jmp to it follows
+
+CHANGE_JUMP_REMOVED = "jmp removed"
+CHANGE_JUMP_ADDED = "jmp added"
+CHANGE_INVERTED = "branch inverted"
+CHANGE_SAVED = "expected ticks saved"
+
+
+class Profile(NamedTuple):
+    executions: dict[int, int]  # By instruction address
+    taken: dict[int, int]  # Taken branches by address
+    source: dict[int, str]  # Source lines the profile was made with, if known
+
+
+def load_profile(filename: str) -> Profile:
+    """Read the JSON profile written by machine.py --profile-json."""
+    with open(filename, encoding="utf-8") as file:
+        report = json.load(file)
+    return Profile(
+        {line["address"]: line["executions"] for line in report["instructions"]},
+        {branch["address"]: branch["taken"] for branch in report.get("branches", [])},
+        {line["address"]: line["source"] for line in report["instructions"] if line["source"]},
+    )
+
+
+class Block(NamedTuple):
+    lines: list[int]  # Program lines: labels in front of the first instruction, instructions
+    first: int  # First node
+    last: int  # Last node, the terminator
+
+
+def _blocks(graph: FlowGraph, first_line: int) -> list[Block]:
+    """Basic blocks in program order."""
+    leaders = {0}
+    for index, node in enumerate(graph.nodes):
+        if node.target is not None:
+            leaders.add(node.target)
+        if node.mnemonic in BRANCHES or node.mnemonic == Opcode.HALT.mnemonic:
+            leaders.add(index + 1)
+    starts = sorted(leader for leader in leaders if leader < len(graph.nodes))
+    blocks = []
+    line = first_line
+    for first, end in zip(starts, [*starts[1:], len(graph.nodes)]):
+        last_line = graph.nodes[end - 1].line
+        blocks.append(Block(list(range(line, last_line + 1)), first, end - 1))
+        line = last_line + 1
+    return blocks
+
+
+class Layout:
+    """
+    Profile-guided order of the basic blocks of a program.
+
+    Blocks are chained along the hottest edges first (Pettis-Hansen), so the hot successor of a
+    block is placed right after it. A jmp to the next block is removed, a branch to the next
+    block is inverted to fall through, and a fall-through whose block was moved away becomes a
+    jmp. Conditional branches take as many ticks taken as not taken here, so the gain is the
+    jmps removed from the hot paths minus the jmps added on the cold ones.
+    """
+
+    def __init__(self, program: Program, graph: FlowGraph, profile: Profile):
+        self.program = program
+        self.graph = graph
+        self.profile = profile
+        self.blocks = _blocks(graph, graph.first_line)
+        self.block_of = {block.first: number for number, block in enumerate(self.blocks)}
+        self.weights = self._weights()
+
+    def _executions(self, node: int) -> int:
+        return self.profile.executions.get(node, 0)
+
+    def successors(self, number: int) -> tuple[int | None, int | None]:
+        """Block reached by falling through and block branched to (None if there is none)."""
+        block = self.blocks[number]
+        node = self.graph.nodes[block.last]
+        target = None if node.target is None else self.block_of[node.target]
+        if node.mnemonic in {Opcode.JUMP.mnemonic, Opcode.HALT.mnemonic}:
+            return None, target
+        return (number + 1 if number + 1 < len(self.blocks) else None), target
+
+    def _weights(self) -> Counter[tuple[int, int]]:
+        weights: Counter[tuple[int, int]] = Counter()
+        for number, block in enumerate(self.blocks):
+            executions = self._executions(block.last)
+            taken = self.profile.taken.get(block.last, 0)
+            following, target = self.successors(number)
+            if target is not None:
+                weights[(number, target)] += executions if following is None else taken
+            if following is not None:
+                weights[(number, following)] += executions - taken if target is not None else executions
+        return weights
+
+    def _chained(self, backward: bool) -> list[int]:
+        chain_of = {number: [number] for number in range(len(self.blocks))}
+        # Among equally hot edges the fall-through ones are taken first, or the backward ones
+        edges = sorted(
+            ((a, b) for a in range(len(self.blocks)) for b in self.successors(a) if b is not None),
+            key=lambda edge: (-self.weights[edge], edge[1] > edge[0] if backward else edge[1] != edge[0] + 1, edge),
+        )
+        for a, b in edges:
+            chain, following = chain_of[a], chain_of[b]
+            if chain is following or chain[-1] != a or following[0] != b or b == 0:
+                continue
+            chain.extend(following)
+            for number in following:
+                chain_of[number] = chain
+        chains = {id(chain): chain for chain in chain_of.values()}.values()
+        return [number for chain in sorted(chains, key=lambda chain: chain[0]) for number in chain]
+
+    def order(self) -> list[int]:
+        """
+        Blocks in their new order, the entry block first.
+
+        A loop whose exit test is at the top runs as often as its body, preferring the backward
+        edge places the test after the body (the loop is rotated): the body loses its jmp back and
+        the test branches back to the body instead of out of the loop. The cheaper order is taken.
+        """
+        return min((self._chained(backward) for backward in (False, True)), key=self.cost)
+
+    def action(self, number: int, placed_next: int | None) -> str:
+        """What becomes of the terminator of a block followed by another one."""
+        node = self.graph.nodes[self.blocks[number].last]
+        following, target = self.successors(number)
+        if node.mnemonic == Opcode.JUMP.mnemonic:
+            return ACTION_REMOVE if target == placed_next else ACTION_KEEP
+        if following is None or placed_next == following:
+            return ACTION_KEEP
+        if node.mnemonic in INVERTED and placed_next == target:
+            return ACTION_INVERT
+        return ACTION_JUMP
+
+    def cost(self, order: list[int]) -> int:
+        """Ticks spent in the jmps of a block order."""
+        ticks = 0
+        for position, number in enumerate(order):
+            action = self.action(number, order[position + 1] if position + 1 < len(order) else None)
+            if action == ACTION_KEEP and self.graph.nodes[self.blocks[number].last].mnemonic == Opcode.JUMP.mnemonic:
+                ticks += self._executions(self.blocks[number].last) * JUMP_TICKS
+            elif action == ACTION_JUMP:
+                ticks += self.weights[(number, self.successors(number)[0])] * JUMP_TICKS
+        return ticks
+
+    def original_cost(self) -> int:
+        """Ticks spent in the jmps of the program as written."""
+        jumps = [index for index, node in enumerate(self.graph.nodes) if node.mnemonic == Opcode.JUMP.mnemonic]
+        return sum(self._executions(index) for index in jumps) * JUMP_TICKS
+
+
+def _labels(program: Program) -> set[str]:
+    return {
+        token.get_string_value() for tokens in program.tokens for token in tokens if token.get_type() == TokenType.LABEL
+    }
+
+
+class _Emitter:
+    """Writes the reordered blocks with their terminators fixed up."""
+
+    def __init__(self, layout: Layout, changes: Counter[str], names: dict[int, str] | None = None):
+        self.layout = layout
+        self.program = layout.program
+        self.changes = changes
+        self.names = {} if names is None else dict(names)
+        self.used = _labels(self.program) | set(self.names.values())
+        self.tokens: list[list[Token]] = []
+        self.code: list[str] = []
+
+    def leading_labels(self, number: int) -> list[str]:
+        """Labels of the first instruction of a block."""
+        block = self.layout.blocks[number]
+        first_line = self.layout.graph.nodes[block.first].line
+        labels = (self.program.label(line) for line in block.lines if line <= first_line)
+        return [label for label in labels if label is not None]
+
+    def label(self, number: int) -> str:
+        """Label of a block, a new one is made up if it has none."""
+        if number not in self.names:
+            leading = self.leading_labels(number)
+            name = leading[0] if leading else None
+            counter = len(self.used)
+            while name is None or name in self.used and not leading:
+                name = f"{LABEL_PREFIX}{counter}"
+                counter += 1
+            self.used.add(name)
+            self.names[number] = name
+        return self.names[number]
+
+    def emit(self, tokens: list[Token], code: str | None = None) -> None:
+        if tokens:
+            self.tokens.append(tokens)
+            self.code.append(render(tokens) if code is None else code)
+
+    def block(self, number: int, placed_next: int | None) -> None:
+        lines = self.layout.blocks[number].lines
+        if number in self.names and self.names[number] not in self.leading_labels(number):
+            self.emit([Token(TokenType.LABEL, self.names[number])])
+        for line in lines[:-1]:
+            self.emit(self.program.tokens[line], self.program.code[line])
+        tokens = self.program.tokens[lines[-1]]
+        mnemonic, arguments = self.program.instruction(lines[-1])
+        labels = tokens[: len(tokens) - len(arguments) - 1]
+        following = self.layout.successors(number)[0]
+        action = self.layout.action(number, placed_next)
+        if action == ACTION_REMOVE:
+            self.changes[CHANGE_JUMP_REMOVED] += 1
+            self.emit(labels)
+        elif action == ACTION_INVERT:
+            self.changes[CHANGE_INVERTED] += 1
+            instruction = Token(TokenType.INSTRUCTION, INVERTED[mnemonic])
+            self.emit([*labels, instruction, *arguments[:-1], Token(TokenType.LABEL, self.label(following))])
+        else:
+            self.emit(tokens, self.program.code[lines[-1]])
+        if action == ACTION_JUMP:
+            self.changes[CHANGE_JUMP_ADDED] += 1
+            self.emit(
+                [Token(TokenType.INSTRUCTION, Opcode.JUMP.mnemonic), Token(TokenType.LABEL, self.label(following))]
+            )
+
+    def run(self, order: list[int]) -> None:
+        for position, number in enumerate(order):
+            self.block(number, order[position + 1] if position + 1 < len(order) else None)
+
+
+def _check_profile(program: Program, graph: FlowGraph, profile: Profile) -> None:
+    for address in (*profile.executions, *profile.taken):
+        if address >= len(graph.nodes):
+            raise ProfileMismatchError(address)
+    for address, source in profile.source.items():
+        if program.code[graph.nodes[address].line] != source:
+            raise ProfileMismatchError(address)
+
+
+def optimize(
+    code: list[str], tokenized: list[list[Token]], data_labels: dict[str, int], profile: Profile
+) -> tuple[list[str], list[list[Token]], Counter[str]]:
+    """
+    Reorder the basic blocks of the text section by the profile of a previous run.
+
+    The profile must come from the same program (translated with the same options), its addresses
+    are those of the instructions here. Programs which can not be analysed (see FlowGraph.build),
+    branch to undefined labels or may run past their last instruction are returned unchanged, and
+    so are the programs the profile does not make faster.
+
+    Returns:
+        tuple[list[str], list[list[Token]], Counter[str]]: As peephole.optimize, the changes include
+            the expected tick reduction for the profiled run.
+
+    Raises:
+        ProfileMismatchError: If the profile refers to instructions this program does not have.
+    """
+    program = Program(code, tokenized, data_labels)
+    graph = FlowGraph.build(program)
+    if graph is None:
+        return (*program.result(), program.changes)
+    _check_profile(program, graph, profile)
+    layout = Layout(program, graph, profile)
+    last = graph.nodes[-1]
+    branches_defined = all(node.target is not None for node in graph.nodes if node.mnemonic in BRANCHES)
+    if not branches_defined or last.mnemonic not in {Opcode.JUMP.mnemonic, Opcode.HALT.mnemonic}:
+        return (*program.result(), program.changes)
+    order = layout.order()
+    saved = layout.original_cost() - layout.cost(order)
+    if saved <= 0:
+        return (*program.result(), program.changes)
+
+    # Labels of the blocks jumped to are only known once all the blocks were placed
+    names = _Emitter(layout, Counter())
+    names.run(order)
+    emitter = _Emitter(layout, program.changes, names.names)
+    emitter.run(order)
+    end = layout.blocks[-1].lines[-1] + 1
+    program.tokens[graph.first_line : end] = emitter.tokens
+    program.code[graph.first_line : end] = emitter.code
+    program.changes[CHANGE_SAVED] = saved
+    return (*program.result(), program.changes)
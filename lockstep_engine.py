@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from typing import NamedTuple
+
+import machine
+from alu import MAX_NUMBER, MIN_NUMBER
+from control_unit import ControlUnit
+from datapath import DataPath
+from instruction_engine import InstructionEngine
+from isa import INSTRUCTION_MEMORY_BEGIN_ADDRESS, Opcode
+from machine_exceptions import MachineError, MissingExtraError
+from memory import CELL_TYPECODE, MAX_MEMORY_SIZE, PAGE_SIZE
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by this engine, it is the optional "lockstep" extra
+    np = None
+
+MATH_OPERATIONS = {
+    Opcode.ADD.code: lambda left, right: left + right,
+    Opcode.SUB.code: lambda left, right: left - right,
+    Opcode.MUL.code: lambda left, right: left * right,
+    Opcode.AND.code: lambda left, right: left & right,
+}
+COMPARE_OPCODES = [Opcode.BEQ.code, Opcode.BNE.code, Opcode.BGT.code, Opcode.BLT.code]
+# Operands of a multiplication below this bound can not overflow int64
+SAFE_MUL_OPERAND = 1 << 31
+# Errors of the program which stop an instance: machine errors, HALT of the microcoded ControlUnit
+# and IndexError for addresses outside the data memory or the register file
+PROGRAM_ERRORS = (MachineError, StopIteration, IndexError)
+
+
+class InstanceResult(NamedTuple):
+    output: list[int]
+    ticks: int
+    instructions: int
+    mc: int
+    stop_reason: str | None  # None if the tick limit was reached, like in run_simulation
+
+
+class LockstepEngine:
+    """
+    Runs N instances of one program with different inputs, every step executes one instruction
+    on all running instances at once.
+
+    Registers, flags, PCs, counters and data memories are NumPy arrays with a row per instance;
+    instances at different PCs (diverged) execute different instructions of the same step through
+    masked operations. The step reproduces InstructionEngine, so the counters are charged from
+    the same microprogram costs. Instances which would leave the common path in this step (a
+    runtime error, the end of the input, a multiplication which may overflow int64) execute the
+    instruction on a scalar machine built from their row; the last instructions before the tick
+    limit are finished by the microcoded ControlUnit exactly like in run_simulation.
+
+    Data memories take MAX_MEMORY_SIZE int64 cells per instance, np.zeros leaves the untouched
+    pages unallocated.
+
+    Raises:
+        MissingExtraError: If NumPy (the "lockstep" extra) is not installed.
+    """
+
+    def __init__(
+        self,
+        instructions: Sequence[int],
+        data: Sequence[int],
+        inputs: Sequence[str],
+        entry: int = INSTRUCTION_MEMORY_BEGIN_ADDRESS,
+    ):
+        if np is None:
+            raise MissingExtraError("LockstepEngine", "numpy", "lockstep")
+        count = len(inputs)
+        # The scalar machine is the reference for the decoding and the costs
+        datapath = DataPath(instructions, [], "")
+        self.instruction_memory = datapath.instruction_memory
+        # Executes the instructions of the instances which fall back to the scalar machine
+        self.engine = InstructionEngine(ControlUnit(datapath.alu, datapath))
+        self.fetch = self.engine.fetch
+        self.max_instruction_ticks = self.engine.max_instruction_ticks
+        self._build_tables(self.engine)
+
+        self.pc = np.full(count, entry, dtype=np.int64)
+        self.neg_zero = np.zeros(count, dtype=np.int64)
+        self.ticks = np.zeros(count, dtype=np.int64)
+        self.instructions_counter = np.zeros(count, dtype=np.int64)
+        self.mc = np.zeros(count, dtype=np.int64)
+        self.registers = np.zeros((count, 16), dtype=np.int64)
+        self.memory = np.zeros((count, MAX_MEMORY_SIZE), dtype=np.int64)
+        initial_data = np.array(data[: MAX_MEMORY_SIZE - 2], dtype=np.int64)
+        self.memory[:, 2 : 2 + len(initial_data)] = initial_data
+
+        # Input words with the end of input 0, instance i has input_length[i] + 1 words to read
+        self.input_length = np.array([len(text) for text in inputs], dtype=np.int64)
+        self.input_words = np.zeros((count, int(self.input_length.max(initial=0)) + 1), dtype=np.int64)
+        for index, text in enumerate(inputs):
+            self.input_words[index, : len(text)] = [ord(char) for char in text]
+        self.input_position = np.zeros(count, dtype=np.int64)
+
+        self.outputs: list[list[int]] = [[] for _ in range(count)]
+        self.stop_reasons: list[str | None] = [None] * count
+        self.running = np.ones(count, dtype=bool)
+
+    def _build_tables(self, engine: InstructionEngine) -> None:
+        decoded = self.instruction_memory.decoded
+        self.code_length = len(decoded)
+        # One more row with no decode line stands for the addresses past the end of the program
+        fields = np.array(
+            [
+                (
+                    instruction.opcode,
+                    instruction.rb,
+                    instruction.r1,
+                    instruction.r2,
+                    instruction.flag,
+                    -1 if instruction.decode_line is None else instruction.decode_line,
+                )
+                for instruction in decoded
+            ]
+            + [(Opcode.NOP.code, 0, 0, 0, 0, -1)],
+            dtype=np.int64,
+        )
+        self.opcode, self.rb, self.r1, self.r2, self.flag, self.line = fields.T
+
+        lines = max(engine.costs) + 1
+        self.cost_ticks = np.zeros((lines, 3), dtype=np.int64)
+        self.cost_mc = np.zeros((lines, 3), dtype=np.int64)
+        self.cost_jumps = np.zeros((lines, 3), dtype=bool)
+        self.cost_halts = np.zeros((lines, 3), dtype=bool)
+        for line, costs in engine.costs.items():
+            for neg_zero, cost in enumerate(costs):
+                self.cost_ticks[line, neg_zero] = cost.ticks
+                self.cost_mc[line, neg_zero] = cost.mc[-1]
+                self.cost_jumps[line, neg_zero] = cost.jumps
+                self.cost_halts[line, neg_zero] = cost.halts
+
+    def run(self, tick_limit: int | None = None) -> list[InstanceResult]:
+        """
+        Run all instances until they stop or reach the tick limit (machine.TICK_LIMIT if not given).
+
+        Returns:
+            list[InstanceResult]: Output, counters and stop reason of every instance, in the order of the inputs.
+        """
+        if tick_limit is None:
+            tick_limit = machine.TICK_LIMIT
+        last_start = tick_limit - self.max_instruction_ticks
+        while True:
+            lanes = np.flatnonzero(self.running & (self.ticks <= last_start))
+            if lanes.size == 0:
+                break
+            self.step(lanes)
+        for lane in np.flatnonzero(self.running):
+            self._finish_scalar(int(lane), tick_limit)
+        return [
+            InstanceResult(
+                self.outputs[lane],
+                int(self.ticks[lane]),
+                int(self.instructions_counter[lane]),
+                int(self.mc[lane]),
+                self.stop_reasons[lane],
+            )
+            for lane in range(len(self.outputs))
+        ]
+
+    def step(self, lanes: np.ndarray) -> None:
+        """Execute one instruction on every given running instance."""
+        address = self.pc[lanes]  # Index of the instruction in the memory (PC before the increment)
+        address = np.minimum(address, self.code_length)
+        fallback = self._needs_scalar(lanes, address)
+        for lane in lanes[fallback]:
+            self._step_scalar(int(lane))
+        lanes, address = lanes[~fallback], address[~fallback]
+
+        self.pc[lanes] += 1
+        self.instructions_counter[lanes] += 1
+        self.ticks[lanes] += self.fetch.ticks
+        self.mc[lanes] += self.fetch.mc[-1]
+
+        opcode = self.opcode[address]
+        math = (opcode >= Opcode.ADD.code) & (opcode <= Opcode.AND.code)
+        self._math(lanes[math], address[math])
+        compare = np.isin(opcode, COMPARE_OPCODES)
+        self._compare(lanes[compare], address[compare])
+        load = opcode == Opcode.LOAD_WORD.code
+        self._load_word(lanes[load], address[load])
+        store = opcode == Opcode.WRITE_WORD.code
+        self._write_word(lanes[store], address[store])
+
+        line = self.line[address]
+        neg_zero = self.neg_zero[lanes]
+        self.ticks[lanes] += self.cost_ticks[line, neg_zero]
+        self.mc[lanes] += self.cost_mc[line, neg_zero]
+        jumps = self.cost_jumps[line, neg_zero]
+        self.pc[lanes[jumps]] = self.r2[address[jumps]]
+        halts = lanes[self.cost_halts[line, neg_zero]]
+        self.running[halts] = False
+        for lane in halts:
+            self.stop_reasons[lane] = "HALT"
+
+    def _needs_scalar(self, lanes: np.ndarray, address: np.ndarray) -> np.ndarray:
+        """Find the instances whose instruction fails or can not be executed on int64 rows."""
+        opcode, rb, r1, r2, flag = (
+            self.opcode[address],
+            self.rb[address],
+            self.r1[address],
+            self.r2[address],
+            self.flag[address],
+        )
+        registers = self.registers[lanes]
+        rows = np.arange(len(lanes))
+        math = (opcode >= Opcode.ADD.code) & (opcode <= Opcode.AND.code)
+        register_r2 = np.minimum(r2, 15)
+        # Unknown opcodes and addresses past the program, writes to r0 and register indices beyond
+        # the register file (r2 is a 16 bit field)
+        fails = self.line[address] < 0
+        fails |= ((opcode == Opcode.LOAD_WORD.code) | math) & (rb == 0)
+        fails |= ((opcode == Opcode.WRITE_WORD.code) | (math & (flag == 0))) & (r2 > 15)
+
+        left = np.where((flag == 1) & (r1 == 15), r2, registers[rows, r1])
+        right = np.where(flag == 1, r2, registers[rows, register_r2])
+        big = (np.abs(left) >= SAFE_MUL_OPERAND) | (np.abs(right) >= SAFE_MUL_OPERAND)
+        fails |= (opcode == Opcode.MUL.code) & big
+
+        memory_address = registers[rows, r1]
+        out_of_range = (memory_address < -MAX_MEMORY_SIZE) | (memory_address >= MAX_MEMORY_SIZE)
+        load = opcode == Opcode.LOAD_WORD.code
+        input_finished = self.input_position[lanes] > self.input_length[lanes]
+        fails |= load & (out_of_range | (memory_address == 1) | ((memory_address == 0) & input_finished))
+        fails |= (opcode == Opcode.WRITE_WORD.code) & (out_of_range | (memory_address == 0))
+        return fails
+
+    def _alu(self, lanes: np.ndarray, result: np.ndarray) -> np.ndarray:
+        result = np.where(result > MAX_NUMBER, result % MAX_NUMBER, result)
+        result = np.where(result < MIN_NUMBER, result % -MIN_NUMBER, result)
+        self.neg_zero[lanes] = np.where(result == 0, 1, np.where(result < 0, 2, 0))
+        return result
+
+    def _math(self, lanes: np.ndarray, address: np.ndarray) -> None:
+        immediate = self.flag[address] == 1
+        self.registers[lanes[immediate], 15] = self.r2[address[immediate]]
+        left = self.registers[lanes, self.r1[address]]
+        right = np.where(immediate, self.r2[address], self.registers[lanes, np.minimum(self.r2[address], 15)])
+        result = np.zeros(len(lanes), dtype=np.int64)
+        opcode = self.opcode[address]
+        for code, operation in MATH_OPERATIONS.items():
+            selected = opcode == code
+            result[selected] = operation(left[selected], right[selected])
+        self.registers[lanes, self.rb[address]] = self._alu(lanes, result)
+
+    def _compare(self, lanes: np.ndarray, address: np.ndarray) -> None:
+        self._alu(lanes, self.registers[lanes, self.rb[address]] - self.registers[lanes, self.r1[address]])
+
+    def _load_word(self, lanes: np.ndarray, address: np.ndarray) -> None:
+        memory_address = self.registers[lanes, self.r1[address]]
+        reads_input = memory_address == 0
+        cells = np.where(memory_address < 0, memory_address + MAX_MEMORY_SIZE, memory_address)
+        value = self.memory[lanes, cells]
+        input_lanes = lanes[reads_input]
+        value[reads_input] = self.input_words[input_lanes, self.input_position[input_lanes]]
+        self.input_position[input_lanes] += 1
+        self.registers[lanes, self.rb[address]] = value
+
+    def _write_word(self, lanes: np.ndarray, address: np.ndarray) -> None:
+        memory_address = self.registers[lanes, self.r1[address]]
+        value = self.registers[lanes, self.r2[address]]
+        cells = np.where(memory_address < 0, memory_address + MAX_MEMORY_SIZE, memory_address)
+        self.memory[lanes, cells] = value
+        writes_output = memory_address == 1
+        for lane, word in zip(lanes[writes_output], value[writes_output]):
+            self.outputs[lane].append(int(word))
+
+    def _load_scalar(self, lane: int) -> ControlUnit:
+        """Build a machine with the state of the instance, at the start of an instruction."""
+        cells = array(CELL_TYPECODE, self.memory[lane].tobytes())
+        datapath = DataPath([], cells[2:], "")
+        datapath.instruction_memory = self.instruction_memory
+        # Cells 0 and 1 are not part of the initial data, but they may have been written
+        datapath.data_memory.image[0][:2] = cells[:2]
+        datapath.pc = int(self.pc[lane])
+        datapath.register_file.registers[:] = self.registers[lane].tolist()
+        datapath.alu.neg_zero = int(self.neg_zero[lane])
+
+        io_controller = datapath.io_controller
+        position, length = int(self.input_position[lane]), int(self.input_length[lane])
+        io_controller.input_buffer = deque(self.input_words[lane, position : length + 1].tolist())
+        io_controller.input_finished = True
+        io_controller.output_buffer = self.outputs[lane]
+
+        control_unit = ControlUnit(datapath.alu, datapath)
+        control_unit.tick_counter = int(self.ticks[lane])
+        control_unit.instructions_counter = int(self.instructions_counter[lane])
+        control_unit.mc_counter = int(self.mc[lane])
+        return control_unit
+
+    def _store_scalar(self, lane: int, control_unit: ControlUnit) -> None:
+        datapath = control_unit.datapath
+        self.ticks[lane] = control_unit.tick_counter
+        self.instructions_counter[lane] = control_unit.instructions_counter
+        self.mc[lane] = control_unit.mc_counter
+        self.pc[lane] = datapath.pc
+        self.registers[lane] = datapath.register_file.registers
+        self.neg_zero[lane] = datapath.alu.neg_zero
+        self.input_position[lane] = self.input_length[lane] + 1 - len(datapath.io_controller.input_buffer)
+        data_memory = datapath.data_memory
+        for number, owned in enumerate(data_memory.owned):
+            if owned:
+                start = number * PAGE_SIZE
+                cells = np.frombuffer(data_memory.pages[number], dtype=np.int64)
+                self.memory[lane, start : start + PAGE_SIZE] = cells[: MAX_MEMORY_SIZE - start]
+
+    def _stop(self, lane: int, reason: str) -> None:
+        self.running[lane] = False
+        self.stop_reasons[lane] = reason
+
+    def _step_scalar(self, lane: int) -> None:
+        control_unit = self._load_scalar(lane)
+        self.engine.bind(control_unit)
+        try:
+            if self.engine.step():
+                self._stop(lane, "HALT")
+        except PROGRAM_ERRORS as e:
+            self._stop(lane, str(e))
+        self._store_scalar(lane, control_unit)
+
+    def _finish_scalar(self, lane: int, tick_limit: int) -> None:
+        control_unit = self._load_scalar(lane)
+        try:
+            machine.run_microcode(control_unit, tick_limit, None)
+        except PROGRAM_ERRORS as e:
+            self._stop(lane, str(e))
+        self._store_scalar(lane, control_unit)
@@ -1,59 +1,514 @@
 from __future__ import annotations
 
+import argparse
+import json
 import logging
 import sys
+from collections.abc import Sequence
+from contextlib import ExitStack
 
+from block_cache import DEFAULT_CACHE_SIZE, BlockEngine
+from branch_predictor import DEFAULT_PENALTY, BranchMonitor, create_predictors
 from control_unit import ControlUnit
+from data_cache import CacheConfig, DataCache, parse_cache_config
 from datapath import DataPath
+from instruction_engine import InstructionEngine
+from io_controller import FileSink, InputSource, IOController, file_source
+from isa import INSTRUCTION_MEMORY_BEGIN_ADDRESS
+from machine_exceptions import CacheConfigError, EngineConfigError, UnknownPredictorError
+from microcode_compaction import MicrocodeTable, compact
+from object_file import ObjectFile, is_object_file, read_object
+from pipeline import PipelineEngine
+from profiler import Profiler, opcode_mix, read_listing
+from run_result import RunResult, classify_stop, log_result
+from snapshot import Checkpointer, load_snapshot
+from tracer import TRACE_LOG, LogTracer, Tracer, create_tracer, trace_mode
 
 TICK_LIMIT = 7000
 
+ENGINE_MICROCODE = "microcode"
+ENGINE_INSTRUCTION = "instruction"
+ENGINE_BLOCK = "block"
+ENGINE_PIPELINE = "pipeline"
+ENGINES = [ENGINE_MICROCODE, ENGINE_INSTRUCTION, ENGINE_BLOCK, ENGINE_PIPELINE]
+
 
 def read_file(file_name: str) -> list[str]:
     return open(file=file_name, encoding="utf-8").read().splitlines()
 
 
-def main(compiled_code: str, compiled_data: str, input_file: str | None):
-    instructions = read_file(compiled_code)
-    data = list(map(lambda x: int(x, 2), read_file(compiled_data)))
-    input_str = None
-    if input_file is not None:
+def load_program(compiled_code: str, compiled_data: str | None) -> ObjectFile:
+    """
+    Load a program from an object file or from the text code and data files.
+
+    Args:
+        compiled_code (str): Object file, or the text code file if compiled_data is given.
+        compiled_data (str | None): Text data file, None for object files.
+
+    Returns:
+        ObjectFile: Code and data words, entry point and symbols (no symbols for the text format).
+    """
+    if compiled_data is None:
+        return read_object(compiled_code)
+    code = [int(line, 2) for line in read_file(compiled_code)]
+    data = [int(line, 2) for line in read_file(compiled_data)]
+    return ObjectFile(code, data, INSTRUCTION_MEMORY_BEGIN_ADDRESS, [])
+
+
+def main(
+    compiled_code: str,
+    compiled_data: str | None,
+    input_file: str | None,
+    *,
+    interpreted: bool = False,
+    engine: str = ENGINE_MICROCODE,
+    block_cache_size: int = DEFAULT_CACHE_SIZE,
+    trace: str = TRACE_LOG,
+    trace_dump: str | None = None,
+    stream_input: bool = False,
+    output_file: str | None = None,
+    log_io: bool = True,
+    tick_limit: int | None = None,
+    checkpointer: Checkpointer | None = None,
+    snapshot: str | None = None,
+    profiler: Profiler | None = None,
+    microcode: MicrocodeTable | None = None,
+    data_cache: CacheConfig | None = None,
+    branch_monitor: BranchMonitor | None = None,
+) -> RunResult:
+    """Run a compiled program from files, run_simulation logs the summary of the run."""
+    program = load_program(compiled_code, compiled_data)
+    tracer = create_tracer(trace, run_simulation)
+    with ExitStack() as stack:
+        io_controller = create_io_controller(stack, input_file, stream_input, output_file, log_io)
+        result = run_simulation(
+            program.code,
+            program.data,
+            None,
+            interpreted=interpreted,
+            engine=engine,
+            block_cache_size=block_cache_size,
+            tracer=tracer,
+            entry=program.entry,
+            io_controller=io_controller,
+            tick_limit=tick_limit,
+            checkpointer=checkpointer,
+            snapshot=snapshot,
+            profiler=profiler,
+            microcode=microcode,
+            data_cache=data_cache,
+            branch_monitor=branch_monitor,
+        )
+    if tracer is not None and not isinstance(tracer, LogTracer):
+        if trace_dump is None:
+            tracer.dump()
+        else:
+            with open(trace_dump, "w", encoding="utf-8") as dump_file:
+                tracer.dump(dump_file)
+    return result
+
+
+def create_io_controller(
+    stack: ExitStack,
+    input_file: str | None,
+    stream_input: bool = False,
+    output_file: str | None = None,
+    log_io: bool = True,
+) -> IOController:
+    """
+    Create the IOController for a run, the opened files are closed by the stack.
+
+    Args:
+        stack (ExitStack): Owner of the opened files.
+        input_file (str | None): Input file, "-" is stdin when streaming.
+        stream_input (bool): Read the whole input file lazily instead of its first line only.
+        output_file (str | None): File the output characters are flushed to in batches.
+        log_io (bool): Log every io word.
+    """
+    source: str | InputSource = ""
+    if input_file is not None and stream_input:
+        file = sys.stdin if input_file == "-" else stack.enter_context(open(input_file, encoding="utf-8"))
+        source = file_source(file)
+    elif input_file is not None:
         input_data = read_file(input_file)
         if len(input_data) != 0:
-            input_str = input_data[0]
-    run_simulation(instructions, data, input_str)
+            source = input_data[0]
+    sink = None
+    if output_file is not None:
+        sink = FileSink(stack.enter_context(open(output_file, "w", encoding="utf-8", errors="replace")))
+    return IOController(source, sink, log_io)
 
 
-def run_simulation(instructions: list[str], data: list[int], input_str: str | None):
-    datapath = DataPath(instructions, data, "" if input_str is None else input_str)
-    control_unit = ControlUnit(datapath.alu, datapath)
-    instructions_counter = 0
-    mc_counter = 0
-    try:
-        while control_unit.tick_counter < TICK_LIMIT:
-            if control_unit.mpc == 0:
-                instructions_counter += 1
-            mc_counter += control_unit.run_microprogram()
-            logging.debug(
-                f"Machine state: IR({control_unit.ir}), MPC({control_unit.mpc}), PC({datapath.pc}), REGISTERS({
-                    datapath.register_file.registers}), NZ({datapath.alu.neg_zero}), TICKS({control_unit.tick_counter}), MC_COUNTER({mc_counter})"
+def create_engine(engine: str, control_unit: ControlUnit, block_cache_size: int) -> InstructionEngine | None:
+    if engine == ENGINE_INSTRUCTION:
+        return InstructionEngine(control_unit)
+    if engine == ENGINE_BLOCK:
+        return BlockEngine(control_unit, block_cache_size)
+    if engine == ENGINE_PIPELINE:
+        return PipelineEngine(control_unit)
+    return None
+
+
+def run_microcode(control_unit: ControlUnit, tick_limit: int, tracer: Tracer | None) -> None:
+    """
+    Run the microcoded ControlUnit tick by tick until the tick limit.
+
+    The state after every tick is passed to the tracer; without a tracer the loop does not
+    build the state at all.
+    """
+    datapath = control_unit.datapath
+    registers = datapath.register_file.registers
+    fetch_rows = control_unit.fetch_rows
+    fetched = control_unit.fetched
+    while control_unit.tick_counter < tick_limit:
+        if control_unit.mpc in fetch_rows:
+            control_unit.instructions_counter += 1
+            fetched[datapath.pc] += 1
+        control_unit.mc_counter += control_unit.run_microprogram()
+        if tracer is not None:
+            tracer.record(
+                control_unit.ir,
+                control_unit.mpc,
+                datapath.pc,
+                registers,
+                datapath.alu.neg_zero,
+                control_unit.tick_counter,
+                control_unit.mc_counter,
             )
+
+
+def run_segment(
+    control_unit: ControlUnit,
+    instruction_engine: InstructionEngine | None,
+    tick_limit: int,
+    tracer: Tracer | None,
+) -> str | None:
+    """
+    Run until the tick limit, an instruction left unfinished by the previous segment (or a
+    restored snapshot) is finished by the microcoded ControlUnit before the engine takes over.
+
+    Returns:
+        str | None: "HALT" if an engine halted, None if the tick limit was reached.
+    """
+    while control_unit.mpc != 0 and control_unit.tick_counter < tick_limit:
+        run_microcode(control_unit, control_unit.tick_counter + 1, tracer)
+    if instruction_engine is not None:
+        stop_reason = instruction_engine.run(tick_limit)
+        if stop_reason is not None:
+            return stop_reason
+    run_microcode(control_unit, tick_limit, tracer)
+    return None
+
+
+def execute(
+    control_unit: ControlUnit,
+    instruction_engine: InstructionEngine | None,
+    tick_limit: int,
+    tracer: Tracer | None,
+    checkpointer: Checkpointer | None,
+) -> str | None:
+    """Run segment by segment, a checkpoint is saved at the end of every segment."""
+    if checkpointer is None:
+        return run_segment(control_unit, instruction_engine, tick_limit, tracer)
+    for boundary in checkpointer.boundaries(control_unit.tick_counter, tick_limit):
+        stop_reason = run_segment(control_unit, instruction_engine, boundary, tracer)
+        if stop_reason is not None:
+            return stop_reason
+        checkpointer.save(control_unit)
+    return None
+
+
+def create_control_unit(
+    instructions: Sequence[int],
+    data: Sequence[int],
+    input_str: str | None,
+    interpreted: bool,
+    entry: int,
+    io_controller: IOController | None,
+    snapshot: str | None,
+    microcode: MicrocodeTable | None = None,
+    data_cache: CacheConfig | None = None,
+) -> ControlUnit:
+    """
+    Build the machine for a program, in its initial state or in the state restored from a snapshot.
+
+    The data cache starts empty, a snapshot does not keep it.
+    """
+    cache = None if data_cache is None else DataCache(data_cache)
+    datapath = DataPath(instructions, data, "" if input_str is None else input_str, io_controller, cache)
+    datapath.pc = entry
+    control_unit = ControlUnit(datapath.alu, datapath, interpreted, microcode)
+    if snapshot is not None:
+        load_snapshot(snapshot, control_unit)
+    return control_unit
+
+
+def component_stats(control_unit: ControlUnit, instruction_engine: InstructionEngine | None) -> dict[str, str]:
+    """Counters of the block cache, the pipeline and the data cache of a run, by name."""
+    stats = {}
+    if isinstance(instruction_engine, BlockEngine):
+        stats["Block cache"] = instruction_engine.cache.stats()
+    if isinstance(instruction_engine, PipelineEngine):
+        stats["Pipeline"] = instruction_engine.stats()
+    if control_unit.data_cache is not None:
+        stats["Data cache"] = control_unit.data_cache.stats()
+    return stats
+
+
+def check_engine(
+    engine: str,
+    microcode: MicrocodeTable | None,
+    data_cache: CacheConfig | None,
+    profiler: Profiler | None,
+    branch_monitor: BranchMonitor | None,
+) -> None:
+    """
+    Check that the features which work on the microcoded ticks run with the microcode engine.
+
+    The other engines charge the costs of MicroProgramMemory without memory stalls and skip the ticks
+    the profiler and the branch monitor watch.
+
+    >>> check_engine(ENGINE_BLOCK, None, CacheConfig(), None, None)
+    Traceback (most recent call last):
+    ...
+    machine_exceptions.EngineConfigError: The block engine can not run with a data cache, it needs the microcode engine
+
+    Raises:
+        EngineConfigError: If the engine is not the microcode one and any of the features is given.
+    """
+    if engine == ENGINE_MICROCODE:
+        return
+    features = {
+        "a microcode table": microcode,
+        "a data cache": data_cache,
+        "a profiler": profiler,
+        "a branch monitor": branch_monitor,
+    }
+    for feature, value in features.items():
+        if value is not None:
+            raise EngineConfigError(engine, feature)
+
+
+def run_simulation(
+    instructions: Sequence[int],
+    data: Sequence[int],
+    input_str: str | None,
+    *,
+    interpreted: bool = False,
+    engine: str = ENGINE_MICROCODE,
+    block_cache_size: int = DEFAULT_CACHE_SIZE,
+    tracer: Tracer | None = None,
+    entry: int = INSTRUCTION_MEMORY_BEGIN_ADDRESS,
+    io_controller: IOController | None = None,
+    tick_limit: int | None = None,
+    checkpointer: Checkpointer | None = None,
+    snapshot: str | None = None,
+    profiler: Profiler | None = None,
+    microcode: MicrocodeTable | None = None,
+    data_cache: CacheConfig | None = None,
+    branch_monitor: BranchMonitor | None = None,
+) -> RunResult:
+    """
+    Run the program until HALT, an error or the tick limit (TICK_LIMIT if not given).
+
+    Every microcoded tick is passed to the tracer (LogTracer writes the per-tick machine state log),
+    without a tracer nothing is recorded.
+
+    With the "instruction" and "block" engines whole instructions (or basic blocks) are
+    executed without the per-tick machine state log, the last instructions before the tick
+    limit are finished by the microcoded ControlUnit, so the counters are the same for these engines.
+    The "pipeline" engine gives the same results in the ticks of a pipelined control unit (see pipeline.py).
+
+    An io_controller with its own input source and output sink replaces input_str, the output
+    left in its buffer is flushed to the sink before the run returns.
+
+    The checkpointer saves snapshots during the run and at the tick limit. A run resumed from a
+    snapshot continues from the restored state, the tick limit is then a budget on top of its ticks.
+
+    A microcode table (see microcode_compaction.py) replaces MicroProgramMemory, the run is then
+    interpreted tick by tick. A data cache (see data_cache.py) stalls the memory rows. The profiler
+    and the branch monitor (see branch_predictor.py) watch the microcoded ticks like tracers.
+    All of them need the microcode engine (see check_engine). The opcode mix of the result is
+    counted by every engine, from the instructions fetched in this run (not before a snapshot).
+
+    The summary of the run is logged at the end (see run_result.log_result), the result holds the same values.
+
+    Returns:
+        RunResult: The stop reason, counters, registers and output of the run and the control
+        unit after it (DataPath, latches).
+
+    Raises:
+        EngineConfigError: If the engine can not run with the microcode table, data cache, profiler
+            or branch monitor.
+    """
+    check_engine(engine, microcode, data_cache, profiler, branch_monitor)
+    control_unit = create_control_unit(
+        instructions, data, input_str, interpreted, entry, io_controller, snapshot, microcode, data_cache
+    )
+    datapath = control_unit.datapath
+    tick_limit = control_unit.tick_counter + (TICK_LIMIT if tick_limit is None else tick_limit)
+    instruction_engine = create_engine(engine, control_unit, block_cache_size)
+    for observer in (profiler, branch_monitor):
+        if observer is not None:
+            tracer = observer.attach(control_unit, tracer)
+    error = None
+    try:
+        stop_reason = execute(control_unit, instruction_engine, tick_limit, tracer, checkpointer)
     except Exception as e:
-        logging.debug(f"StopIteration reason:  {e}")
-    logging.debug(f"LOC: {len(instructions)}")
-    logging.debug(f"Ticks:  {control_unit.tick_counter}")
-    logging.debug(f"Instructions executed: {instructions_counter}")
-    logging.debug(f"Microprogram executed: {mc_counter}")
-    logging.debug(f"Output(int): {datapath.io_controller.output_buffer}")
-    logging.debug(
-        f"Output(str): {list(map(lambda x: chr(x) if x in range(
-            0x110000) else "NONE", datapath.io_controller.output_buffer))}"
+        stop_reason = str(e)
+        error = e
+    datapath.io_controller.flush()
+    result = RunResult(
+        classify_stop(stop_reason, error),
+        stop_reason,
+        len(instructions),
+        control_unit.tick_counter,
+        control_unit.instructions_counter,
+        control_unit.mc_counter,
+        tuple(datapath.register_file.registers),
+        list(datapath.io_controller.output_buffer),
+        opcode_mix(datapath.instruction_memory.cells, control_unit.fetched),
+        component_stats(control_unit, instruction_engine),
+        control_unit,
     )
+    log_result(result)
+    return result
 
 
 if __name__ == "__main__":
-    logging.getLogger().setLevel(logging.DEBUG)
-    assert (
-        len(sys.argv) >= 3
-    ), "Not enought arguments! Usage: python machine.py <compiled_code> <compiled_data> OP(<input_file>)"
-    main(sys.argv[1], sys.argv[2], None if len(sys.argv) < 4 else sys.argv[3])
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="RISC CPU model")
+    parser.add_argument("compiled_code", help="object file, or the code file of the text format")
+    parser.add_argument(
+        "files",
+        nargs="*",
+        metavar="file",
+        help="<compiled_data> <input_file> for the text format, only <input_file> for an object file",
+    )
+    parser.add_argument(
+        "--interpreted",
+        action="store_true",
+        help="execute microprograms signal by signal instead of the compiled microcode",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=ENGINE_MICROCODE,
+        help="microcode - tick by tick, instruction/block - whole instructions/basic blocks with the same counters, "
+        "pipeline - whole instructions timed by a pipelined control unit",
+    )
+    parser.add_argument(
+        "--block-cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="number of translated basic blocks kept by the block engine",
+    )
+    parser.add_argument(
+        "--trace",
+        type=trace_mode,
+        default=TRACE_LOG,
+        help="per-tick machine state trace: off, log (default), ring:<size> or sample:<every>",
+    )
+    parser.add_argument("--trace-dump", help="write the ring/sample trace to this file instead of the log")
+    parser.add_argument(
+        "--stream-input",
+        action="store_true",
+        help="read the whole input file lazily instead of its first line only, - reads stdin",
+    )
+    parser.add_argument("--output-file", help="flush the output characters to this file in batches")
+    parser.add_argument("--no-io-log", action="store_true", help="do not log every io word")
+    parser.add_argument(
+        "--tick-limit",
+        type=int,
+        default=TICK_LIMIT,
+        help="tick budget of the run, counted from the restored ticks when resuming",
+    )
+    parser.add_argument("--checkpoint", help="snapshot file written at the tick limit, may contain {ticks}")
+    parser.add_argument("--checkpoint-every", type=int, help="also write the snapshot every N ticks")
+    parser.add_argument("--resume", metavar="SNAPSHOT", help="continue the run from a snapshot of the same program")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print the per-address, per-opcode, loop, microprogram row and signal profile (microcoded run)",
+    )
+    parser.add_argument("--profile-json", help="write the profile to this JSON file")
+    parser.add_argument("--listing", help="translator output, maps the profiled addresses to source lines")
+    parser.add_argument(
+        "--branch-predictors",
+        metavar="NAMES",
+        help="compare branch predictors on the run: not-taken,backward-taken,2bit,gshare (microcoded run)",
+    )
+    parser.add_argument(
+        "--mispredict-penalty",
+        type=int,
+        default=DEFAULT_PENALTY,
+        help="ticks lost on a mispredicted branch",
+    )
+    parser.add_argument(
+        "--compact-microcode",
+        action="store_true",
+        help="run the microprogram memory of microcode_compaction.py (interpreted)",
+    )
+    parser.add_argument(
+        "--data-cache",
+        metavar="SPEC",
+        help="model a data cache, e.g. sets=16,ways=2,line=4,write=back,hit=1,miss=10 (microcoded run)",
+    )
+    args = parser.parse_args()
+    if is_object_file(args.compiled_code):
+        args.files.insert(0, None)
+    if not 1 <= len(args.files) <= 2:
+        parser.error("expected <object_file> [<input_file>] or <compiled_code> <compiled_data> [<input_file>]")
+    compiled_data, input_file = [*args.files, None][:2]
+    if args.checkpoint_every is not None and args.checkpoint is None:
+        parser.error("--checkpoint-every needs --checkpoint")
+    data_cache = None
+    if args.data_cache is not None:
+        try:
+            data_cache = parse_cache_config(args.data_cache)
+        except CacheConfigError as e:
+            parser.error(str(e))
+    source = {}
+    if args.listing is not None:
+        source = read_listing(read_file(args.listing))
+    profiler = None
+    if args.profile or args.profile_json is not None:
+        profiler = Profiler(source)
+    branch_monitor = None
+    if args.branch_predictors is not None:
+        try:
+            branch_monitor = BranchMonitor(create_predictors(args.branch_predictors), args.mispredict_penalty, source)
+        except UnknownPredictorError as e:
+            parser.error(str(e))
+    microcode = compact() if args.compact_microcode else None
+    try:
+        check_engine(args.engine, microcode, data_cache, profiler, branch_monitor)
+    except EngineConfigError as e:
+        parser.error(str(e))
+    main(
+        args.compiled_code,
+        compiled_data,
+        input_file,
+        interpreted=args.interpreted,
+        engine=args.engine,
+        block_cache_size=args.block_cache_size,
+        trace=args.trace,
+        trace_dump=args.trace_dump,
+        stream_input=args.stream_input,
+        output_file=args.output_file,
+        log_io=not args.no_io_log,
+        tick_limit=args.tick_limit,
+        checkpointer=None if args.checkpoint is None else Checkpointer(args.checkpoint, args.checkpoint_every),
+        snapshot=args.resume,
+        profiler=profiler,
+        microcode=microcode,
+        data_cache=data_cache,
+        branch_monitor=branch_monitor,
+    )
+    if branch_monitor is not None:
+        branch_monitor.write_table(sys.stdout)
+    if args.profile:
+        profiler.write_table(sys.stdout)
+    if args.profile_json is not None:
+        with open(args.profile_json, "w", encoding="utf-8") as profile_file:
+            json.dump(profiler.report(), profile_file, indent=2)
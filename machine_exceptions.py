@@ -44,8 +44,80 @@ class InvalidOperandIndexError(MachineRuntimeError):
         super().__init__("Invalid Operand Index")
 
 
+class InvalidOpcodeError(MachineRuntimeError):
+    """Exception raised when the decoder meets an unknown opcode."""
+
+    def __init__(self, opcode: int):
+        super().__init__(f"Invalid Opcode: {opcode}")
+
+
 class InvalidRegisterIndexError(MachineRuntimeError):
     """Exception raised for invalid register index."""
 
     def __init__(self, msg):
         super().__init__(f"Invalid Register Index: {msg}")
+
+
+class InvalidObjectFileError(MachineError):
+    """Exception raised when a file is not a valid object file."""
+
+    def __init__(self, msg):
+        super().__init__(f"Invalid Object File: {msg}")
+
+
+class WallClockTimeoutError(MachineError):
+    """Exception raised when a run exceeds its wall-clock time limit."""
+
+    def __init__(self, seconds: float):
+        super().__init__(f"Timeout: {seconds}s")
+
+
+class InvalidSnapshotError(MachineError):
+    """Exception raised when a file is not a valid snapshot of the loaded program."""
+
+    def __init__(self, msg):
+        super().__init__(f"Invalid Snapshot: {msg}")
+
+
+class MicrocodeLayoutError(MachineError):
+    """Exception raised when a microprogram row can not be placed in another microprogram memory."""
+
+    def __init__(self, row: int):
+        super().__init__(f"Microprogram row {row} does not select the next MPC")
+
+
+class CacheConfigError(MachineError):
+    """Exception raised for an invalid data cache description."""
+
+    def __init__(self, option: str):
+        super().__init__(f"Invalid data cache option: {option}")
+
+
+class UnknownPredictorError(MachineError):
+    """Exception raised for a branch predictor name which is not known."""
+
+    def __init__(self, name: str):
+        super().__init__(f"Unknown branch predictor: {name}")
+
+
+class TraceModeError(MachineError):
+    """Exception raised for an invalid machine state trace mode."""
+
+    def __init__(self, mode: str):
+        super().__init__(f"Invalid trace mode: {mode} (off, log, ring:<size> or sample:<every>, from 1)")
+
+
+class EngineConfigError(MachineError):
+    """Exception raised when an engine is combined with a feature which needs the microcoded ticks."""
+
+    def __init__(self, engine: str, feature: str):
+        super().__init__(f"The {engine} engine can not run with {feature}, it needs the microcode engine")
+
+
+class MissingExtraError(ModuleNotFoundError):
+    """Exception raised when a feature needs a package of an optional extra which is not installed."""
+
+    def __init__(self, feature: str, package: str, extra: str):
+        super().__init__(
+            f"{feature} needs {package}, install the {extra} extra: poetry install -E {extra}", name=package
+        )
@@ -1,60 +1,174 @@
 from __future__ import annotations
 
 import logging
+from array import array
+from collections.abc import Sequence
+from typing import TYPE_CHECKING, NamedTuple
 
 from io_controller import IOController
+from isa import INPUT_CELL_ADDRESS, OUTPUT_CELL_ADDRESS
 from machine_exceptions import ReadOnlyCellError, WriteOnlyCellError
+from microcode import MicroProgramMemory
 from register_file import RegisterFile
 
+if TYPE_CHECKING:
+    from data_cache import DataCache
+
 MAX_MEMORY_SIZE = 65535
 
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+PAGE_COUNT = (MAX_MEMORY_SIZE + PAGE_MASK) >> PAGE_BITS
+# 64 bit cells: data words are unsigned 32 bit values, registers hold signed ones
+CELL_TYPECODE = "q"
+# Shared by all untouched pages, it is never written: the first write copies the page
+ZERO_PAGE = array(CELL_TYPECODE, bytes(PAGE_SIZE * array(CELL_TYPECODE).itemsize))
+# Message of the IndexError raised by the former flat list memory, it ends up in the run log
+INDEX_ERROR_MESSAGE = "list index out of range"
+IO_CELLS = (INPUT_CELL_ADDRESS, OUTPUT_CELL_ADDRESS)
+
 
 class DataMemory:
-    def __init__(self, data: list[int], register_file: RegisterFile, io_controller: IOController) -> None:
-        # Initialize all cells with 0
-        self.cells = [0] * MAX_MEMORY_SIZE
+    """
+    Data memory split into pages of PAGE_SIZE cells.
+
+    Pages share the initial image (or ZERO_PAGE) until they are written to for the first time,
+    only then a page of its own is allocated. reset() restores the initial image in place.
+
+    The rows latching the memory go through the data cache if there is one (the io cells
+    bypass it), the cache charges the extra ticks of the access.
 
-        initial_data = [0, 0, *data]
-        # Truncate initial_data if it exceeds MAX_MEMORY_SIZE
-        if len(initial_data) > MAX_MEMORY_SIZE:
-            initial_data = initial_data[:MAX_MEMORY_SIZE]
+    >>> memory = DataMemory([5, 6], RegisterFile(), IOController(""))
+    >>> memory.write_cell(300, 7)
+    >>> memory.read_cell(300), memory.resident_pages
+    (7, 1)
+    >>> memory.reset()
+    >>> memory.read_cell(300), memory.read_cell(3), memory.read_cell(-MAX_MEMORY_SIZE)
+    (0, 6, 0)
+    """
 
-        # Set initial values for the first few cells
-        self.cells[: len(initial_data)] = initial_data
+    def __init__(
+        self,
+        data: Sequence[int],
+        register_file: RegisterFile,
+        io_controller: IOController,
+        cache: DataCache | None = None,
+    ) -> None:
+        # Initial image: cells 0 and 1 are the io cells, data starts at DATA_MEMORY_BEGIN_ADDRESS,
+        # whatever exceeds MAX_MEMORY_SIZE is truncated
+        initial_data = array(CELL_TYPECODE, [0, 0]) + array(CELL_TYPECODE, data[: MAX_MEMORY_SIZE - 2])
+        self.image: list[array] = [ZERO_PAGE] * PAGE_COUNT
+        for start in range(0, len(initial_data), PAGE_SIZE):
+            page = initial_data[start : start + PAGE_SIZE]
+            page.extend(ZERO_PAGE[len(page) :])
+            self.image[start >> PAGE_BITS] = page
+
+        self.pages = list(self.image)
+        self.owned = [False] * PAGE_COUNT
+        self.resident_pages = 0
         self.register_file = register_file
         self.io_controller = io_controller
+        self.cache = cache
+
+    def reset(self) -> None:
+        """Restore the initial image, allocated pages are kept and overwritten in place."""
+        for number, owned in enumerate(self.owned):
+            if owned:
+                self.pages[number][:] = self.image[number]
+
+    def stats(self) -> str:
+        return f"resident_pages={self.resident_pages}/{PAGE_COUNT}, page_size={PAGE_SIZE}"
+
+    def _check_index(self, index: int) -> int:
+        # Same indexing as the former flat list: negative indices count from the end
+        if -MAX_MEMORY_SIZE <= index < 0:
+            return index + MAX_MEMORY_SIZE
+        raise IndexError(INDEX_ERROR_MESSAGE)
 
     def read_cell(self, index: int) -> int:
         if index == 0:
-            logging.debug("Reading from 'in' buffer")
+            if self.io_controller.log_io:
+                logging.debug("Reading from 'in' buffer")
             return self.io_controller.read_from_buffer()
         if index == 1:
             logging.error("Unable to read from write-only cell")
             raise WriteOnlyCellError()
-        return self.cells[index]
+        if not 0 <= index < MAX_MEMORY_SIZE:
+            index = self._check_index(index)
+        return self.pages[index >> PAGE_BITS][index & PAGE_MASK]
 
     def write_cell(self, index: int, value: int) -> None:
         if index == 0:
             logging.error("Unable to write to read-only cell")
             raise ReadOnlyCellError()
         if index == 1:
-            logging.debug("Writing to 'out' buffer")
+            if self.io_controller.log_io:
+                logging.debug("Writing to 'out' buffer")
             self.io_controller.write_to_buffer(value)
-        self.cells[index] = value
+        if not 0 <= index < MAX_MEMORY_SIZE:
+            index = self._check_index(index)
+        number = index >> PAGE_BITS
+        if not self.owned[number]:
+            self.pages[number] = array(CELL_TYPECODE, self.pages[number])
+            self.owned[number] = True
+            self.resident_pages += 1
+        self.pages[number][index & PAGE_MASK] = value
 
     def latch_write_memory(self) -> None:
         left_out = self.register_file.left_out
         right_out = self.register_file.right_out
         self.write_cell(left_out, right_out)
+        if self.cache is not None and left_out not in IO_CELLS:
+            self.cache.write(left_out)
 
     def latch_read_memory(self) -> None:
         left_out = self.register_file.left_out
         self.memory_out = self.read_cell(left_out)
+        if self.cache is not None and left_out not in IO_CELLS:
+            self.cache.read(left_out)
+
+
+class DecodedInstruction(NamedTuple):
+    """Instruction word split into its fields (see the layout table in isa.py)."""
+
+    opcode: int
+    rb: int
+    r1: int
+    r2: int  # 16 bit field: register index, number or address
+    flag: int
+    operands: int  # 24 bit operands register value (rb, r1, r2)
+    decode_line: int | None  # First microprogram row, None if the opcode is unknown
+
+
+def decode_instruction(word: int) -> DecodedInstruction:
+    """
+    Split a 32 bit instruction word into its fields.
+
+    >>> decode_instruction(int("00000110011000100000000000000100", 2))
+    DecodedInstruction(opcode=3, rb=3, r1=1, r2=2, flag=0, operands=3211266, decode_line=5)
+    """
+    opcode = word >> 25
+    flag = word & 0b1
+    return DecodedInstruction(
+        opcode=opcode,
+        rb=(word >> 21) & 0b1111,
+        r1=(word >> 17) & 0b1111,
+        r2=(word >> 1) & 0xFFFF,
+        flag=flag,
+        operands=(word >> 1) & 0xFFFFFF,
+        decode_line=MicroProgramMemory.get_decode_line(opcode, flag),
+    )
 
 
 class InstructionMemory:
-    def __init__(self, cells: list[str]) -> None:
+    def __init__(self, cells: Sequence[int]) -> None:
         self.cells = cells
+        # Every word is decoded once here, so fetching only reads the decoded fields
+        self.decoded = [decode_instruction(cell) for cell in cells]
 
-    def read_cell(self, index: int) -> str:
+    def read_cell(self, index: int) -> int:
         return self.cells[index - 1]
+
+    def read_decoded(self, index: int) -> DecodedInstruction:
+        return self.decoded[index - 1]
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+from collections.abc import Sequence
 from enum import IntEnum, auto
 from typing import ClassVar
 
+from isa import Opcode
+
 
 class Signal(IntEnum):
     """Enum class representing signals."""
@@ -280,7 +283,96 @@ class MicroProgramMemory:
         [Signal.SEL_MPC_INC, Signal.LATCH_MPC],
     ]
 
+    # Mapping of (opcode, flag) to the first row of the instruction microprogram
+    _decode_lines: ClassVar[dict[tuple[int, int], int]] = {
+        (Opcode.NOP.code, 0): 3,
+        (Opcode.NOP.code, 1): 3,
+        (Opcode.HALT.code, 0): 4,
+        (Opcode.HALT.code, 1): 4,
+        (Opcode.ADD.code, 0): 5,
+        (Opcode.ADD.code, 1): 6,
+        (Opcode.SUB.code, 0): 8,
+        (Opcode.SUB.code, 1): 9,
+        (Opcode.MUL.code, 0): 11,
+        (Opcode.MUL.code, 1): 12,
+        (Opcode.AND.code, 0): 14,
+        (Opcode.AND.code, 1): 15,
+        (Opcode.LOAD_WORD.code, 0): 17,
+        (Opcode.LOAD_WORD.code, 1): 17,
+        (Opcode.WRITE_WORD.code, 0): 19,
+        (Opcode.WRITE_WORD.code, 1): 19,
+        (Opcode.BEQ.code, 0): 20,
+        (Opcode.BEQ.code, 1): 20,
+        (Opcode.BNE.code, 0): 24,
+        (Opcode.BNE.code, 1): 24,
+        (Opcode.BGT.code, 0): 28,
+        (Opcode.BGT.code, 1): 28,
+        (Opcode.BLT.code, 0): 32,
+        (Opcode.BLT.code, 1): 32,
+        (Opcode.JUMP.code, 0): 36,
+        (Opcode.JUMP.code, 1): 36,
+    }
+
     @staticmethod
     def get_microprogram(index: int) -> list[Signal]:
         """Retrieve microprogram for a given index."""
         return MicroProgramMemory._memory[index]
+
+    @staticmethod
+    def get_size() -> int:
+        """Retrieve the number of microprogram rows."""
+        return len(MicroProgramMemory._memory)
+
+    @staticmethod
+    def get_decode_lines() -> set[int]:
+        """Retrieve the rows the decoder can dispatch to."""
+        return set(MicroProgramMemory._decode_lines.values())
+
+    @staticmethod
+    def get_path(
+        start: int, neg_zero: int = 0, memory: Sequence[Sequence[Signal]] | None = None
+    ) -> tuple[list[int], bool]:
+        """
+        Follow the MPC from the given row until the microprogram returns to fetch (or dispatches).
+
+        Args:
+            start (int): Row the MPC points to.
+            neg_zero (int): NZ flags checked by SEL_TWICE_INC_IF_Z/N signals on the way.
+            memory (Sequence[Sequence[Signal]] | None): Rows of another microprogram memory.
+
+        Returns:
+            tuple[list[int], bool]: Executed rows and whether the path ends with HALT.
+        """
+        rows: list[int] = []
+        mpc = start
+        inc_value = 1
+        mpc_mux = None
+        while True:
+            program = MicroProgramMemory.get_microprogram(mpc) if memory is None else memory[mpc]
+            if Signal.HALT in program:
+                return rows, True
+            rows.append(mpc)
+            inc_value, mpc_mux = MicroProgramMemory._select_next_mpc(program, neg_zero, inc_value, mpc_mux)
+            if mpc_mux != Signal.SEL_MPC_INC:
+                return rows, False
+            mpc += inc_value
+
+    @staticmethod
+    def _select_next_mpc(
+        program: Sequence[Signal], neg_zero: int, inc_value: int, mpc_mux: Signal | None
+    ) -> tuple[int, Signal | None]:
+        """Apply the MPC increment and MPC mux selections of one row."""
+        for signal in program:
+            if signal == Signal.SEL_ONE_INC:
+                inc_value = 1
+            elif signal in (Signal.SEL_TWICE_INC_IF_Z, Signal.SEL_TWICE_INC_IF_N):
+                flag = 0b01 if signal == Signal.SEL_TWICE_INC_IF_Z else 0b10
+                inc_value = 2 if neg_zero == flag else 1
+            elif signal in (Signal.SEL_MPC_ZERO, Signal.SEL_MPC_IR, Signal.SEL_MPC_INC):
+                mpc_mux = signal
+        return inc_value, mpc_mux
+
+    @staticmethod
+    def get_decode_line(opcode: int, flag: int) -> int | None:
+        """Retrieve the first microprogram row for an opcode/flag pair, None if the opcode is unknown."""
+        return MicroProgramMemory._decode_lines.get((opcode, flag))
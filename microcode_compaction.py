@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+from collections.abc import Sequence
+from pathlib import Path
+from typing import NamedTuple
+
+from isa import Opcode
+from machine_exceptions import MicrocodeLayoutError
+from microcode import MicroProgramMemory, Signal
+
+# Relative to the directory of this module, not to the current one
+GOLDEN_FILES = "golden/*.yml"
+
+# Latched state: written at the end of a tick, so a signal of the same tick still reads the old value
+CLOCKED = frozenset({"pc", "mpc", "ir", "operands", "registers", "memory", "memory_out", "flags"})
+# Everything else is chosen for the tick (muxes, ALU operation, register file outputs, MPC increment)
+
+MPC_SIGNALS = frozenset({Signal.SEL_MPC_INC, Signal.SEL_MPC_ZERO, Signal.SEL_MPC_IR, Signal.LATCH_MPC})
+CONDITIONS = frozenset({Signal.SEL_TWICE_INC_IF_Z, Signal.SEL_TWICE_INC_IF_N})
+COMPARISONS = (Opcode.BEQ, Opcode.BNE, Opcode.BGT, Opcode.BLT)
+
+CONTROL_HALT = "halt"
+CONTROL_DISPATCH = "dispatch"  # SEL_MPC_IR, to the decode line of the fetched instruction
+CONTROL_FETCH = "fetch"  # SEL_MPC_ZERO, back to row 0
+CONTROL_NEXT = "next"  # SEL_MPC_INC, to the next row
+CONTROL_BRANCH = "branch"  # SEL_MPC_INC after SEL_TWICE_INC_IF_Z/N, to the next row or the one after it
+
+
+class Access(NamedTuple):
+    reads: frozenset[str]
+    writes: frozenset[str]
+
+
+def _access(reads: str = "", writes: str = "") -> Access:
+    return Access(frozenset(reads.split()), frozenset(writes.split()))
+
+
+REGISTER_INPUT = "data_src alu memory_out operands"
+SIGNAL_ACCESS: dict[Signal, Access] = {
+    Signal.HALT: _access(),
+    Signal.LATCH_IR: _access("pc", "ir"),
+    Signal.LATCH_OPERANDS: _access("pc", "operands"),
+    Signal.LATCH_PC: _access("pc pc_mux operands", "pc"),
+    Signal.LATCH_MPC: _access("mpc mpc_mux inc ir", "mpc"),
+    Signal.LATCH_READ_MEM: _access("left memory", "memory_out"),
+    Signal.LATCH_WRITE_MEM: _access("left right", "memory"),
+    Signal.LATCH_REG: _access(REGISTER_INPUT, "registers"),
+    Signal.SEL_REG_L: _access("registers operands ir", "left"),
+    Signal.SEL_REG_R: _access("registers operands ir", "right"),
+    Signal.SEL_ONE_INC: _access(writes="inc"),
+    **{signal: _access("flags", "inc") for signal in CONDITIONS},
+    **{
+        signal: _access("left right", "alu flags")
+        for signal in (Signal.ALU_ADD, Signal.ALU_SUB, Signal.ALU_MUL, Signal.ALU_AND)
+    },
+    **{signal: _access(writes="mpc_mux") for signal in (Signal.SEL_MPC_INC, Signal.SEL_MPC_ZERO, Signal.SEL_MPC_IR)},
+    **{signal: _access(writes="pc_mux") for signal in (Signal.SEL_PC_INC, Signal.SEL_PC_ADDR)},
+    **{signal: _access(writes="data_src") for signal in (Signal.SEL_SRC_MEM, Signal.SEL_SRC_ALU, Signal.SEL_SRC_CU)},
+    **{Signal(int(Signal.LATCH_REG0) + index): _access(REGISTER_INPUT, "registers") for index in range(16)},
+    **{Signal(int(Signal.SEL_L_REG0) + index): _access("registers", "left") for index in range(16)},
+    **{Signal(int(Signal.SEL_R_REG0) + index): _access("registers", "right") for index in range(16)},
+}
+
+
+def can_merge(first: Sequence[Signal], second: Sequence[Signal]) -> bool:
+    """
+    Whether the second row can run in the same tick as the first one, without its MPC selection.
+
+    The second row must not read or write the latched state the first one writes (it would get
+    the value from before the tick), and a mux, the ALU or the MPC increment can only be set one
+    way in a tick: the second row must not change one the first row sets or uses.
+
+    >>> can_merge([Signal.SEL_MPC_ZERO, Signal.LATCH_MPC], MicroProgramMemory.get_microprogram(0))
+    True
+    >>> can_merge(MicroProgramMemory.get_microprogram(0), MicroProgramMemory.get_microprogram(1))
+    False
+    """
+    first = [signal for signal in first if signal not in MPC_SIGNALS]
+    selections = {resource: signal for signal in first for resource in SIGNAL_ACCESS[signal].writes}
+    used = {resource for signal in first for resource in SIGNAL_ACCESS[signal].reads} - CLOCKED
+    for signal in second:
+        reads, writes = SIGNAL_ACCESS[signal]
+        if (reads | writes) & CLOCKED & selections.keys():
+            return False
+        for resource in writes - CLOCKED:
+            if selections.get(resource, signal) != signal or (resource in used and resource not in selections):
+                return False
+    return True
+
+
+def row_control(row: Sequence[Signal], index: int) -> str:
+    """
+    How the MPC leaves a row.
+
+    Raises:
+        MicrocodeLayoutError: If the row does not select the next MPC itself.
+    """
+    if Signal.HALT in row:
+        return CONTROL_HALT
+    if CONDITIONS.intersection(row):
+        return CONTROL_BRANCH
+    selections = [signal for signal in row if signal in MPC_SIGNALS and signal != Signal.LATCH_MPC]
+    if not selections:
+        raise MicrocodeLayoutError(index)
+    return {
+        Signal.SEL_MPC_IR: CONTROL_DISPATCH,
+        Signal.SEL_MPC_ZERO: CONTROL_FETCH,
+        Signal.SEL_MPC_INC: CONTROL_NEXT,
+    }[selections[-1]]
+
+
+class Row:
+    """A row of the compacted memory: original rows run in one tick, ending with the control of the last."""
+
+    def __init__(self, index: int, signals: Sequence[Signal]):
+        self.signals = list(signals)
+        self.rows = [index]  # Original rows
+        self.control = row_control(signals, index)
+        successors = {CONTROL_FETCH: (0,), CONTROL_NEXT: (index + 1,), CONTROL_BRANCH: (index + 1, index + 2)}
+        self.successors: tuple[int, ...] = successors.get(self.control, ())
+
+    def merge(self, row: Row) -> None:
+        self.signals = [signal for signal in self.signals if signal not in MPC_SIGNALS] + row.signals
+        self.rows += row.rows
+        self.control = row.control
+        self.successors = row.successors
+
+
+class MicrocodeTable(NamedTuple):
+    """A microprogram memory the ControlUnit can run instead of MicroProgramMemory."""
+
+    rows: tuple[tuple[Signal, ...], ...]
+    decode_lines: dict[tuple[int, int], int]  # (opcode, flag) to the first row
+    fetch_rows: frozenset[int]  # Rows an instruction fetch starts in
+    compare_lines: frozenset[int]  # Decode lines of the instructions whose SEL_REG_L/R pick rb/r1
+
+    @staticmethod
+    def standard() -> MicrocodeTable:
+        """The rows of MicroProgramMemory."""
+        decode_lines = {}
+        for opcode in Opcode:
+            for flag in (0, 1):
+                decode_lines[(opcode.code, flag)] = MicroProgramMemory.get_decode_line(opcode.code, flag)
+        rows = tuple(
+            tuple(MicroProgramMemory.get_microprogram(index)) for index in range(MicroProgramMemory.get_size())
+        )
+        compare_lines = frozenset(decode_lines[(opcode.code, flag)] for opcode in COMPARISONS for flag in (0, 1))
+        return MicrocodeTable(rows, decode_lines, frozenset({0}), compare_lines)
+
+    def decode_line(self, opcode: int, flag: int) -> int | None:
+        return self.decode_lines.get((opcode, flag))
+
+    def instruction_ticks(self, opcode: int, flag: int, neg_zero: int) -> tuple[int, bool]:
+        """
+        Ticks from the dispatch of an instruction to the dispatch of the next one.
+
+        Returns:
+            tuple[int, bool]: The ticks and whether the instruction branched.
+        """
+        rows, halts = MicroProgramMemory.get_path(self.decode_lines[(opcode, flag)], neg_zero, self.rows)
+        branched = any(Signal.SEL_PC_ADDR in self.rows[row] for row in rows)
+        if not halts and Signal.SEL_MPC_ZERO in self.rows[rows[-1]]:
+            rows += MicroProgramMemory.get_path(0, neg_zero, self.rows)[0]
+        return len(rows), branched
+
+
+def _merge_rows(rows: list[Row]) -> None:
+    # A row right after a conditional row can not be followed by its own next row
+    slots = {index + 1 for index, row in enumerate(rows) if row.control == CONTROL_BRANCH}
+    for index, row in enumerate(rows):
+        # The last row (a jmp leftover) is never reached, it would continue past the memory
+        while row.control in {CONTROL_FETCH, CONTROL_NEXT} and row.successors[0] < len(rows):
+            following = rows[row.successors[0]]
+            if following.control == CONTROL_HALT or following.rows[0] in row.rows:
+                break
+            if index in slots and following.control in {CONTROL_NEXT, CONTROL_BRANCH}:
+                break
+            if not can_merge(row.signals, following.signals):
+                break
+            row.merge(following)
+
+
+class _Layout:
+    """Places the merged rows so every MPC increment still reaches the right row, copying rows if needed."""
+
+    def __init__(self, rows: list[Row]):
+        self.rows = rows
+        self.memory: list[tuple[Signal, ...]] = []
+        self.fetch_rows: set[int] = set()
+
+    def place(self, index: int) -> int:
+        position = len(self.memory)
+        self._append(self.rows[index])
+        row = self.rows[index]
+        if row.control == CONTROL_NEXT:
+            self.place(row.successors[0])
+        elif row.control == CONTROL_BRANCH:
+            self._append(self.rows[row.successors[0]])
+            self.place(row.successors[1])
+        return position
+
+    def _append(self, row: Row) -> None:
+        if 0 in row.rows:
+            self.fetch_rows.add(len(self.memory))
+        self.memory.append(tuple(row.signals))
+
+
+def compact() -> MicrocodeTable:
+    """
+    Merge every row with the row it continues with, while both fit into one tick (see can_merge).
+
+    A row reached from several rows (row 0 above all) is copied into each of them, so the
+    instruction microprograms end by starting the fetch of the next instruction. The rows are
+    laid out again: row 0 first, then every decode line followed by the rows its increments reach.
+    """
+    standard = MicrocodeTable.standard()
+    rows = [Row(index, signals) for index, signals in enumerate(standard.rows)]
+    _merge_rows(rows)
+    layout = _Layout(rows)
+    layout.place(0)
+    positions = {line: layout.place(line) for line in sorted(set(standard.decode_lines.values()))}
+    decode_lines = {key: positions[line] for key, line in standard.decode_lines.items()}
+    compare_lines = frozenset(positions[line] for line in standard.compare_lines)
+    return MicrocodeTable(tuple(layout.memory), decode_lines, frozenset(layout.fetch_rows), compare_lines)
+
+
+def ticks_saved(table: MicrocodeTable) -> list[tuple[str, int, int]]:
+    """Ticks per instruction (dispatch to dispatch) with MicroProgramMemory and with the table, per variant."""
+    standard = MicrocodeTable.standard()
+    report = []
+    for opcode in Opcode:
+        for flag in (0, 1) if opcode.is_mathlog() else (0,):
+            outcomes = {}
+            for neg_zero in (0, 1, 2):
+                before, branched = standard.instruction_ticks(opcode.code, flag, neg_zero)
+                after, _ = table.instruction_ticks(opcode.code, flag, neg_zero)
+                outcomes[branched] = (before, after)
+            for branched, (before, after) in outcomes.items():
+                name = opcode.mnemonic + (" #imm" if flag else "")
+                if len(outcomes) > 1:
+                    name += " taken" if branched else " not taken"
+                report.append((name, before, after))
+    return report
+
+
+class Verification(NamedTuple):
+    name: str
+    ticks: int
+    compacted_ticks: int
+    identical: bool
+
+
+def verify(table: MicrocodeTable, goldens: str = GOLDEN_FILES) -> list[Verification]:
+    """
+    Run every golden program with MicroProgramMemory and with the table and compare the results.
+
+    The output, stop reason, registers, data memory and executed instructions must be the same.
+    The goldens pattern is relative to the directory of this module.
+    """
+    # Imported here, the machine imports the ControlUnit which takes the table
+    import machine
+    import translator
+    from ruamel.yaml import YAML
+
+    results = []
+    for golden_file in sorted(Path(__file__).parent.glob(goldens)):
+        with open(golden_file, encoding="utf-8") as file:
+            golden = YAML(typ="safe").load(file)
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "source.rasm")
+            with open(source, "w", encoding="utf-8") as file:
+                file.write(golden["in_source"])
+            with contextlib.redirect_stdout(io.StringIO()):
+                translator.main(source, os.path.join(directory, "program.o"))
+            program = machine.load_program(os.path.join(directory, "program.o"), None)
+        input_str = "".join(golden["in_stdin"].splitlines()[:1])
+        runs = []
+        for microcode in (None, table):
+            result = machine.run_simulation(
+                program.code, program.data, input_str, interpreted=True, entry=program.entry, microcode=microcode
+            )
+            state = (
+                result.output,
+                result.stop_reason,
+                result.registers,
+                [page.tolist() for page in result.control_unit.datapath.data_memory.pages],
+                result.instructions,
+            )
+            runs.append((state, result.ticks))
+        (state, ticks), (compacted_state, compacted_ticks) = runs
+        results.append(Verification(golden_file.name, ticks, compacted_ticks, state == compacted_state))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge microprogram rows which fit into one tick")
+    parser.add_argument(
+        "--goldens",
+        default=GOLDEN_FILES,
+        help="golden cases run with both microprogram memories, relative to this module",
+    )
+    parser.add_argument("--table", action="store_true", help="print the compacted rows")
+    args = parser.parse_args()
+
+    table = compact()
+    if args.table:
+        for index, row in enumerate(table.rows):
+            print(f"{index:>3} {', '.join(signal.name for signal in row)}")
+    print(f"rows: {MicroProgramMemory.get_size()} -> {len(table.rows)}")
+    print(f"{'instruction':<16} {'ticks':>6} {'compacted':>10} {'saved':>6}")
+    for name, before, after in ticks_saved(table):
+        print(f"{name:<16} {before:>6} {after:>10} {before - after:>6}")
+    print(f"{'golden':<16} {'ticks':>6} {'compacted':>10} {'same':>6}")
+    for result in verify(table, args.goldens):
+        print(f"{result.name:<16} {result.ticks:>6} {result.compacted_ticks:>10} {result.identical!s:>6}")
@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+from functools import cache
+from typing import Callable
+
+from alu import MAX_NUMBER, MIN_NUMBER
+from machine_exceptions import InvalidOpcodeError
+from microcode import MicroProgramMemory, Signal
+
+L_SIGNALS = tuple(Signal(int(Signal.SEL_L_REG0) + index) for index in range(16))
+R_SIGNALS = tuple(Signal(int(Signal.SEL_R_REG0) + index) for index in range(16))
+
+ALU_OPERATORS = {
+    Signal.ALU_ADD: "+",
+    Signal.ALU_SUB: "-",
+    Signal.ALU_MUL: "*",
+    Signal.ALU_AND: "&",
+}
+
+DATA_SOURCES = {
+    Signal.SEL_SRC_MEM: "dp.data_memory.memory_out",
+    Signal.SEL_SRC_ALU: "alu.alu_result",
+    Signal.SEL_SRC_CU: "dp.cu_data_out",
+}
+
+# Decode lines whose microprograms compare rb with r1 (SEL_REG_L/SEL_REG_R pick rb/r1 instead of r1/r2)
+BRANCH_DECODE_LINES = range(20, 33)
+
+
+class MicroprogramCompiler:
+    """
+    Translates one row of the microprogram memory into the source of a Python function.
+
+    The compiler walks the signals in the same order as ControlUnit._execute_signal and
+    keeps track of the multiplexers selected earlier in the row, so latches are emitted
+    with the chosen input already resolved. Muxes which were not selected in the row are
+    read at runtime, exactly like the interpreter does.
+    """
+
+    def __init__(self, index: int, program: list[Signal], branch_row: bool):
+        self.index = index
+        self.program = program
+        self.branch_row = branch_row
+        self.lines: list[str] = []
+
+        self.mpc_mux: Signal | None = None
+        self.pc_mux: Signal | None = None
+        self.data_src_mux: Signal | None = None
+        self.inc_value: str | None = None
+        self.fetched = False
+
+        self.emitters: dict[Signal, Callable[[Signal], None]] = {
+            Signal.HALT: self._emit_halt,
+            Signal.LATCH_IR: self._emit_latch_ir,
+            Signal.LATCH_OPERANDS: self._emit_latch_operands,
+            Signal.LATCH_PC: self._emit_latch_pc,
+            Signal.LATCH_MPC: self._emit_latch_mpc,
+            Signal.LATCH_READ_MEM: self._emit_call("dp.data_memory.latch_read_memory()"),
+            Signal.LATCH_WRITE_MEM: self._emit_call("dp.data_memory.latch_write_memory()"),
+            Signal.LATCH_REG: self._emit_latch_reg,
+            Signal.SEL_REG_L: self._emit_sel_reg_l,
+            Signal.SEL_REG_R: self._emit_sel_reg_r,
+            Signal.SEL_ONE_INC: self._emit_one_inc,
+            Signal.SEL_TWICE_INC_IF_Z: self._emit_twice_inc(1),
+            Signal.SEL_TWICE_INC_IF_N: self._emit_twice_inc(2),
+        }
+        for signal in ALU_OPERATORS:
+            self.emitters[signal] = self._emit_alu
+        for signal in (Signal.SEL_MPC_INC, Signal.SEL_MPC_ZERO, Signal.SEL_MPC_IR):
+            self.emitters[signal] = self._emit_sel_mpc
+        for signal in (Signal.SEL_PC_INC, Signal.SEL_PC_ADDR):
+            self.emitters[signal] = self._emit_sel_pc
+        for signal in DATA_SOURCES:
+            self.emitters[signal] = self._emit_sel_src
+        # LATCH_REG1, SEL_L_REG1 and SEL_R_REG1 are not handled by the interpreter either
+        for index in (0, *range(2, 16)):
+            self.emitters[Signal(int(Signal.LATCH_REG0) + index)] = self._emit_latch_reg_n
+            self.emitters[L_SIGNALS[index]] = self._emit_sel_l_reg_n
+            self.emitters[R_SIGNALS[index]] = self._emit_sel_r_reg_n
+
+    def build(self) -> str:
+        """
+        Build the source of the function executing the whole row in one call.
+
+        Returns:
+            str: Source code of a function `mp_<index>(cu)`, returning the number of executed signals.
+        """
+        self.lines = []
+        for signal in self.program:
+            emit = self.emitters.get(signal)
+            if emit is not None:
+                emit(signal)
+            if signal == Signal.HALT:
+                break
+        else:
+            self.lines.append("cu.tick_counter += 1")
+            self.lines.append(f"return {len(self.program)}")
+
+        header = [
+            f"def mp_{self.index}(cu):",
+            "    dp = cu.datapath",
+            "    rf = dp.register_file",
+            "    alu = cu.alu",
+        ]
+        return "\n".join(header + ["    " + line for line in self.lines]) + "\n"
+
+    def _emit_call(self, call: str) -> Callable[[Signal], None]:
+        return lambda _: self.lines.append(call)
+
+    def _emit_halt(self, _: Signal) -> None:
+        self.lines.append('raise StopIteration("HALT")')
+
+    def _emit_alu(self, signal: Signal) -> None:
+        self.lines += [
+            f"alu.alu_signal = S.{signal.name}",
+            f"result = rf.left_out {ALU_OPERATORS[signal]} rf.right_out",
+            "if result > MAX_NUMBER:",
+            "    result %= MAX_NUMBER",
+            "elif result < MIN_NUMBER:",
+            "    result %= -MIN_NUMBER",
+            "alu.alu_result = result",
+            "alu.neg_zero = 1 if result == 0 else 2 if result < 0 else 0",
+        ]
+
+    def _fetch(self) -> None:
+        if not self.fetched:
+            self.lines.append("instruction = dp.instruction_memory.read_decoded(dp.pc)")
+            self.fetched = True
+
+    def _emit_latch_ir(self, _: Signal) -> None:
+        self._fetch()
+        self.lines += [
+            "if instruction.decode_line is None:",
+            "    raise InvalidOpcodeError(instruction.opcode)",
+            "cu.decode_line = cu.ir = instruction.decode_line",
+        ]
+
+    def _emit_latch_operands(self, _: Signal) -> None:
+        self._fetch()
+        self.lines += [
+            "cu.operands = instruction.operands",
+            "cu.instruction = instruction",
+            "dp.cu_data_out = dp.cu_address_out = instruction.r2",
+        ]
+
+    def _emit_latch_pc(self, _: Signal) -> None:
+        self.fetched = False
+        if self.pc_mux == Signal.SEL_PC_INC:
+            self.lines.append("dp.pc += 1")
+        elif self.pc_mux == Signal.SEL_PC_ADDR:
+            self.lines.append("dp.pc = dp.cu_address_out")
+        else:
+            self.lines.append("dp.latch_pc()")
+
+    def _emit_latch_mpc(self, _: Signal) -> None:
+        if self.mpc_mux == Signal.SEL_MPC_INC:
+            self.lines.append(f"cu.mpc += {self.inc_value or 'cu.inc_value'}")
+        elif self.mpc_mux == Signal.SEL_MPC_IR:
+            self.lines.append("cu.mpc = cu.ir")
+        elif self.mpc_mux == Signal.SEL_MPC_ZERO:
+            self.lines.append("cu.mpc = 0")
+        else:
+            self.lines.append("cu.latch_mpc()")
+
+    def _register_file_input(self) -> str:
+        if self.data_src_mux is None:
+            return "dp.get_register_file_input()"
+        return DATA_SOURCES[self.data_src_mux]
+
+    def _emit_latch_reg(self, _: Signal) -> None:
+        self.lines.append(f"rf.latch_reg_n(cu.instruction.rb, {self._register_file_input()})")
+
+    def _emit_latch_reg_n(self, signal: Signal) -> None:
+        index = int(signal) - int(Signal.LATCH_REG0)
+        if index == 0:
+            self.lines.append(f"rf.latch_reg_n(0, {self._register_file_input()})")
+        else:
+            self.lines.append(f"rf.registers[{index}] = {self._register_file_input()}")
+
+    def _emit_sel_reg_l(self, _: Signal) -> None:
+        operand = "rb" if self.branch_row else "r1"
+        self.lines += [
+            f"index = cu.instruction.{operand}",
+            "rf.mux_left_out = L_SIGNALS[index]",
+            "rf.left_out = rf.registers[index]",
+        ]
+
+    def _emit_sel_reg_r(self, _: Signal) -> None:
+        operand = "r1" if self.branch_row else "r2"
+        self.lines += [
+            f"index = cu.instruction.{operand}",
+            "rf.mux_right_out = R_SIGNALS[index]",
+            "rf.right_out = rf.registers[index]",
+        ]
+
+    def _emit_sel_l_reg_n(self, signal: Signal) -> None:
+        index = int(signal) - int(Signal.SEL_L_REG0)
+        self.lines += [f"rf.mux_left_out = S.{signal.name}", f"rf.left_out = rf.registers[{index}]"]
+
+    def _emit_sel_r_reg_n(self, signal: Signal) -> None:
+        index = int(signal) - int(Signal.SEL_R_REG0)
+        self.lines += [f"rf.mux_right_out = S.{signal.name}", f"rf.right_out = rf.registers[{index}]"]
+
+    def _emit_sel_mpc(self, signal: Signal) -> None:
+        self.mpc_mux = signal
+        self.lines.append(f"cu.mpc_mux = S.{signal.name}")
+
+    def _emit_sel_pc(self, signal: Signal) -> None:
+        self.pc_mux = signal
+        self.lines.append(f"dp.pc_mux = S.{signal.name}")
+
+    def _emit_sel_src(self, signal: Signal) -> None:
+        self.data_src_mux = signal
+        self.lines.append(f"dp.data_src_mux = S.{signal.name}")
+
+    def _emit_one_inc(self, _: Signal) -> None:
+        self.inc_value = "1"
+        self.lines.append("cu.inc_value = 1")
+
+    def _emit_twice_inc(self, flag: int) -> Callable[[Signal], None]:
+        def emit(_: Signal) -> None:
+            self.inc_value = "inc_value"
+            self.lines += [f"inc_value = 2 if alu.neg_zero == {flag} else 1", "cu.inc_value = inc_value"]
+
+        return emit
+
+
+def _owner_decode_line(index: int) -> int | None:
+    """Find the decode line of the instruction microprogram the row belongs to (None for fetch rows)."""
+    owners = [line for line in MicroProgramMemory.get_decode_lines() if line <= index]
+    return max(owners, default=None)
+
+
+def compile_microprogram_source() -> str:
+    """Generate the source code of all microprogram memory rows."""
+    functions = []
+    for index in range(MicroProgramMemory.get_size()):
+        program = MicroProgramMemory.get_microprogram(index)
+        owner = _owner_decode_line(index)
+        branch_row = owner is not None and owner in BRANCH_DECODE_LINES
+        functions.append(MicroprogramCompiler(index, program, branch_row).build())
+    return "\n\n".join(functions)
+
+
+@cache
+def compile_microprogram_memory() -> tuple[Callable, ...]:
+    """
+    Compile every microprogram memory row into a single callable.
+
+    Each callable takes the ControlUnit, executes the whole row, increments the tick
+    counter and returns the number of signals in the row, like ControlUnit.run_microprogram.
+    The result is cached, so the compilation runs once per process.
+
+    Returns:
+        tuple[Callable, ...]: Compiled rows indexed by MPC.
+    """
+    namespace = {
+        "S": Signal,
+        "L_SIGNALS": L_SIGNALS,
+        "R_SIGNALS": R_SIGNALS,
+        "MAX_NUMBER": MAX_NUMBER,
+        "MIN_NUMBER": MIN_NUMBER,
+        "InvalidOpcodeError": InvalidOpcodeError,
+    }
+    exec(compile(compile_microprogram_source(), "<microcode>", "exec"), namespace)
+    return tuple(namespace[f"mp_{index}"] for index in range(MicroProgramMemory.get_size()))
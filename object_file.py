@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from machine_exceptions import InvalidObjectFileError
+
+# Object file layout (all fields little-endian):
+# | Header                                                               | Code        | Data        | Symbols |
+# | magic (4s) | version (H) | reserved (H) | code size (I) | data size (I) | entry (I) | symbol count (I) |
+# | code size * 32 bit words | data size * 32 bit words | symbol count * (section (B), address (I), name length (H), name) |
+MAGIC = b"RISC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIII")
+SYMBOL = struct.Struct("<BIH")
+WORD_SIZE = 4
+
+SECTION_TEXT = 0
+SECTION_DATA = 1
+
+
+class Symbol(NamedTuple):
+    name: str
+    section: int  # SECTION_TEXT or SECTION_DATA
+    address: int
+
+
+class ObjectFile(NamedTuple):
+    code: array  # Instruction words
+    data: array  # Initial data memory words, starting at DATA_MEMORY_BEGIN_ADDRESS
+    entry: int  # Initial PC
+    symbols: list[Symbol]
+
+
+def _words(values: Iterable[int]) -> array:
+    # "I" is 4 bytes wide on every platform CPython supports
+    return array("I", values)
+
+
+def _to_little_endian(words: array) -> bytes:
+    if sys.byteorder == "big":
+        words = array(words.typecode, words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def _read_words(buffer: mmap.mmap, offset: int, count: int) -> array:
+    words = _words([])
+    words.frombytes(buffer[offset : offset + count * WORD_SIZE])
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+def write_object(
+    filename: str,
+    code: Iterable[int],
+    data: Iterable[int],
+    entry: int = 0,
+    symbols: Iterable[Symbol] = (),
+) -> None:
+    """
+    Write a program into the packed object format.
+
+    Args:
+        filename (str): Output file.
+        code (Iterable[int]): Instruction words.
+        data (Iterable[int]): Data words.
+        entry (int): Initial PC.
+        symbols (Iterable[Symbol]): Labels of the program.
+    """
+    code_words = _words(code)
+    data_words = _words(data)
+    symbols = list(symbols)
+    with open(filename, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, 0, len(code_words), len(data_words), entry, len(symbols)))
+        file.write(_to_little_endian(code_words))
+        file.write(_to_little_endian(data_words))
+        for symbol in symbols:
+            name = symbol.name.encode("utf-8")
+            file.write(SYMBOL.pack(symbol.section, symbol.address, len(name)))
+            file.write(name)
+
+
+def is_object_file(filename: str) -> bool:
+    """Check whether the file starts with the object file magic."""
+    with open(filename, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def _read_symbols(buffer: mmap.mmap, offset: int, count: int) -> list[Symbol]:
+    symbols = []
+    for _ in range(count):
+        section, address, length = SYMBOL.unpack_from(buffer, offset)
+        offset += SYMBOL.size
+        symbols.append(Symbol(str(buffer[offset : offset + length], "utf-8"), section, address))
+        offset += length
+    return symbols
+
+
+def read_object(filename: str) -> ObjectFile:
+    """
+    Load an object file by memory-mapping it, the words are copied into arrays without any parsing.
+
+    Raises:
+        InvalidObjectFileError: If the file is not an object file of a supported version or is truncated.
+    """
+    with open(filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size < HEADER.size:
+            raise InvalidObjectFileError(filename)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return _parse_object(filename, buffer)
+
+
+def _parse_object(filename: str, buffer: mmap.mmap) -> ObjectFile:
+    magic, version, _, code_size, data_size, entry, symbol_count = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise InvalidObjectFileError(filename)
+    code_offset = HEADER.size
+    data_offset = code_offset + code_size * WORD_SIZE
+    symbols_offset = data_offset + data_size * WORD_SIZE
+    if len(buffer) < symbols_offset:
+        raise InvalidObjectFileError(filename)
+    try:
+        symbols = _read_symbols(buffer, symbols_offset, symbol_count)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise InvalidObjectFileError(filename) from e
+    return ObjectFile(
+        _read_words(buffer, code_offset, code_size),
+        _read_words(buffer, data_offset, data_size),
+        entry,
+        symbols,
+    )
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+from collections import Counter
+from collections.abc import Callable
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from isa import Opcode
+from translator_token import Token, TokenType
+
+if TYPE_CHECKING:
+    from benchmark import Workload
+
+IMMEDIATE_MASK = 0xFFFF  # Width of the immediate field, see translator.create_binary_command
+# Flag-1 math loads its immediate into R15 first, removing or rewriting it changes R15
+SCRATCH_REGISTER = 15
+UNCONDITIONAL = {Opcode.JUMP.mnemonic, Opcode.HALT.mnemonic}
+BRANCHES = {opcode.mnemonic for opcode in Opcode if opcode.is_branch()}
+
+CHANGE_NOP = "nop removed"
+CHANGE_THREADED = "jump threaded"
+CHANGE_NEXT = "branch to next removed"
+CHANGE_UNREACHABLE = "unreachable removed"
+CHANGE_FOLDED = "move folded"
+CHANGE_IDENTITY = "identity removed"
+
+
+def _instruction_index(tokens: list[Token]) -> int:
+    for i, token in enumerate(tokens):
+        if token.get_type() == TokenType.INSTRUCTION:
+            return i
+    return -1
+
+
+def register_token(number: int) -> Token:
+    return Token(TokenType.REGISTER, str(number))
+
+
+def render(tokens: list[Token]) -> str:
+    """
+    Source text of a rewritten line, shown in the listing.
+
+    >>> render([Token(TokenType.LABEL, "loop"), Token(TokenType.INSTRUCTION, "add"), register_token(1), register_token(0)])
+    'loop: add r1, r0'
+    """
+    prefix = {TokenType.REGISTER: "r", TokenType.NUMBER: "#"}
+    words = [f"{prefix.get(token.get_type(), '')}{token.get_value()}" for token in tokens]
+    i = _instruction_index(tokens)
+    if i < 0:
+        return " ".join(f"{word}:" for word in words)
+    labels = [f"{word}: " for word in words[:i]]
+    return f"{''.join(labels)}{words[i]} {', '.join(words[i + 1 :])}".rstrip()
+
+
+class Program:
+    """
+    Tokenized source lines being optimized, with the source text of every line kept in step.
+
+    An instruction is removed by dropping its tokens from the line, a label defined on the same
+    line stays as a label-only line, so get_text_labels_mapping gives it the address of the
+    next instruction.
+    """
+
+    def __init__(self, code: list[str], tokenized: list[list[Token]], data_labels: dict[str, int]):
+        self.code = list(code)
+        self.tokens = [list(tokens) for tokens in tokenized]
+        self.data_labels = data_labels
+        self.changes: Counter[str] = Counter()
+
+    def text_lines(self) -> list[int]:
+        """Indexes of the lines of the text sections, a section line is -1 (a barrier for the passes)."""
+        lines = []
+        section = None
+        for i, tokens in enumerate(self.tokens):
+            if tokens and tokens[0].get_type() == TokenType.SECTION:
+                section = tokens[0].get_value()
+                lines.append(-1)
+            elif section == "text":
+                lines.append(i)
+        return lines
+
+    def instruction(self, line: int) -> tuple[str, list[Token]] | None:
+        """Mnemonic and arguments of the instruction on a line."""
+        tokens = self.tokens[line]
+        i = _instruction_index(tokens)
+        if i < 0:
+            return None
+        return tokens[i].get_string_value(), tokens[i + 1 :]
+
+    def label(self, line: int) -> str | None:
+        tokens = self.tokens[line]
+        if tokens and tokens[0].get_type() == TokenType.LABEL:
+            return tokens[0].get_string_value()
+        return None
+
+    def replace(self, line: int, arguments: list[Token] | None, change: str, mnemonic: str | None = None) -> None:
+        """Replace the arguments (and mnemonic) of the instruction on a line, or remove the instruction (None)."""
+        tokens = self.tokens[line]
+        i = _instruction_index(tokens)
+        instruction = tokens[i] if mnemonic is None else Token(TokenType.INSTRUCTION, mnemonic)
+        self.tokens[line] = tokens[:i] if arguments is None else [*tokens[:i], instruction, *arguments]
+        self.code[line] = render(self.tokens[line])
+        self.changes[change] += 1
+
+    def insert(self, line: int, tokens: list[Token]) -> None:
+        """Insert a new line before a line."""
+        self.tokens.insert(line, tokens)
+        self.code.insert(line, render(tokens))
+
+    def result(self) -> tuple[list[str], list[list[Token]]]:
+        """Source lines and tokenized lines, without the lines left empty."""
+        # Lines left without tokens would still take an address in get_text_labels_mapping
+        kept = [i for i, tokens in enumerate(self.tokens) if tokens]
+        return [self.code[i] for i in kept], [self.tokens[i] for i in kept]
+
+    def referenced_labels(self) -> set[str]:
+        labels = set()
+        for line in range(len(self.tokens)):
+            instruction = self.instruction(line)
+            if instruction is not None and instruction[0] in BRANCHES:
+                labels.update(
+                    token.get_string_value() for token in instruction[1] if token.get_type() == TokenType.LABEL
+                )
+        return labels
+
+    def uses_scratch_register(self) -> bool:
+        return any(
+            token.get_type() == TokenType.REGISTER and token.get_string_value() == str(SCRATCH_REGISTER)
+            for tokens in self.tokens
+            for token in tokens
+        )
+
+
+def remove_nops(program: Program) -> None:
+    for line in program.text_lines():
+        instruction = program.instruction(line) if line >= 0 else None
+        if instruction is not None and instruction[0] == Opcode.NOP.mnemonic:
+            program.replace(line, None, CHANGE_NOP)
+
+
+def immediate_value(program: Program, token: Token) -> int | None:
+    if token.get_type() == TokenType.NUMBER:
+        return token.get_int_value() & IMMEDIATE_MASK
+    if token.get_type() == TokenType.LABEL and token.get_string_value() in program.data_labels:
+        return program.data_labels[token.get_string_value()] & IMMEDIATE_MASK
+    return None
+
+
+def _fold(mnemonic: str, rb: int, r1: int, operand: Token, immediate: int | None) -> list[Token] | None:
+    """
+    Cheaper arguments for a math instruction computing a copy of r1 or zero, rewritten as add.
+
+    Returns:
+        list[Token] | None: "rb, r1, r0" for a copy, "rb, r0, r0" for zero, None if there is nothing to fold.
+    """
+    zero_register = operand.get_type() == TokenType.REGISTER and operand.get_int_value() == 0
+    if immediate == 0 or zero_register:
+        source = 0 if mnemonic in {Opcode.MUL.mnemonic, Opcode.AND.mnemonic} else r1
+    elif immediate == 1 and mnemonic == Opcode.MUL.mnemonic:
+        source = r1
+    else:
+        return None
+    return [register_token(rb), register_token(source), register_token(0)]
+
+
+def _math_arguments(program: Program, line: int) -> tuple[str, int, int, Token] | None:
+    """Mnemonic, rb, r1 and the last operand of a math instruction writing a register other than r0."""
+    instruction = program.instruction(line) if line >= 0 else None
+    if instruction is None or not Opcode.get_opcode_by_mnemonic(instruction[0]).is_mathlog():
+        return None
+    if len(instruction[1]) != 3:
+        return None
+    rb, r1, operand = instruction[1]
+    if rb.get_type() != TokenType.REGISTER or r1.get_type() != TokenType.REGISTER or rb.get_int_value() == 0:
+        return None
+    return instruction[0], rb.get_int_value(), r1.get_int_value(), operand
+
+
+def fold_moves(program: Program) -> None:
+    """
+    Fold math with a neutral operand (x + 0, x - 0, x * 1) or a zero result (x * 0, x & 0): a copy
+    of a register into itself is removed, the other ones become "add rb, r1, r0", which has no
+    immediate and so takes one microprogram row less. Skipped when the program uses R15.
+    """
+    if program.uses_scratch_register():
+        return
+    for line in program.text_lines():
+        arguments = _math_arguments(program, line)
+        if arguments is None:
+            continue
+        mnemonic, rb, r1, operand = arguments
+        folded = _fold(mnemonic, rb, r1, operand, immediate_value(program, operand))
+        if folded is None:
+            continue
+        if folded[0].get_value() == folded[1].get_value():
+            program.replace(line, None, CHANGE_IDENTITY)
+        elif operand.get_type() != TokenType.REGISTER:
+            program.replace(line, folded, CHANGE_FOLDED, Opcode.ADD.mnemonic)
+
+
+def label_targets(program: Program, lines: list[int]) -> dict[str, int]:
+    """Position (in lines) of the instruction every text label points to."""
+    targets = {}
+    pending: list[str] = []
+    for position, line in enumerate(lines):
+        if line < 0:
+            pending = []
+            continue
+        label = program.label(line)
+        if label is not None:
+            pending.append(label)
+        if program.instruction(line) is not None:
+            targets.update((label, position) for label in pending)
+            pending = []
+    return targets
+
+
+def _branch_label(arguments: list[Token]) -> bool:
+    return bool(arguments) and arguments[-1].get_type() == TokenType.LABEL
+
+
+def _next_instruction(program: Program, lines: list[int], position: int) -> int | None:
+    for following in range(position + 1, len(lines)):
+        if lines[following] < 0:
+            return None
+        if program.instruction(lines[following]) is not None:
+            return following
+    return None
+
+
+def thread_jumps(program: Program) -> None:
+    """Make branches to a jmp go straight to the final target of the jump chain."""
+    lines = program.text_lines()
+    targets = label_targets(program, lines)
+    for line in lines:
+        instruction = program.instruction(line) if line >= 0 else None
+        if instruction is None or instruction[0] not in BRANCHES or not _branch_label(instruction[1]):
+            continue
+        arguments = instruction[1]
+        label = arguments[-1].get_string_value()
+        seen = {label}
+        while label in targets:
+            target = program.instruction(lines[targets[label]])
+            if target is None or target[0] != Opcode.JUMP.mnemonic or len(target[1]) != 1:
+                break
+            following = target[1][0].get_string_value()
+            if following in seen:
+                break
+            seen.add(following)
+            label = following
+        if label != arguments[-1].get_string_value():
+            program.replace(line, [*arguments[:-1], Token(TokenType.LABEL, label)], CHANGE_THREADED)
+
+
+def remove_branches_to_next(program: Program) -> None:
+    """Remove branches whose target is the next instruction, both ways go to the same place."""
+    lines = program.text_lines()
+    targets = label_targets(program, lines)
+    for position, line in enumerate(lines):
+        instruction = program.instruction(line) if line >= 0 else None
+        if instruction is None or instruction[0] not in BRANCHES or not _branch_label(instruction[1]):
+            continue
+        following = _next_instruction(program, lines, position)
+        if following is not None and targets.get(instruction[1][-1].get_string_value()) == following:
+            program.replace(line, None, CHANGE_NEXT)
+
+
+def remove_unreachable(program: Program) -> None:
+    """Remove the instructions after a jmp or halt, up to the next label a branch points to."""
+    referenced = program.referenced_labels()
+    unreachable = False
+    for line in program.text_lines():
+        if line < 0 or program.label(line) in referenced:
+            unreachable = False
+        instruction = program.instruction(line) if line >= 0 else None
+        if instruction is None:
+            continue
+        if unreachable:
+            program.replace(line, None, CHANGE_UNREACHABLE)
+        elif instruction[0] in UNCONDITIONAL:
+            unreachable = True
+
+
+PASSES: tuple[Callable[[Program], None], ...] = (
+    remove_nops,
+    fold_moves,
+    thread_jumps,
+    remove_branches_to_next,
+    remove_unreachable,
+)
+
+
+def optimize(
+    code: list[str], tokenized: list[list[Token]], data_labels: dict[str, int]
+) -> tuple[list[str], list[list[Token]], Counter[str]]:
+    """
+    Peephole optimization of the tokenized program, run until nothing changes.
+
+    Args:
+        code (list[str]): Source lines, in step with the tokenized lines.
+        tokenized (list[list[Token]]): Tokenized lines.
+        data_labels (dict[str, int]): Data label addresses, labels used as immediates.
+
+    Returns:
+        tuple[list[str], list[list[Token]], Counter[str]]: Source lines (rewritten ones rendered
+            from their tokens), tokenized lines and the number of changes of every kind.
+    """
+    program = Program(code, tokenized, data_labels)
+    total = -1
+    while total != program.changes.total():
+        total = program.changes.total()
+        for optimization in PASSES:
+            optimization(program)
+    return (*program.result(), program.changes)
+
+
+def measure(workload: Workload, directory: str, **optimizations: bool) -> tuple[int, list[int]]:
+    """Ticks and output of a benchmark workload translated with the optimizations (translator.main flags)."""
+    # Imported here, the translator imports this module
+    import machine
+    import translator
+    from benchmark import BENCHMARK_TICK_LIMIT
+
+    source = os.path.join(directory, f"{workload.name}.rasm")
+    target = os.path.join(directory, f"{workload.name}.o")
+    Path(source).write_text(workload.source, encoding="utf-8")
+    with contextlib.redirect_stdout(io.StringIO()):
+        translator.main(source, target, **optimizations)
+    program = machine.load_program(target, None)
+    result = machine.run_simulation(
+        program.code, program.data, workload.input_str, entry=program.entry, tick_limit=BENCHMARK_TICK_LIMIT
+    )
+    return result.ticks, result.output
+
+
+if __name__ == "__main__":
+    import logging
+
+    import benchmark
+
+    parser = argparse.ArgumentParser(description="Ticks saved by the optimizations")
+    parser.add_argument("--scale", type=float, default=0.1, help="size factor of the synthetic workloads")
+    parser.add_argument("--dataflow", action="store_true", help="measure dataflow.py too")
+    args = parser.parse_args()
+    optimizations = {"optimize": True, "dataflow": args.dataflow}
+
+    logging.disable(logging.CRITICAL)
+    print(f"{'program':<12} {'ticks':>10} {'optimized':>10} {'saved':>8}  output")
+    with tempfile.TemporaryDirectory() as directory:
+        for workload in benchmark.example_workloads() + benchmark.synthetic_workloads(args.scale):
+            ticks, output = measure(workload, directory)
+            optimized_ticks, optimized_output = measure(workload, directory, **optimizations)
+            same = "same" if output == optimized_output else "DIFFERENT"
+            print(f"{workload.name:<12} {ticks:>10} {optimized_ticks:>10} {ticks - optimized_ticks:>8}  {same}")
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from control_unit import ControlUnit
+from instruction_engine import InstructionEngine
+from isa import Opcode
+from memory import DecodedInstruction
+
+REGISTER_COUNT = 16
+SCRATCH_REGISTER = 15  # Loaded with the immediate by the flag-1 math microprograms
+MATH = {Opcode.ADD.code, Opcode.SUB.code, Opcode.MUL.code, Opcode.AND.code}
+CONDITIONAL_BRANCHES = {Opcode.BEQ.code, Opcode.BNE.code, Opcode.BGT.code, Opcode.BLT.code}
+
+
+def register_reads(instruction: DecodedInstruction) -> tuple[int, ...]:
+    """
+    Registers read by an instruction, R0 left out (it is never written).
+
+    >>> from memory import decode_instruction
+    >>> register_reads(decode_instruction(0b00000110011000100000000000000100))  # add r3, r1, r2
+    (1, 2)
+    """
+    opcode = instruction.opcode
+    if opcode in MATH:
+        registers: tuple[int, ...] = (instruction.r1,) if instruction.flag else (instruction.r1, instruction.r2)
+    elif opcode == Opcode.LOAD_WORD.code:
+        registers = (instruction.r1,)
+    elif opcode == Opcode.WRITE_WORD.code:
+        registers = (instruction.r1, instruction.r2)
+    elif opcode in CONDITIONAL_BRANCHES:
+        registers = (instruction.rb, instruction.r1)
+    else:
+        registers = ()
+    return tuple(register for register in registers if register != 0)
+
+
+def register_writes(instruction: DecodedInstruction) -> tuple[int, ...]:
+    """Registers written by an instruction."""
+    if instruction.opcode in MATH:
+        return (instruction.rb, SCRATCH_REGISTER) if instruction.flag else (instruction.rb,)
+    if instruction.opcode == Opcode.LOAD_WORD.code:
+        return (instruction.rb,)
+    return ()
+
+
+class PipelineEngine(InstructionEngine):
+    """
+    Pipelined control unit: the next instruction is fetched and decoded while the current one executes.
+
+    The instructions are executed whole like in InstructionEngine, so the architectural state
+    (registers, memory, output, stop reason) is the same as in the microcoded run, only the
+    ticks are counted by the pipeline timing:
+
+    - IF takes a tick, ID (decode, register read) a tick, EX the rows of the instruction's own
+      microprogram. The stages work in order and hold one instruction each, so an instruction
+      waits in IF or ID while the next stage is busy.
+    - Hazards: an instruction does not enter EX before the registers it reads are written.
+      An ALU result is forwarded to the next EX, a loaded word (and any result without
+      forwarding) is read by ID after the write, a tick later. Writes can not be reordered
+      with the in-order single EX, so there are no write-after-read or write-after-write hazards.
+    - Branches: instructions are fetched sequentially (predict not taken). A taken conditional
+      branch redirects the fetch when it leaves EX, a jmp when it leaves ID, the instructions
+      fetched behind it are flushed.
+
+    The counters of the microcoded run are not kept: tick_counter holds the pipelined ticks
+    (the end of EX of the last instruction), mc_counter the microinstructions executed.
+    """
+
+    def __init__(self, control_unit: ControlUnit, forwarding: bool = True):
+        super().__init__(control_unit)
+        self.forwarding = forwarding
+        self.stalls = 0  # EX ticks lost to data hazards
+        self.stalled = 0  # Instructions which waited for an operand
+        self.forwarded = 0  # Operands which would have stalled without forwarding
+        self.flushes = 0  # Taken branches
+        self.flush_ticks = 0  # EX ticks lost refilling the pipeline after them
+        self._empty(control_unit.tick_counter)
+
+    def _empty(self, tick: int) -> None:
+        # Ticks at which the next fetch may start and ID and EX become free
+        self.next_fetch = self.decode_free = self.execute_free = tick
+        # Tick at which a register is written and whether its value is forwarded
+        self.written = [tick] * REGISTER_COUNT
+        self.forwardable = [False] * REGISTER_COUNT
+        self.redirected = False
+        self.tick = tick
+
+    def stats(self) -> str:
+        return (
+            f"stalls={self.stalls}, stalled_instructions={self.stalled}, forwarded={self.forwarded}, "
+            f"flushes={self.flushes}, flush_ticks={self.flush_ticks}"
+        )
+
+    def _ready(self, register: int) -> int:
+        return self.written[register] + (0 if self.forwardable[register] else 1)
+
+    def run(self, tick_limit: int) -> str | None:
+        """
+        Execute instructions while their EX ends within the tick limit.
+
+        An instruction which would end later is left to the next run, tick_counter is then set to
+        the tick limit. A pipeline left by the microcoded ControlUnit in between starts empty.
+
+        Returns:
+            str | None: "HALT" if the program halted, None at the tick limit.
+        """
+        if self.control_unit.tick_counter != self.tick:
+            self._empty(self.control_unit.tick_counter)
+        while self.control_unit.tick_counter < tick_limit:
+            instruction = self.datapath.instruction_memory.read_decoded(self.datapath.pc + 1)
+            if instruction.decode_line is None:
+                # Raises InvalidOpcodeError like the microcoded fetch
+                self.step()
+            longest = max(cost.ticks for cost in self.costs[instruction.decode_line])
+            decode = max(self.next_fetch + 1, self.decode_free)
+            issue = max(decode + 1, self.execute_free)
+            execute = max([issue, *(self._ready(register) for register in register_reads(instruction))])
+            if execute + longest > tick_limit:
+                self.control_unit.tick_counter = self.tick = tick_limit
+                return None
+            if self._execute(instruction, decode, issue, execute):
+                return "HALT"
+        return None
+
+    def _execute(self, instruction: DecodedInstruction, decode: int, issue: int, execute: int) -> bool:
+        try:
+            halted = self.step()
+        except Exception:
+            self.control_unit.tick_counter = self.tick = execute + self.stage
+            raise
+        cost = self.costs[instruction.decode_line][self.alu.neg_zero]
+        end = execute + cost.ticks
+
+        reads = register_reads(instruction)
+        if execute > issue:
+            self.stalls += execute - issue
+            self.stalled += 1
+        self.forwarded += sum(
+            1 for register in reads if self.forwardable[register] and execute == self.written[register]
+        )
+        if self.redirected:
+            self.flush_ticks += issue - self.execute_free
+        for register in register_writes(instruction):
+            self.written[register] = end
+            self.forwardable[register] = self.forwarding and instruction.opcode in MATH
+
+        self.redirected = cost.jumps
+        if not cost.jumps:
+            self.next_fetch = decode
+        elif instruction.opcode == Opcode.JUMP.code:
+            self.next_fetch = decode + 1
+        else:
+            self.next_fetch = end
+        self.flushes += cost.jumps
+        self.decode_free = execute
+        self.execute_free = end
+        self.control_unit.tick_counter = self.tick = end
+        return halted
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import re
+from collections import Counter
+from collections.abc import Iterable, Sequence
+from typing import Any, TextIO
+
+from control_unit import ControlUnit
+from isa import Opcode
+from memory import decode_instruction
+from microcode import MicroProgramMemory
+from tracer import Tracer
+
+# Text section line of the translator listing: "<number> <32 bit word> <source line>"
+LISTING_LINE_REGEX = re.compile(r"^(\d+) ([01]{32}) (.*)$")
+OPCODE_NAMES = {opcode.code: opcode.mnemonic for opcode in Opcode}
+
+
+def read_listing(lines: Iterable[str]) -> dict[int, str]:
+    """
+    Map instruction addresses to source lines using the listing printed by translator.main.
+
+    The listing numbers instructions from 1, addresses (PC values, labels) start at 0.
+
+    >>> read_listing(["-- Text section --", "1 00000000000000000000000000000000 nop", "-- Data section --"])
+    {0: 'nop'}
+    """
+    source = {}
+    for line in lines:
+        match = LISTING_LINE_REGEX.match(line.rstrip("\n"))
+        if match is not None:
+            source[int(match.group(1)) - 1] = match.group(3)
+    return source
+
+
+def variant_name(word: int) -> str:
+    """
+    Opcode mnemonic and flag of an instruction word.
+
+    >>> variant_name(int("00000110011000100000000000000101", 2))
+    'add/1'
+    """
+    instruction = decode_instruction(word)
+    return f"{OPCODE_NAMES.get(instruction.opcode, instruction.opcode)}/{instruction.flag}"
+
+
+def opcode_mix(code: Sequence[int], fetched: Counter[int]) -> dict[str, int]:
+    """
+    Executions per opcode and flag of the instructions fetched per address, the most frequent first.
+
+    Fetches past the end of the code are left out.
+
+    >>> opcode_mix([int("00000110011000100000000000000101", 2), 0], Counter({0: 3, 1: 1, 9: 1}))
+    {'add/1': 3, 'nop/0': 1}
+    """
+    variants: Counter[str] = Counter()
+    for address, executions in fetched.items():
+        if address < len(code):
+            variants[variant_name(code[address])] += executions
+    return dict(variants.most_common())
+
+
+class Profiler(Tracer):
+    """
+    Execution profile of the microcoded ControlUnit.
+
+    The profiler receives the state after every tick like a tracer (and passes it on to the
+    wrapped tracer), so nothing is counted and nothing costs anything when it is not attached.
+    It counts ticks and executions per instruction address, executions per opcode and flag,
+    microprogram rows started, taken branches per address and taken backward branches (loops).
+    """
+
+    def __init__(self, source: dict[int, str] | None = None):
+        super().__init__()
+        self.source = {} if source is None else source
+        self.tracer: Tracer | None = None
+        self.code: list[int] = []
+        self.pc = 0
+        self.mpc = 0
+        self.address = 0
+        self.executions: Counter[int] = Counter()
+        self.ticks: Counter[int] = Counter()
+        self.rows: Counter[int] = Counter()
+        self.back_edges: Counter[tuple[int, int]] = Counter()
+        self.taken: Counter[int] = Counter()
+
+    def attach(self, control_unit: ControlUnit, tracer: Tracer | None = None) -> Profiler:
+        """
+        Start profiling from the current state of the control unit.
+
+        Args:
+            control_unit (ControlUnit): The profiled machine.
+            tracer (Tracer | None): Tracer which gets the states after the profiler.
+
+        Returns:
+            Profiler: The profiler itself, to be used as the tracer of the run.
+        """
+        self.tracer = tracer
+        self.code = list(control_unit.datapath.instruction_memory.cells)
+        self.pc = control_unit.datapath.pc
+        self.mpc = control_unit.mpc
+        # An instruction resumed in the middle was fetched already, PC points to the next one
+        self.address = self.pc if self.mpc == 0 else self.pc - 1
+        return self
+
+    def record(self, ir: int, mpc: int, pc: int, registers: list[int], neg_zero: int, ticks: int, mc: int) -> None:
+        row = self.mpc
+        self.rows[row] += 1
+        if row == 0:
+            self.address = self.pc
+            self.executions[self.pc] += 1
+        self.ticks[self.address] += 1
+        if mpc == 0 and pc != self.address + 1:
+            self.taken[self.address] += 1
+            if pc <= self.address:
+                self.back_edges[(self.address, pc)] += 1
+        self.pc = pc
+        self.mpc = mpc
+        if self.tracer is not None:
+            self.tracer.record(ir, mpc, pc, registers, neg_zero, ticks, mc)
+
+    def signals(self) -> Counter[str]:
+        """Executions of every signal, from the microprogram rows started (a HALT row counts in full)."""
+        counts: Counter[str] = Counter()
+        for row, executions in self.rows.items():
+            for signal in MicroProgramMemory.get_microprogram(row):
+                counts[signal.name] += executions
+        return counts
+
+    def loops(self) -> list[dict[str, Any]]:
+        """
+        Hot loops: taken backward branches with the ticks spent in their bodies, hottest first.
+        """
+        loops = []
+        for (branch, target), taken in self.back_edges.items():
+            body_ticks = sum(ticks for address, ticks in self.ticks.items() if target <= address <= branch)
+            loops.append(
+                {
+                    "start": target,
+                    "end": branch,
+                    "iterations": taken,
+                    "ticks": body_ticks,
+                    "source": self.source.get(target, ""),
+                }
+            )
+        return sorted(loops, key=lambda loop: loop["ticks"], reverse=True)
+
+    def report(self) -> dict[str, Any]:
+        """The profile as JSON-compatible data."""
+        return {
+            "ticks": sum(self.ticks.values()),
+            "instructions": [
+                {
+                    "address": address,
+                    "executions": self.executions[address],
+                    "ticks": ticks,
+                    "source": self.source.get(address, ""),
+                }
+                for address, ticks in sorted(self.ticks.items())
+            ],
+            "branches": [{"address": address, "taken": taken} for address, taken in sorted(self.taken.items())],
+            "opcodes": opcode_mix(self.code, self.executions),
+            "microprogram_rows": {str(row): count for row, count in sorted(self.rows.items())},
+            "signals": dict(self.signals().most_common()),
+            "loops": self.loops(),
+        }
+
+    def write_table(self, file: TextIO) -> None:
+        """Write the profile as text tables."""
+        report = self.report()
+        total = max(report["ticks"], 1)
+        file.write(f"{'address':>7} {'executions':>10} {'ticks':>8} {'%':>6}  source\n")
+        for line in report["instructions"]:
+            share = 100 * line["ticks"] / total
+            file.write(
+                f"{line['address']:>7} {line['executions']:>10} {line['ticks']:>8} {share:>6.2f}  {line['source']}\n"
+            )
+        file.write(f"\n{'opcode':>10} {'executions':>10}\n")
+        for name, count in report["opcodes"].items():
+            file.write(f"{name:>10} {count:>10}\n")
+        file.write(f"\n{'loop':>11} {'iterations':>10} {'ticks':>8}  source\n")
+        for loop in report["loops"]:
+            span = f"{loop['start']}-{loop['end']}"
+            file.write(f"{span:>11} {loop['iterations']:>10} {loop['ticks']:>8}  {loop['source']}\n")
+        file.write(f"\n{'row':>5} {'executions':>10}\n")
+        for row, count in report["microprogram_rows"].items():
+            file.write(f"{row:>5} {count:>10}\n")
+        file.write(f"\n{'signal':>20} {'executions':>10}\n")
+        for name, count in report["signals"].items():
+            file.write(f"{name:>20} {count:>10}\n")
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, NamedTuple
+
+from machine_exceptions import StopIterationError
+
+if TYPE_CHECKING:
+    from control_unit import ControlUnit
+
+STOP_HALT = "HALT"
+STOP_INPUT_EXHAUSTED = "INPUT_EXHAUSTED"
+STOP_TICK_LIMIT = "TICK_LIMIT"
+STOP_ERROR = "ERROR"
+
+
+def classify_stop(stop_reason: str | None, error: Exception | None) -> str:
+    """
+    Kind of the end of a run from its stop reason and the exception which ended it.
+
+    >>> classify_stop("HALT", None), classify_stop(None, None), classify_stop("list index out of range", IndexError())
+    ('HALT', 'TICK_LIMIT', 'ERROR')
+    """
+    if stop_reason is None:
+        return STOP_TICK_LIMIT
+    if stop_reason == STOP_HALT:
+        return STOP_HALT
+    if isinstance(error, StopIterationError):
+        return STOP_INPUT_EXHAUSTED
+    return STOP_ERROR
+
+
+class RunResult(NamedTuple):
+    """
+    What a run of machine.run_simulation produced.
+
+    >>> result = RunResult(STOP_HALT, "HALT", 8, 12, 3, 40, (0,) * 16, [72, 105, -1], {"nop/0": 3}, {}, None)
+    >>> result.cpi, result.output_text
+    (4.0, 'Hi�')
+    """
+
+    stop: str  # STOP_HALT, STOP_INPUT_EXHAUSTED, STOP_TICK_LIMIT or STOP_ERROR
+    stop_reason: str | None  # "HALT" or the message of the error, None at the tick limit
+    loc: int  # Instructions in the program
+    ticks: int
+    instructions: int
+    microinstructions: int
+    registers: tuple[int, ...]
+    output: list[int]
+    opcode_mix: dict[str, int]  # Executions per opcode and flag ("add/1"), the most frequent first
+    stats: dict[str, str]  # Counters of the block cache, the pipeline or the data cache by name
+    control_unit: ControlUnit  # The machine after the run: data memory, flags, latches
+
+    @property
+    def cpi(self) -> float:
+        """Ticks per executed instruction."""
+        return self.ticks / self.instructions if self.instructions else 0.0
+
+    @property
+    def output_text(self) -> str:
+        """The output words as characters, U+FFFD for those which are not a code point."""
+        return "".join(chr(word) if 0 <= word < 0x110000 else "\ufffd" for word in self.output)
+
+
+def log_result(result: RunResult) -> None:
+    """Log the summary of a run in the golden log format, attributed to the caller (machine.run_simulation)."""
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    if result.stop_reason is not None:
+        logging.debug(f"StopIteration reason:  {result.stop_reason}", stacklevel=2)
+    for name, stats in result.stats.items():
+        logging.debug(f"{name}: {stats}", stacklevel=2)
+    logging.debug(f"LOC: {result.loc}", stacklevel=2)
+    logging.debug(f"Ticks:  {result.ticks}", stacklevel=2)
+    logging.debug(f"Instructions executed: {result.instructions}", stacklevel=2)
+    logging.debug(f"Microprogram executed: {result.microinstructions}", stacklevel=2)
+    logging.debug(f"Output(int): {result.output}", stacklevel=2)
+    logging.debug(
+        f"Output(str): {[chr(word) if 0 <= word < 0x110000 else 'NONE' for word in result.output]}", stacklevel=2
+    )
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import struct
+import sys
+import zlib
+from array import array
+from collections import deque
+from pathlib import Path
+from typing import Any
+
+from control_unit import ControlUnit
+from machine_exceptions import InvalidSnapshotError
+from memory import CELL_TYPECODE, PAGE_COUNT, PAGE_SIZE, decode_instruction
+from microcode import Signal
+
+# Snapshot layout (all fields little-endian):
+# | magic (4s) | version (H) | flags (H) | program CRC-32 (I) | field mask (Q) |
+# | input size (I) | output size (I) | page count (I) |
+# | 64 bit words: present fields, instruction word, registers, input, output, page numbers, pages |
+MAGIC = b"RSNP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIQIII")
+WORD_SIZE = 8
+
+FLAG_INPUT_FINISHED = 0b1
+
+# Scalar state: (owner, attribute), see _owners. Attributes which were never set (muxes before
+# their first signal, ALU result before the first operation) are absent from the field mask.
+FIELDS = (
+    ("cu", "ir"),
+    ("cu", "operands"),
+    ("cu", "mpc"),
+    ("cu", "mpc_mux"),
+    ("cu", "inc_value"),
+    ("cu", "decode_line"),
+    ("cu", "tick_counter"),
+    ("cu", "instructions_counter"),
+    ("cu", "mc_counter"),
+    ("dp", "pc"),
+    ("dp", "pc_mux"),
+    ("dp", "data_src_mux"),
+    ("dp", "cu_address_out"),
+    ("dp", "cu_data_out"),
+    ("rf", "mux_left_out"),
+    ("rf", "mux_right_out"),
+    ("rf", "left_out"),
+    ("rf", "right_out"),
+    ("alu", "alu_signal"),
+    ("alu", "alu_result"),
+    ("alu", "neg_zero"),
+    ("dm", "memory_out"),
+)
+SIGNAL_FIELDS = {"mpc_mux", "pc_mux", "data_src_mux", "mux_left_out", "mux_right_out", "alu_signal"}
+REGISTER_COUNT = 16
+
+
+def _owners(control_unit: ControlUnit) -> dict[str, Any]:
+    datapath = control_unit.datapath
+    return {
+        "cu": control_unit,
+        "dp": datapath,
+        "rf": datapath.register_file,
+        "alu": datapath.alu,
+        "dm": datapath.data_memory,
+    }
+
+
+def program_checksum(control_unit: ControlUnit) -> int:
+    """CRC-32 of the instruction words and the initial data memory image, a snapshot only fits its own program."""
+    checksum = zlib.crc32(array(CELL_TYPECODE, control_unit.datapath.instruction_memory.cells).tobytes())
+    for page in control_unit.datapath.data_memory.image:
+        checksum = zlib.crc32(page.tobytes(), checksum)
+    return checksum
+
+
+def encode_instruction(control_unit: ControlUnit) -> int:
+    """Instruction word of the latched instruction (the inverse of memory.decode_instruction)."""
+    instruction = control_unit.instruction
+    return (
+        (instruction.opcode << 25)
+        | (instruction.rb << 21)
+        | (instruction.r1 << 17)
+        | (instruction.r2 << 1)
+        | instruction.flag
+    )
+
+
+def _drain_input(control_unit: ControlUnit) -> list[int]:
+    # The rest of the input source is pulled into the buffer, so the snapshot does not depend on it
+    io_controller = control_unit.datapath.io_controller
+    for chunk in io_controller.input_source:
+        io_controller.input_buffer.extend(chunk)
+    return list(io_controller.input_buffer)
+
+
+def save_snapshot(control_unit: ControlUnit, filename: str) -> None:
+    """
+    Write the full machine state into a snapshot file.
+
+    Only the data memory pages written by the program are stored, the rest comes from the
+    program itself when the snapshot is loaded. The not yet read input is pulled from the input
+    source into the input buffer first (a stream is read up to its end).
+
+    Args:
+        control_unit (ControlUnit): The machine, its DataPath is saved too.
+        filename (str): Snapshot file, replaced atomically.
+    """
+    owners = _owners(control_unit)
+    datapath = control_unit.datapath
+    io_controller = datapath.io_controller
+    data_memory = datapath.data_memory
+
+    mask = 0
+    words = array(CELL_TYPECODE)
+    for bit, (owner, name) in enumerate(FIELDS):
+        value = getattr(owners[owner], name, None)
+        if value is not None:
+            mask |= 1 << bit
+            words.append(value)
+    words.append(encode_instruction(control_unit))
+    words.extend(datapath.register_file.registers)
+    input_words = _drain_input(control_unit)
+    words.extend(input_words)
+    words.extend(io_controller.output_buffer)
+    pages = [number for number in range(PAGE_COUNT) if data_memory.owned[number]]
+    words.extend(pages)
+    for number in pages:
+        words.extend(data_memory.pages[number])
+    if sys.byteorder == "big":
+        words.byteswap()
+
+    flags = FLAG_INPUT_FINISHED if io_controller.input_finished else 0
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        flags,
+        program_checksum(control_unit),
+        mask,
+        len(input_words),
+        len(io_controller.output_buffer),
+        len(pages),
+    )
+    temporary = Path(f"{filename}.tmp")
+    with open(temporary, "wb") as file:
+        file.write(header)
+        file.write(words.tobytes())
+    temporary.replace(filename)
+
+
+def _read_words(filename: str) -> tuple[tuple[Any, ...], array]:
+    with open(filename, "rb") as file:
+        content = file.read()
+    if len(content) < HEADER.size:
+        raise InvalidSnapshotError(filename)
+    header = HEADER.unpack_from(content)
+    if header[0] != MAGIC or header[1] != VERSION or (len(content) - HEADER.size) % WORD_SIZE:
+        raise InvalidSnapshotError(filename)
+    words = array(CELL_TYPECODE)
+    words.frombytes(content[HEADER.size :])
+    if sys.byteorder == "big":
+        words.byteswap()
+    return header, words
+
+
+def load_snapshot(filename: str, control_unit: ControlUnit) -> None:
+    """
+    Restore a snapshot into a ControlUnit created for the same program.
+
+    Restoring copies the saved words back, nothing is replayed.
+
+    Raises:
+        InvalidSnapshotError: If the file is not a snapshot, is truncated or was saved for another program.
+    """
+    header, words = _read_words(filename)
+    _, _, flags, checksum, mask, input_size, output_size, page_count = header
+    fields = [(owner, name) for bit, (owner, name) in enumerate(FIELDS) if mask >> bit & 1]
+    size = len(fields) + 1 + REGISTER_COUNT + input_size + output_size + page_count * (1 + PAGE_SIZE)
+    if len(words) != size or checksum != program_checksum(control_unit):
+        raise InvalidSnapshotError(filename)
+
+    owners = _owners(control_unit)
+    for (owner, name), value in zip(fields, words):
+        setattr(owners[owner], name, Signal(value) if name in SIGNAL_FIELDS else value)
+    position = len(fields)
+    control_unit.instruction = decode_instruction(words[position])
+    position += 1
+    datapath = control_unit.datapath
+    datapath.register_file.registers[:] = words[position : position + REGISTER_COUNT]
+    position += REGISTER_COUNT
+
+    io_controller = datapath.io_controller
+    io_controller.input_source = iter(())
+    io_controller.input_buffer = deque(words[position : position + input_size])
+    io_controller.input_finished = bool(flags & FLAG_INPUT_FINISHED)
+    position += input_size
+    io_controller.output_buffer = words[position : position + output_size].tolist()
+    position += output_size
+    _restore_pages(control_unit, words[position : position + page_count], words[position + page_count :])
+
+
+def _restore_pages(control_unit: ControlUnit, numbers: array, contents: array) -> None:
+    data_memory = control_unit.datapath.data_memory
+    data_memory.reset()
+    for index, number in enumerate(numbers):
+        if not data_memory.owned[number]:
+            data_memory.owned[number] = True
+            data_memory.resident_pages += 1
+        data_memory.pages[number] = contents[index * PAGE_SIZE : (index + 1) * PAGE_SIZE]
+
+
+class Checkpointer:
+    """
+    Saves snapshots of a running simulation.
+
+    A checkpoint is written every `every` ticks (if set) and when the run stops at its tick
+    limit, so the run can be resumed with a new tick budget. The path may contain "{ticks}",
+    otherwise every checkpoint replaces the previous one.
+    """
+
+    def __init__(self, path: str, every: int | None = None):
+        self.path = path
+        self.every = every
+
+    def boundaries(self, start: int, tick_limit: int) -> list[int]:
+        """
+        Ticks at which the run is paused for a checkpoint, the last one is the tick limit.
+
+        >>> Checkpointer("run.snap", 1000).boundaries(1500, 3500)
+        [2000, 3000, 3500]
+        """
+        if not self.every:
+            return [tick_limit]
+        return [*range((start // self.every + 1) * self.every, tick_limit, self.every), tick_limit]
+
+    def save(self, control_unit: ControlUnit) -> None:
+        save_snapshot(control_unit, self.path.format(ticks=control_unit.tick_counter))
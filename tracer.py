@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import argparse
+import inspect
+import logging
+from collections import deque
+from collections.abc import Callable
+from typing import TextIO
+
+from machine_exceptions import TraceModeError
+
+TRACE_OFF = "off"
+TRACE_LOG = "log"
+TRACE_RING = "ring"
+TRACE_SAMPLE = "sample"
+# Default size of the ring and period of the sample, the other modes take no argument
+TRACE_DEFAULTS = {TRACE_RING: 1000, TRACE_SAMPLE: 100}
+
+# Machine state: IR, MPC, PC, registers, NZ, ticks, microinstructions executed
+MachineState = tuple[int, int, int, tuple[int, ...], int, int, int]
+
+
+def format_state(state: MachineState) -> str:
+    """
+    Format a machine state the same way as the per-tick log of machine.run_simulation.
+
+    >>> format_state((6, 2, 1, (0,) * 16, 0, 2, 9))
+    'Machine state: IR(6), MPC(2), PC(1), REGISTERS([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]), NZ(0), TICKS(2), MC_COUNTER(9)'
+    """
+    ir, mpc, pc, registers, neg_zero, ticks, mc_counter = state
+    return (
+        f"Machine state: IR({ir}), MPC({mpc}), PC({pc}), REGISTERS({list(registers)}), "
+        f"NZ({neg_zero}), TICKS({ticks}), MC_COUNTER({mc_counter})"
+    )
+
+
+class Tracer:
+    """Base class for machine state tracers, called by run_simulation after every microcoded tick."""
+
+    def __init__(self):
+        self.states: deque[MachineState] | list[MachineState] = []
+
+    def record(self, ir: int, mpc: int, pc: int, registers: list[int], neg_zero: int, ticks: int, mc: int) -> None:
+        self.states.append((ir, mpc, pc, tuple(registers), neg_zero, ticks, mc))
+
+    def dump(self, file: TextIO | None = None) -> None:
+        """
+        Write the recorded states in the golden log format.
+
+        Args:
+            file (TextIO | None): Output file, the states are logged with logging.debug if None.
+        """
+        for state in self.states:
+            if file is None:
+                logging.debug(format_state(state))
+            else:
+                file.write(format_state(state) + "\n")
+
+
+class LogTracer(Tracer):
+    """
+    Logs every state immediately as it happens (the golden log), nothing is kept.
+
+    The records are attributed to the frame of the origin function (machine.run_simulation) when
+    it is on the stack, so the log shows the same module and function as the states it traces.
+    """
+
+    def __init__(self, origin: Callable | None = None):
+        super().__init__()
+        self.origin = None if origin is None else origin.__code__
+
+    def record(self, ir: int, mpc: int, pc: int, registers: list[int], neg_zero: int, ticks: int, mc: int) -> None:
+        logger = logging.getLogger()
+        if logger.isEnabledFor(logging.DEBUG):
+            state = format_state((ir, mpc, pc, registers, neg_zero, ticks, mc))
+            logger.debug(state, stacklevel=self.stacklevel())
+
+    def stacklevel(self) -> int:
+        """Stack level of the origin frame for a logging call in record, 1 (record itself) without it."""
+        frame = inspect.currentframe()
+        level = 0
+        while frame is not None:
+            if frame.f_code is self.origin:
+                return level
+            frame = frame.f_back
+            level += 1
+        return 1
+
+
+class RingBufferTracer(Tracer):
+    """Keeps the last `size` machine states."""
+
+    def __init__(self, size: int):
+        super().__init__()
+        self.states = deque(maxlen=size)
+
+
+class SamplingTracer(Tracer):
+    """Keeps the state of every `every`-th tick."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+
+    def record(self, ir: int, mpc: int, pc: int, registers: list[int], neg_zero: int, ticks: int, mc: int) -> None:
+        if ticks % self.every == 0:
+            self.states.append((ir, mpc, pc, tuple(registers), neg_zero, ticks, mc))
+
+
+def parse_trace_mode(mode: str) -> tuple[str, int]:
+    """
+    Split a mode string (off, log, ring:<size> or sample:<every>) into the name and the argument, 0 for off and log.
+
+    >>> parse_trace_mode("ring:100"), parse_trace_mode("sample"), parse_trace_mode("log")
+    (('ring', 100), ('sample', 100), ('log', 0))
+
+    Raises:
+        TraceModeError: If the name is unknown, or the argument is not a number from 1 or is not expected.
+    """
+    name, _, argument = mode.partition(":")
+    if name in (TRACE_OFF, TRACE_LOG) and not argument:
+        return name, 0
+    if name not in TRACE_DEFAULTS:
+        raise TraceModeError(mode)
+    if not argument:
+        return name, TRACE_DEFAULTS[name]
+    if not argument.isdigit() or int(argument) < 1:
+        raise TraceModeError(mode)
+    return name, int(argument)
+
+
+def trace_mode(mode: str) -> str:
+    """
+    Argument type of a trace option: the mode string once parse_trace_mode accepts it.
+
+    Raises:
+        argparse.ArgumentTypeError: If the mode is not valid, reported by argparse as a usage error.
+    """
+    try:
+        parse_trace_mode(mode)
+    except TraceModeError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+    return mode
+
+
+def create_tracer(mode: str, origin: Callable | None = None) -> Tracer | None:
+    """
+    Create a tracer from a mode string: off, log, ring:<size> or sample:<every>.
+
+    The log tracer attributes its records to the origin function (see LogTracer).
+
+    >>> type(create_tracer("ring:100")).__name__, create_tracer("off")
+    ('RingBufferTracer', None)
+
+    Raises:
+        TraceModeError: If the mode is not valid (see parse_trace_mode).
+    """
+    name, argument = parse_trace_mode(mode)
+    if name == TRACE_LOG:
+        return LogTracer(origin)
+    if name == TRACE_RING:
+        return RingBufferTracer(argument)
+    if name == TRACE_SAMPLE:
+        return SamplingTracer(argument)
+    return None
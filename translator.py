@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import argparse
+import functools
 import re
-import sys
+from collections.abc import Callable
 
+import dataflow as dataflow_optimization
+import layout
+import peephole
 from isa import (
     DATA_MEMORY_BEGIN_ADDRESS,
     INPUT_CELL_ADDRESS,
@@ -10,16 +15,27 @@ from isa import (
     OUTPUT_CELL_ADDRESS,
     Opcode,
 )
+from object_file import SECTION_DATA, SECTION_TEXT, Symbol, write_object
 from translator_excpetions import InvalidArgumentCountError, InvalidArgumentError, NoTokenError
 from translator_token import Token, TokenType
 
-# Regular expressions for different types of tokens
-REGISTER_REGEX = re.compile(r"\b(r\d+)\b")
-LABEL_REGEX = re.compile(r"[a-zA-Z_]\w*:")
-NUMBER_REGEX = re.compile(r"#\b\d+\b")
+# Scanner of a source line: a single alternation with a named group per token kind, tried in
+# this order at every position. A token is a run of characters up to a space, comma or quote, its
+# kind depends on how it starts (e.g. "r1:" is a register, "loop:x" a label). A quoted string is
+# a token of its own even without a separator; a quote which is not closed starts a word
+TOKEN_REGEX = re.compile(
+    r"""
+    (?P<separator>[\s,]+)
+    | (?P<string>"[^"]*")
+    | (?P<register>r\d+\b[^\s,"]*)
+    | (?P<label>[a-zA-Z_]\w*:[^\s,"]*)
+    | (?P<number>\#\d+\b[^\s,"]*)
+    | (?P<section>\.\w[^\s,"]*)
+    | (?P<word>"?[^\s,"]+|")
+    """,
+    re.VERBOSE,
+)
 COMMENT_REGEX = re.compile(r"//.*")
-STRING_REGEX = re.compile(r'"[^\"]*"')
-SECTION_REGEX = re.compile(r"\.(\w+)")
 
 
 def remove_comments(text: str) -> str:
@@ -45,46 +61,42 @@ def read_file(filename: str) -> list[str]:
     return code_lines
 
 
-def replace_quoted_strings(line: str) -> tuple[str, dict]:
-    string_placeholders = {}
-    placeholder_index = 0
-    matches = list(re.finditer(STRING_REGEX, line))
-    for match in matches:
-        placeholder = f"__STRING_PLACEHOLDER_{placeholder_index}__"
-        string_placeholders[placeholder] = match.group(0).replace('"', "").replace("\\0", chr(0))
-        line = line.replace(match.group(0), placeholder, 1)
-        placeholder_index += 1
-    return line, string_placeholders
-
-
-def process_token(token: str, string_placeholders: dict, tokens: list[Token]):
-    if token in string_placeholders:
-        tokens.append(Token(TokenType.STRING, string_placeholders[token]))
-    elif re.match(REGISTER_REGEX, token):
-        tokens.append(Token(TokenType.REGISTER, token[1:]))
-    elif re.match(LABEL_REGEX, token):
-        tokens.append(Token(TokenType.LABEL, token[:-1]))
-    elif re.match(NUMBER_REGEX, token):
-        tokens.append(Token(TokenType.NUMBER, int(token[1:])))
-    elif re.match(SECTION_REGEX, token):
-        tokens.append(Token(TokenType.SECTION, token[1:]))
-    else:
-        if any([t.type == TokenType.INSTRUCTION for t in tokens]):
-            tokens.append(Token(TokenType.LABEL, token))
-        else:
-            tokens.append(Token(TokenType.INSTRUCTION, token))
-
+# Tokens of the scanner groups, bare words are handled by tokenize_line
+TOKEN_FACTORIES = {
+    "string": lambda text: Token(TokenType.STRING, text.replace('"', "").replace("\\0", chr(0))),
+    "register": lambda text: Token(TokenType.REGISTER, text[1:]),
+    "label": lambda text: Token(TokenType.LABEL, text[:-1]),
+    "number": lambda text: Token(TokenType.NUMBER, int(text[1:])),
+    "section": lambda text: Token(TokenType.SECTION, text[1:]),
+}
 
-def tokenize_line(line) -> list[Token]:
-    """Tokenize a single line of code."""
-    tokens: list[Token] = []
 
-    line, string_placeholders = replace_quoted_strings(line)
+def tokenize_line(line: str) -> list[Token]:
+    """
+    Tokenize a single line of code in one left-to-right pass.
 
-    for token in re.split(r"[\s,]+", line):
-        if token:
-            process_token(token, string_placeholders, tokens)
+    The first bare word of a line is the instruction, the following ones are labels.
 
+    >>> [(token.get_type().value, token.get_value()) for token in tokenize_line('hello: "Hi, \\\\0" #5')]
+    [('label', 'hello'), ('string', 'Hi, \\x00'), ('number', 5)]
+    >>> [token.get_type().value for token in tokenize_line("loop: add r1, r0, limit")]
+    ['label', 'instruction', 'register', 'register', 'label']
+    >>> [(token.get_type().value, token.get_value()) for token in tokenize_line('hello:"Hi" a"b"')]
+    [('label', 'hello'), ('string', 'Hi'), ('instruction', 'a'), ('string', 'b')]
+    """
+    tokens: list[Token] = []
+    seen_instruction = False
+    for match in TOKEN_REGEX.finditer(line):
+        kind = match.lastgroup
+        if kind == "separator":
+            continue
+        if kind in TOKEN_FACTORIES:
+            tokens.append(TOKEN_FACTORIES[kind](match.group()))
+        elif seen_instruction:
+            tokens.append(Token(TokenType.LABEL, match.group()))
+        else:
+            tokens.append(Token(TokenType.INSTRUCTION, match.group()))
+            seen_instruction = True
     return tokens
 
 
@@ -140,6 +152,23 @@ def get_all_labels(token_line: list[list[Token]]) -> list[Token]:
     return labels
 
 
+def data_line_size(tokens: list[Token]) -> int:
+    """
+    Words taken by the values following a data label.
+
+    >>> data_line_size([Token(TokenType.STRING, "Hi"), Token(TokenType.NUMBER, 5)])
+    3
+    """
+    size = 0
+    for token in tokens:
+        if token.get_type() == TokenType.STRING:
+            # Increment the current_address by the length of the string
+            size += len(token.get_string_value().strip('"').replace("\\0", ""))
+        elif token.get_type() in [TokenType.NUMBER, TokenType.LABEL]:
+            size += 1
+    return size
+
+
 def get_data_labels_mapping(token_lines: list[list[Token]]) -> dict[str, int]:
     mapping = {"in": INPUT_CELL_ADDRESS, "out": OUTPUT_CELL_ADDRESS}
     current_address = DATA_MEMORY_BEGIN_ADDRESS
@@ -150,13 +179,7 @@ def get_data_labels_mapping(token_lines: list[list[Token]]) -> dict[str, int]:
             label = line[0].get_string_value()
             # Calculate the memory address for this label
             mapping[label] = current_address
-            # Assume the next token in the line is a string
-            for token in line[1:]:
-                if token.get_type() == TokenType.STRING:
-                    # Increment the current_address by the length of the string
-                    current_address += len(token.get_string_value().strip('"').replace("\\0", ""))
-                elif token.get_type() in [TokenType.NUMBER, TokenType.LABEL]:
-                    current_address += 1
+            current_address += data_line_size(line[1:])
     print(mapping)
     return mapping
 
@@ -323,11 +346,52 @@ def convert_data_tokens_to_binary(tokens: list[Token]) -> list[str]:
     return result
 
 
-def main(source: str, target_code: str, target_data: str):
+def optimization_passes(optimize: bool, dataflow: bool, profile: str | None) -> list[tuple[str, Callable]]:
+    """Names and functions of the optimizations of the tokenized program to run, in order."""
+    passes: list[tuple[str, Callable]] = []
+    if optimize:
+        passes.append(("peephole", peephole.optimize))
+    if dataflow:
+        passes.append(("dataflow", dataflow_optimization.optimize))
+    if profile is not None:
+        passes.append(("layout", functools.partial(layout.optimize, profile=layout.load_profile(profile))))
+    return passes
+
+
+def format_changes(name: str, changes: dict[str, int]) -> str:
+    """
+    Listing line of the changes an optimization made.
+
+    >>> format_changes("peephole", {"nop removed": 2, "move folded": 1})
+    '-- Optimization peephole: nop removed 2, move folded 1 --'
+    """
+    summary = ", ".join(f"{change} {count}" for change, count in changes.items())
+    return f"-- Optimization {name}: {summary or 'no changes'} --"
+
+
+def main(
+    source: str,
+    target_code: str,
+    target_data: str | None = None,
+    optimize: bool = False,
+    dataflow: bool = False,
+    profile: str | None = None,
+):
+    """
+    Translate the source into an object file, or into the text code and data files if target_data is given.
+
+    With optimize the tokenized program goes through the peephole optimization (peephole.py) before encoding,
+    with dataflow through redundant load elimination and loop-invariant code motion (dataflow.py). With a
+    profile (machine.py --profile-json of the program translated the same way) its basic blocks are laid out
+    so the hot paths fall through (layout.py), last.
+    """
     code = read_file(source)
     tokenized = tokenize(code)
 
     data_label_mapping = get_data_labels_mapping(tokenized)
+    for name, optimization in optimization_passes(optimize, dataflow, profile):
+        code, tokenized, changes = optimization(code, tokenized, data_label_mapping)
+        print(format_changes(name, changes))
     text_label_mapping = get_text_labels_mapping(tokenized)
 
     output = []
@@ -340,7 +404,6 @@ def main(source: str, target_code: str, target_data: str):
             print(f"{instruction_mem_counter} {binary} {code[i]}")
             output.append(binary)
             instruction_mem_counter += 1
-    write_file(target_code, output)
 
     print("-- Data section --")
     data_output = []
@@ -351,14 +414,47 @@ def main(source: str, target_code: str, target_data: str):
             data_output.append(line)
             print(f"{data_mem_counter}  {line}")
             data_mem_counter += 1
-    write_file(target_data, data_output)
 
+    if target_data is None:
+        symbols = [Symbol(label, SECTION_TEXT, address) for label, address in text_label_mapping.items()]
+        symbols += [Symbol(label, SECTION_DATA, address) for label, address in data_label_mapping.items()]
+        write_object(
+            target_code,
+            [int(word, 2) for word in output],
+            [int(word, 2) for word in data_output],
+            INSTRUCTION_MEMORY_BEGIN_ADDRESS,
+            symbols,
+        )
+    else:
+        write_file(target_code, output)
+        write_file(target_data, data_output)
 
-if __name__ == "__main__":
-    assert len(sys.argv) == 4, "Usage: python translator.py  <input_file>  <code_output>  <data_output>"
-
-    source = sys.argv[1]
-    file_code_output = sys.argv[2]
-    file_data_output = sys.argv[3]
 
-    main(source, file_code_output, file_data_output)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Translator of the RISC assembly")
+    parser.add_argument("source", help="assembly source file")
+    parser.add_argument("target_code", help="object file, or the code file of the text format")
+    # With a separate data file the program is exported in the text format
+    parser.add_argument("target_data", nargs="?", help="data file, exports the program in the text format")
+    parser.add_argument("--optimize", action="store_true", help="remove nops, jump chains, dead code and moves")
+    parser.add_argument("--dataflow", action="store_true", help="remove redundant loads, hoist loop-invariant ones")
+    parser.add_argument("--layout", metavar="PROFILE", help="lay out basic blocks by a --profile-json report")
+    parser.add_argument("--cache", metavar="DIRECTORY", help="reuse translations from this cache (no listing)")
+    parser.add_argument("--cache-size", type=int, help="cache size limit in bytes")
+    args = parser.parse_args()
+
+    if args.cache is None:
+        main(args.source, args.target_code, args.target_data, args.optimize, args.dataflow, args.layout)
+    else:
+        # Imported here, the cache module imports the translator
+        from assembly_cache import DEFAULT_CACHE_SIZE, AssemblyCache
+
+        cache = AssemblyCache(args.cache, args.cache_size or DEFAULT_CACHE_SIZE)
+        cache.translate(
+            args.source,
+            args.target_code,
+            args.target_data,
+            optimize=args.optimize,
+            dataflow=args.dataflow,
+            profile=args.layout,
+        )
@@ -26,3 +26,18 @@ class InvalidArgumentError(TranslatorError):
             f"Invalid argument '{
             argument}'. Expected one of: {expected_str}"
         )
+
+
+class DuplicateLabelError(TranslatorError):
+    def __init__(self, label: str):
+        super().__init__(f"Label '{label}' is defined more than once")
+
+
+class UndefinedLabelError(TranslatorError):
+    def __init__(self, label: str):
+        super().__init__(f"Label '{label}' is used but never defined")
+
+
+class ProfileMismatchError(TranslatorError):
+    def __init__(self, address: int):
+        super().__init__(f"Profile does not match the program at address {address}")